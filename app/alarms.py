@@ -0,0 +1,326 @@
+# app/alarms.py
+#
+# Edge alarm engine: rules from data/alarm_rules.csv (above, below, rate_above, rate_below, stale)
+# evaluated against each DeviceRecord as it is polled; events are queued for the MQTT alarm publisher.
+
+import csv
+import math
+import queue
+import threading
+import time
+from app import clock
+from app import metrics
+from app.logger import logger
+
+RULES_FILE = "data/alarm_rules.csv"
+CONDITIONS = ("above", "below", "rate_above", "rate_below", "stale")
+# Events waiting for the MQTT alarm publisher; the oldest are dropped if the broker stays unreachable
+MAX_QUEUED_EVENTS = 10000
+events = queue.Queue(MAX_QUEUED_EVENTS)
+
+def parse_active_hours(text):
+    """"HH:MM-HH:MM" as (start_minute, end_minute) of the local day, or None for always."""
+    if not text:
+        return None
+    minutes = []
+    for hhmm in text.split("-"):
+        parts = hhmm.strip().split(":")
+        if len(parts) != 2 or not all(part.isdigit() for part in parts):
+            raise ValueError(f"active_hours {text!r} is not HH:MM-HH:MM")
+        hours, mins = int(parts[0]), int(parts[1])
+        if hours > 23 or mins > 59:
+            raise ValueError(f"active_hours {text!r} has an invalid time {hhmm.strip()!r}")
+        minutes.append(hours * 60 + mins)
+    if len(minutes) != 2:
+        raise ValueError(f"active_hours {text!r} is not HH:MM-HH:MM")
+    return tuple(minutes)
+
+def parse_rules(path):
+    """Reads the rules file; rows with an unreadable threshold or active_hours are logged and skipped."""
+    with open(path, mode='r', encoding='utf-8-sig', newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        rules = []
+        for row in reader:
+            try:
+                rules.append({
+                    "rule_id": row["rule_id"].strip(),
+                    "device_type_id": row["device_type_id"].strip(),
+                    "variable_name": row["variable_name"].strip(),
+                    "condition": row["condition"].strip().lower(),
+                    "threshold": float(row["threshold"]),
+                    "hysteresis": float(row.get("hysteresis") or 0),
+                    "severity": (row.get("severity") or "major").strip(),
+                    "active_hours": parse_active_hours((row.get("active_hours") or "").strip())
+                })
+            except ValueError as e:
+                logger.error(f"Invalid alarm rule, skipped: Alarm rule {row['rule_id'].strip()}: {e}")
+        return rules
+
+def rule_error(rule, variables):
+    """Why a rule cannot be compiled against the register map's (device_type_id, variable_name) pairs, or None."""
+    if rule["condition"] not in CONDITIONS:
+        return f"Alarm rule {rule['rule_id']} has unknown condition {rule['condition']!r}"
+    if rule["variable_name"] == "*":
+        if rule["condition"] != "stale":
+            return f"Alarm rule {rule['rule_id']}: only stale rules can watch a whole device"
+    elif (rule["device_type_id"], rule["variable_name"]) not in variables:
+        return (f"Alarm rule {rule['rule_id']} references unknown variable {rule['variable_name']!r} "
+                f"of device type {rule['device_type_id']!r}")
+    return None
+
+def in_active_hours(rule, now):
+    hours = rule["active_hours"]
+    if hours is None:
+        return True
+    local = time.localtime(now)
+    minute = local.tm_hour * 60 + local.tm_min
+    start, end = hours
+    return start <= minute < end if start <= end else minute >= start or minute < end
+
+class TypeRules:
+    """The rules of one device type bound to the slots of its layout."""
+
+    def __init__(self, rules, layout):
+        self.layout = layout
+        # slot -> value rules evaluated when that slot's value changes
+        self.by_slot = {}
+        # (rule, slots) evaluated after every poll: staleness and time-of-day rules
+        self.clocked = []
+        self.slot_block = []
+        for block_number in range(len(layout.block_slots) - 1):
+            self.slot_block.extend([block_number] * (layout.block_slots[block_number + 1] - layout.block_slots[block_number]))
+        for rule in rules:
+            if rule["variable_name"] == "*":
+                slots = (None,)
+            else:
+                slots = tuple(slot for slot, name in enumerate(layout.variable_names) if name == rule["variable_name"])
+            if rule["condition"] == "stale" or rule["active_hours"] is not None:
+                self.clocked.append((rule, slots))
+            else:
+                for slot in slots:
+                    self.by_slot.setdefault(slot, []).append(rule)
+        self.watched = tuple(self.by_slot)
+        # Slots with rate rules, which also need evaluating when a fresh read repeats the value (rate 0)
+        self.rate_slots = frozenset(slot for slot, slot_rules in self.by_slot.items() if any(r["condition"].startswith("rate_") for r in slot_rules))
+
+class DeviceAlarmState:
+    __slots__ = ("layout", "values", "times", "active", "created")
+
+    def __init__(self, layout):
+        self.layout = layout
+        # Value of each slot when it was last evaluated, and each block's time at the previous poll
+        self.values = [math.nan] * len(layout)
+        self.times = [0.0] * (len(layout.block_slots) - 1)
+        # (rule_id, slot) -> the event that raised the alarm
+        self.active = {}
+        self.created = clock.now()
+
+class AlarmEngine:
+    """
+    Evaluates alarm rules against DeviceRecords as they are polled.
+
+    Args:
+        rules: Parsed, valid rules (parse_rules).
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.rules_by_type = {}
+        for rule in rules:
+            self.rules_by_type.setdefault(rule["device_type_id"], []).append(rule)
+        self.device_types = {}
+        self.compiled = {}
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def configure(self, device_map):
+        self.device_types = {f"{d['device_id']}_{d['slave_id']}": d["device_type_id"] for d in device_map}
+        with self.lock:
+            for device_key in list(self.states):
+                if device_key not in self.device_types:
+                    self.clear_device(device_key)
+
+    def adopt(self, previous):
+        """Takes over another engine's alarm states, clearing alarms of rules that were changed or removed."""
+        rules = {rule["rule_id"]: rule for rule in self.rules}
+        old_rules = {rule["rule_id"]: rule for rule in previous.rules}
+        now = clock.now()
+        with previous.lock:
+            for device_key, state in previous.states.items():
+                for key, event in list(state.active.items()):
+                    if rules.get(key[0]) != old_rules.get(key[0]):
+                        del state.active[key]
+                        self.emit_cleared(event, now)
+                self.states[device_key] = state
+
+    def type_rules(self, device_type_id, layout):
+        compiled = self.compiled.get(device_type_id)
+        if compiled is None or compiled.layout is not layout:
+            compiled = self.compiled[device_type_id] = TypeRules(self.rules_by_type.get(device_type_id, []), layout)
+        return compiled
+
+    def evaluate(self, record, now=None):
+        """
+        Evaluates the rules affected by the record's latest poll and queues any state changes.
+        Values restored by a warm start (record.stale) are only checked for staleness.
+        """
+        if record is None:
+            return
+        device_type_id = self.device_types.get(record.device_key)
+        if device_type_id not in self.rules_by_type:
+            return
+        now = now or clock.now()
+        with self.lock:
+            compiled = self.type_rules(device_type_id, record.layout)
+            state = self.states.get(record.device_key)
+            if state is None or state.layout is not record.layout:
+                self.clear_device(record.device_key)
+                state = self.states[record.device_key] = DeviceAlarmState(record.layout)
+
+            values, valid, block_times = record.values, record.valid, record.block_times
+            for slot in () if record.stale else compiled.watched:
+                if not valid[slot]:
+                    continue
+                changed = values[slot] != state.values[slot]
+                block_number = compiled.slot_block[slot]
+                elapsed = block_times[block_number] - state.times[block_number]
+                if not changed and not (elapsed > 0 and slot in compiled.rate_slots):
+                    continue
+                for rule in compiled.by_slot[slot]:
+                    if changed or rule["condition"].startswith("rate_"):
+                        self.check_value(rule, record, slot, elapsed, state, now)
+                state.values[slot] = values[slot]
+
+            for rule, slots in compiled.clocked:
+                for slot in slots:
+                    if rule["condition"] == "stale":
+                        self.check_stale(rule, record, slot, compiled, state, now)
+                    elif valid[slot] and not record.stale:
+                        block_number = compiled.slot_block[slot]
+                        self.check_value(rule, record, slot, block_times[block_number] - state.times[block_number], state, now)
+                        state.values[slot] = values[slot]
+            state.times[:] = block_times
+
+    def check_value(self, rule, record, slot, elapsed, state, now):
+        key = (rule["rule_id"], slot)
+        active = key in state.active
+        value = record.values[slot]
+        if not in_active_hours(rule, now):
+            if active:
+                self.change(rule, record, slot, value, state, now, raised=False)
+            return
+        condition, threshold, hysteresis = rule["condition"], rule["threshold"], rule["hysteresis"]
+        if condition.startswith("rate_"):
+            previous = state.values[slot]
+            if math.isnan(previous) or elapsed <= 0:
+                return
+            value = (value - previous) / elapsed
+        if condition.endswith("above"):
+            raise_it, clear_it = value > threshold, value <= threshold - hysteresis
+        else:
+            raise_it, clear_it = value < threshold, value >= threshold + hysteresis
+        if raise_it and not active:
+            self.change(rule, record, slot, value, state, now, raised=True)
+        elif clear_it and active:
+            self.change(rule, record, slot, value, state, now, raised=False)
+
+    def check_stale(self, rule, record, slot, compiled, state, now):
+        last = record.timestamp() if slot is None else record.block_times[compiled.slot_block[slot]]
+        # Seconds since the last successful read, or since the engine first saw the device
+        age = now - (last or state.created)
+        active = (rule["rule_id"], slot) in state.active
+        if age > rule["threshold"] and not active:
+            self.change(rule, record, slot, age, state, now, raised=True)
+        elif age <= rule["threshold"] and active:
+            self.change(rule, record, slot, age, state, now, raised=False)
+
+    def change(self, rule, record, slot, value, state, now, raised):
+        key = (rule["rule_id"], slot)
+        event = {
+            "alarm": rule["rule_id"],
+            "state": "raised" if raised else "cleared",
+            "severity": rule["severity"],
+            "condition": rule["condition"],
+            "threshold": rule["threshold"],
+            "device_id": record.device_key,
+            "device_name": record.device_name,
+            "variable_name": rule["variable_name"],
+            "address": None if slot is None else record.layout.addresses[slot],
+            "value": value,
+            "timestamp": int(now * 1000)
+        }
+        if raised:
+            state.active[key] = event
+            metrics.ALARMS_ACTIVE.inc()
+        else:
+            state.active.pop(key, None)
+            metrics.ALARMS_ACTIVE.dec()
+        logger.warning(f"Alarm {rule['rule_id']} {event['state']} on {record.device_key}: {rule['variable_name']} {value:g}")
+        emit(event)
+
+    def emit_cleared(self, event, now):
+        metrics.ALARMS_ACTIVE.dec()
+        emit(dict(event, state="cleared", value=None, timestamp=int(now * 1000)))
+
+    def clear_device(self, device_key):
+        """Clears a device's alarms (device removed or its layout changed); the caller holds the lock."""
+        state = self.states.pop(device_key, None)
+        if state is not None:
+            now = clock.now()
+            for event in state.active.values():
+                self.emit_cleared(event, now)
+
+    def active(self):
+        with self.lock:
+            return [event for state in self.states.values() for event in state.active.values()]
+
+def emit(event):
+    metrics.ALARM_EVENTS.inc(state=event["state"], severity=event["severity"])
+    try:
+        events.put_nowait(event)
+    except queue.Full:
+        events.get_nowait()
+        events.put_nowait(event)
+
+# ----------------------
+# Process-wide engine, from settings.json "alarms"
+# ----------------------
+engine = None
+
+def configure(settings, register_map, device_map):
+    """(Re)builds the engine when the rules change; raised alarms of unchanged rules stay raised."""
+    global engine
+    options = settings.get("alarms", {})
+    if not options.get("enabled", False):
+        engine = None
+        return
+    path = options.get("rules_file", RULES_FILE)
+    try:
+        rules = parse_rules(path)
+    except Exception as e:
+        logger.error(f"Failed to load alarm rules from {path}, keeping the current rules: {e}")
+        if engine is not None:
+            engine.configure(device_map)
+        return
+
+    variables = {(reg["device_type_id"], reg["variable_name"]) for reg in register_map}
+    valid_rules = []
+    for rule in rules:
+        error = rule_error(rule, variables)
+        if error:
+            logger.error(f"Invalid alarm rule, skipped: {error}")
+        elif any(rule["rule_id"] == other["rule_id"] for other in valid_rules):
+            logger.error(f"Duplicate alarm rule {rule['rule_id']}, skipped")
+        else:
+            valid_rules.append(rule)
+
+    if engine is None or engine.rules != valid_rules:
+        previous, engine = engine, AlarmEngine(valid_rules)
+        if previous is not None:
+            engine.adopt(previous)
+        logger.info(f"Loaded {len(valid_rules)} alarm rules from {path}.")
+    engine.configure(device_map)
+
+def evaluate(record):
+    if engine is not None:
+        engine.evaluate(record)
@@ -2,6 +2,11 @@
 import os
 import json
 import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from app.metrics import SPOOL_PAYLOADS, SPOOL_BYTES
+from app.tracing import traced
 
 logger = logging.getLogger("modbus")
 
@@ -10,6 +15,7 @@ ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 # Point to the cache_buffer.json in the root folder
 CACHE_FILE = os.path.join(ROOT_DIR, "cache_buffer.json")
 
+@traced("cache_save")
 def save_payload_to_cache(payload):
     try:
         cache = []
@@ -19,23 +25,126 @@ def save_payload_to_cache(payload):
         cache.append(payload)
         with open(CACHE_FILE, "w") as f:
             json.dump(cache, f)
+        SPOOL_PAYLOADS.set(len(cache))
+        SPOOL_BYTES.set(os.path.getsize(CACHE_FILE))
         logger.warning("Saved payload to cache.")
     except Exception as e:
         logger.error(f"Error saving to cache: {e}")
 
+@traced("cache_load")
 def load_cached_payloads():
     try:
         if os.path.exists(CACHE_FILE):
             with open(CACHE_FILE, "r") as f:
-                return json.load(f)
+                cache = json.load(f)
+            SPOOL_PAYLOADS.set(len(cache))
+            SPOOL_BYTES.set(os.path.getsize(CACHE_FILE))
+            return cache
     except Exception as e:
         logger.error(f"Error loading cache: {e}")
     return []
 
+@traced("cache_clear")
 def clear_cache():
     try:
         if os.path.exists(CACHE_FILE):
             os.remove(CACHE_FILE)
             logger.info("Cleared MQTT cache.")
+        SPOOL_PAYLOADS.set(0)
+        SPOOL_BYTES.set(0)
     except Exception as e:
         logger.error(f"Error clearing cache: {e}")
+
+@contextmanager
+def isolated_spool():
+    """
+    Points the MQTT spool at a temporary file while the block runs, so benchmarks and offline
+    replays that publish through mqtt_manager never fill or clear the gateway's real spool.
+    """
+    global CACHE_FILE
+    real_cache_file = CACHE_FILE
+    with tempfile.TemporaryDirectory(prefix="spool-") as directory:
+        CACHE_FILE = os.path.join(directory, "cache_buffer.json")
+        try:
+            yield CACHE_FILE
+        finally:
+            CACHE_FILE = real_cache_file
+
+class DurableQueue:
+    """
+    Append-only JSON-lines queue on disk with a persisted read offset. Records survive restarts
+    until a consumer commits past them; the file is truncated once everything is consumed.
+
+    Args:
+        path: Queue file; the committed offset is kept in "<path>.offset".
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = f"{path}.offset"
+        self.lock = threading.Lock()
+
+    @traced("queue_append")
+    def append(self, records):
+        if not records:
+            return
+        data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def committed_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    @traced("queue_read_batch")
+    def read_batch(self, max_rows, max_bytes):
+        """
+        Returns (records, end_offset) for up to max_rows records / max_bytes bytes after the
+        committed offset. Pass end_offset to commit() once the records are safely stored.
+        """
+        offset = self.committed_offset()
+        records = []
+        with self.lock:
+            if not os.path.exists(self.path):
+                return records, offset
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                size = 0
+                while len(records) < max_rows and size < max_bytes:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        # End of file or a partially written record from an interrupted append
+                        break
+                    offset += len(line)
+                    size += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError as e:
+                        logger.error(f"Skipping corrupt queue record in {self.path}: {e}")
+        return records, offset
+
+    @traced("queue_commit")
+    def commit(self, end_offset):
+        with self.lock:
+            if os.path.exists(self.path) and end_offset >= os.path.getsize(self.path):
+                # Fully consumed: compact by truncating the queue and resetting the offset
+                open(self.path, "w").close()
+                end_offset = 0
+            tmp_path = f"{self.offset_path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(str(end_offset))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.offset_path)
+
+    def pending_bytes(self):
+        try:
+            return max(0, os.path.getsize(self.path) - self.committed_offset())
+        except OSError:
+            return 0
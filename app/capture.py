@@ -0,0 +1,409 @@
+# app/capture.py
+#
+# Record and replay of Modbus reads: each request with its response registers (or bits), timestamp
+# and latency, plus the active configuration, so the poller can be run offline from a capture.
+#
+#   python -m app.capture summary captures/site.mbcap
+#   python -m app.capture replay captures/site.mbcap --cycles 10 --speed 0 --publish
+#
+# File layout (little endian): magic "MBCP", uint16 version, then records starting with a type byte:
+#   1 endpoint:    uint16 index, uint16 length, "PROTOCOL address param" (utf-8)
+#   2 transaction: float64 timestamp, float32 latency, uint16 endpoint, uint8 unit, uint8 function
+#                  code, uint8 status, uint16 address, uint16 count, uint16 n, uint16 * n payload
+#                  (status 0: registers, or for FC1/FC2 the packed bits two bytes per word (little
+#                  endian); 1: exception response, payload = [code]; 2: no response)
+#   3 config:      uint32 length, JSON {"settings", "register_map", "device_map"}
+
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from app import clock
+from app.pipelined_tcp import RegisterResponse
+from app.read_plan import BIT_FUNCTION_CODES
+from app.utils import pack_bits, unpack_bits
+from app.logger import logger
+
+MAGIC = b"MBCP"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sH")
+ENDPOINT = struct.Struct("<BHH")
+TRANSACTION = struct.Struct("<BdfHBBBHHH")
+CONFIG = struct.Struct("<BI")
+
+RECORD_ENDPOINT = 1
+RECORD_TRANSACTION = 2
+RECORD_CONFIG = 3
+
+STATUS_OK = 0
+STATUS_EXCEPTION = 1
+STATUS_NO_RESPONSE = 2
+
+class CaptureError(Exception):
+    pass
+
+def endpoint_name(endpoint):
+    return " ".join(str(part) for part in endpoint)
+
+def bits_to_words(bits):
+    packed = pack_bits(bits)
+    if len(packed) % 2:
+        packed += b"\0"
+    return list(struct.unpack(f"<{len(packed) // 2}H", packed))
+
+def words_to_bits(words, count):
+    return unpack_bits(struct.pack(f"<{len(words)}H", *words), count)
+
+# ----------------------
+# Recording
+# ----------------------
+class CaptureWriter:
+    """Appends transactions to a capture file; shared by all recording clients."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        if new_file:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        else:
+            # Endpoint indexes are per file; continue numbering after the existing ones
+            self.endpoints = {name: index for index, name in read_capture(path)["endpoints"].items()}
+        self.file.flush()
+
+    def write_config(self, settings, register_map, device_map):
+        data = json.dumps({"settings": settings, "register_map": register_map, "device_map": device_map}).encode("utf-8")
+        with self.lock:
+            self.file.write(CONFIG.pack(RECORD_CONFIG, len(data)) + data)
+            self.file.flush()
+
+    def endpoint_index(self, endpoint):
+        name = endpoint_name(endpoint)
+        index = self.endpoints.get(name)
+        if index is None:
+            index = self.endpoints[name] = len(self.endpoints)
+            data = name.encode("utf-8")
+            self.file.write(ENDPOINT.pack(RECORD_ENDPOINT, index, len(data)) + data)
+        return index
+
+    def write_transaction(self, endpoint, unit_id, function_code, address, count, status, payload, timestamp, latency):
+        with self.lock:
+            index = self.endpoint_index(endpoint)
+            self.file.write(
+                TRANSACTION.pack(RECORD_TRANSACTION, timestamp, latency, index, unit_id, function_code, status,
+                                 address, count, len(payload))
+                + struct.pack(f"<{len(payload)}H", *payload)
+            )
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class RecordingClient:
+    """Wraps a Modbus client and records every read it makes; everything else is passed through."""
+
+    def __init__(self, client, endpoint, writer):
+        self.client = client
+        self.endpoint = endpoint
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def record(self, function_code, read, address, count, slave):
+        timestamp = time.time()
+        start = time.perf_counter()
+        try:
+            result = read(address=address, count=count, slave=slave)
+        except Exception:
+            self.writer.write_transaction(self.endpoint, slave, function_code, address, count, STATUS_NO_RESPONSE, [],
+                                          timestamp, time.perf_counter() - start)
+            raise
+        latency = time.perf_counter() - start
+        if result is None:
+            status, payload = STATUS_NO_RESPONSE, []
+        elif result.isError():
+            status, payload = STATUS_EXCEPTION, [getattr(result, "exception_code", 0) or 0]
+        elif function_code in BIT_FUNCTION_CODES:
+            status, payload = STATUS_OK, bits_to_words(result.bits[:count])
+        else:
+            status, payload = STATUS_OK, list(result.registers)
+        self.writer.write_transaction(self.endpoint, slave, function_code, address, count, status, payload, timestamp, latency)
+        return result
+
+    def read_coils(self, address, count=1, slave=1):
+        return self.record(1, self.client.read_coils, address, count, slave)
+
+    def read_discrete_inputs(self, address, count=1, slave=1):
+        return self.record(2, self.client.read_discrete_inputs, address, count, slave)
+
+    def read_holding_registers(self, address, count=1, slave=1):
+        return self.record(3, self.client.read_holding_registers, address, count, slave)
+
+    def read_input_registers(self, address, count=1, slave=1):
+        return self.record(4, self.client.read_input_registers, address, count, slave)
+
+# ----------------------
+# Reading and replay
+# ----------------------
+def read_capture(path):
+    """
+    Parses a capture file.
+
+    Returns:
+        dict: {"endpoints": {index: name}, "configs": [config, ...],
+               "transactions": [(timestamp, latency, endpoint, unit, fc, status, address, count, payload), ...]}
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < FILE_HEADER.size:
+        raise CaptureError(f"{path} is not a capture file")
+    magic, version = FILE_HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise CaptureError(f"{path} is not a version {VERSION} capture file")
+
+    endpoints, configs, transactions = {}, [], []
+    offset = FILE_HEADER.size
+    while offset < len(data):
+        record_type = data[offset]
+        try:
+            if record_type == RECORD_ENDPOINT:
+                _, index, length = ENDPOINT.unpack_from(data, offset)
+                offset += ENDPOINT.size
+                endpoints[index] = data[offset:offset + length].decode("utf-8")
+                offset += length
+            elif record_type == RECORD_TRANSACTION:
+                _, timestamp, latency, index, unit, fc, status, address, count, n = TRANSACTION.unpack_from(data, offset)
+                offset += TRANSACTION.size
+                payload = list(struct.unpack_from(f"<{n}H", data, offset))
+                offset += 2 * n
+                transactions.append((timestamp, latency, endpoints[index], unit, fc, status, address, count, payload))
+            elif record_type == RECORD_CONFIG:
+                _, length = CONFIG.unpack_from(data, offset)
+                offset += CONFIG.size
+                configs.append(json.loads(data[offset:offset + length]))
+                offset += length
+            else:
+                raise CaptureError(f"Unknown record type {record_type} at offset {offset} in {path}")
+        except struct.error:
+            # Truncated last record, e.g. the recorder was killed mid-write
+            logger.warning(f"Ignoring truncated record at offset {offset} in {path}")
+            break
+    return {"endpoints": endpoints, "configs": configs, "transactions": transactions}
+
+class Replay:
+    """
+    Recorded responses indexed by endpoint and request. Each request replays its recorded
+    responses in order and starts over when they run out, one capture length later on the replay
+    clock (now()), which follows the recorded timestamps of the responses replayed.
+
+    Args:
+        path: Capture file.
+        speed: 1.0 replays recorded latencies, 2.0 twice as fast, 0 without any delay.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        capture = read_capture(path)
+        self.configs = capture["configs"]
+        self.responses = defaultdict(list)
+        for timestamp, latency, endpoint, unit, fc, status, address, count, payload in capture["transactions"]:
+            self.responses[(endpoint, unit, fc, address, count)].append((timestamp + latency, latency, status, payload))
+        self.endpoints = {key[0] for key in self.responses}
+        self.cursors = defaultdict(int)
+        self.lock = threading.Lock()
+        times = sorted(response[0] for responses in self.responses.values() for response in responses)
+        # Replays loop after the capture's span plus one typical gap between repeats of a request
+        gaps = sorted(b[0] - a[0] for responses in self.responses.values() for a, b in zip(responses, responses[1:]))
+        self.period = (times[-1] - times[0] if times else 0) + (gaps[len(gaps) // 2] if gaps else 1.0)
+        self.time = times[0] if times else 0.0
+        # Time of the response each polling thread replayed last, for the values it stores
+        self.local = threading.local()
+
+    def now(self):
+        """Recorded time of this thread's last replayed response, else of the latest replayed so far."""
+        return getattr(self.local, "time", None) or self.time
+
+    def next_response(self, endpoint, unit_id, function_code, address, count):
+        key = (endpoint_name(endpoint), unit_id, function_code, address, count)
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                return None
+            lap, index = divmod(self.cursors[key], len(responses))
+            timestamp, latency, status, payload = responses[index]
+            self.cursors[key] += 1
+            timestamp += lap * self.period
+            self.time = max(self.time, timestamp)
+        self.local.time = timestamp
+        return latency, status, payload
+
+class ReplayClient:
+    """Stands in for a Modbus client, answering reads from a Replay."""
+
+    def __init__(self, replay, endpoint):
+        self.replay = replay
+        self.endpoint = endpoint
+
+    def connect(self):
+        return endpoint_name(self.endpoint) in self.replay.endpoints
+
+    def close(self):
+        pass
+
+    def read(self, function_code, address, count, slave):
+        response = self.replay.next_response(self.endpoint, slave, function_code, address, count)
+        if response is None:
+            raise CaptureError(f"No recorded response for unit {slave} FC {function_code} {address}+{count} on {endpoint_name(self.endpoint)}")
+        latency, status, payload = response
+        if self.replay.speed > 0:
+            time.sleep(latency / self.replay.speed)
+        if status == STATUS_NO_RESPONSE:
+            raise CaptureError(f"No response from unit {slave} (recorded)")
+        if status == STATUS_EXCEPTION:
+            return RegisterResponse(function_code | 0x80, exception_code=payload[0])
+        if function_code in BIT_FUNCTION_CODES:
+            return RegisterResponse(function_code, bits=words_to_bits(payload, count))
+        return RegisterResponse(function_code, payload)
+
+    def read_coils(self, address, count=1, slave=1):
+        return self.read(1, address, count, slave)
+
+    def read_discrete_inputs(self, address, count=1, slave=1):
+        return self.read(2, address, count, slave)
+
+    def read_holding_registers(self, address, count=1, slave=1):
+        return self.read(3, address, count, slave)
+
+    def read_input_registers(self, address, count=1, slave=1):
+        return self.read(4, address, count, slave)
+
+    def write_register(self, address, value, slave=1):
+        raise CaptureError("Writes are not supported while replaying a capture")
+
+    def write_registers(self, address, values, slave=1):
+        raise CaptureError("Writes are not supported while replaying a capture")
+
+# ----------------------
+# Process-wide state, from settings.json "capture"
+# ----------------------
+writer = None
+replay = None
+
+def configure(settings, register_map, device_map):
+    """
+    Opens or closes the recorder and the replay source. "capture": {"record": path} records;
+    "capture": {"replay": path, "speed": 1.0} polls from a capture instead of the network.
+    """
+    global writer, replay
+    options = settings.get("capture", {})
+    record_path = options.get("record")
+    if writer is not None and writer.path != record_path:
+        writer.close()
+        writer = None
+    if record_path:
+        if writer is None:
+            writer = CaptureWriter(record_path)
+            logger.info(f"Recording Modbus transactions to {record_path}")
+        writer.write_config(settings, register_map, device_map)
+
+    replay_path = options.get("replay")
+    if not replay_path:
+        replay = None
+    elif replay is None or replay.path != replay_path or replay.speed != options.get("speed", 1.0):
+        replay = Replay(replay_path, options.get("speed", 1.0))
+        logger.info(f"Replaying Modbus transactions from {replay_path}")
+    clock.source = replay.now if replay is not None else time.time
+
+def wrap_client(client, endpoint):
+    """The client connections should use for an endpoint, given the recording/replay state."""
+    if replay is not None:
+        return ReplayClient(replay, endpoint)
+    if writer is not None and client is not None:
+        return RecordingClient(client, endpoint, writer)
+    return client
+
+# ----------------------
+# CLI
+# ----------------------
+def summary(path):
+    capture = read_capture(path)
+    transactions = capture["transactions"]
+    print(f"{path}: {len(transactions)} transactions, {len(capture['endpoints'])} endpoints, {len(capture['configs'])} configs")
+    if transactions:
+        span = transactions[-1][0] - transactions[0][0]
+        print(f"  recorded over {span:.1f}s")
+    by_status = defaultdict(int)
+    for transaction in transactions:
+        by_status[transaction[5]] += 1
+    print(f"  ok {by_status[STATUS_OK]}, exception {by_status[STATUS_EXCEPTION]}, no response {by_status[STATUS_NO_RESPONSE]}")
+    for index, name in sorted(capture["endpoints"].items()):
+        latencies = sorted(t[1] for t in transactions if t[2] == name)
+        if latencies:
+            print(f"  {name}: {len(latencies)} transactions, median latency {latencies[len(latencies) // 2] * 1000:.1f} ms")
+
+def run_replay(path, cycles, speed, publish, output=None):
+    """Polls from a capture through the normal pipeline and prints throughput; optionally dumps the last snapshot."""
+    global replay
+    from app import modbus_reader, mqtt_manager
+    from app.cache_manager import isolated_spool
+    from app.simulator import LoopbackMqttClient
+
+    configs = read_capture(path)["configs"]
+    if not configs:
+        raise CaptureError(f"{path} has no configuration record")
+    config = configs[-1]
+    settings = dict(config["settings"], capture={"replay": path, "speed": speed})
+    for key in ("shared_snapshot", "timeseries"):
+        settings.pop(key, None)
+    # Start from the beginning of the capture even if it was replayed before in this process
+    replay = None
+    modbus_reader.configure(settings, config["register_map"], config["device_map"])
+
+    loopback = LoopbackMqttClient()
+    if publish:
+        mqtt_manager.mqtt_client_instance = loopback
+        mqtt_manager.mqtt_connected.set()
+
+    start = time.perf_counter()
+    with isolated_spool():
+        for _ in range(cycles):
+            modbus_reader.poll_cycle()
+            if publish:
+                mqtt_manager.publish_to_mqtt(modbus_reader.get_data(), settings)
+    elapsed = time.perf_counter() - start
+    values = sum(record.count() for record in modbus_reader.device_data.values())
+    print(f"{cycles} cycles in {elapsed:.2f}s ({cycles / elapsed:.1f} cycles/s, {values * cycles / elapsed:.0f} values/s)"
+          + (f", published {loopback.messages} payloads" if publish else ""))
+    if output:
+        with open(output, "w") as f:
+            json.dump(modbus_reader.get_data(), f, indent=2, sort_keys=True)
+        print(f"Wrote the last snapshot to {output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or replay Modbus capture files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    summary_parser = commands.add_parser("summary")
+    summary_parser.add_argument("path")
+    replay_parser = commands.add_parser("replay")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--cycles", type=int, default=1)
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="1 = recorded latencies, 0 = as fast as possible")
+    replay_parser.add_argument("--publish", action="store_true", help="Also publish each cycle through a loopback MQTT client")
+    replay_parser.add_argument("--output", help="Write the last snapshot (as served by /data) to this JSON file")
+    replay_parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        summary(args.path)
+    else:
+        logger.setLevel(args.log_level.upper())
+        run_replay(args.path, args.cycles, args.speed, args.publish, args.output)
@@ -0,0 +1,11 @@
+# app/clock.py
+#
+# Wall-clock time of polled values and alarm checks. Replaying a capture swaps in the recorded
+# timestamps (capture.Replay.now) so rate/staleness alarms and derived metrics replay identically.
+
+import time
+
+source = time.time
+
+def now():
+    return source()
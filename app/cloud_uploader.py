@@ -1,71 +1,196 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
 import time
-import json
 import logging
-import pyodbc
-from app.cache_manager import load_cache, clear_cache
+from datetime import datetime
+from app.cache_manager import DurableQueue
+from app.metrics import SQL_ROWS_INSERTED, SQL_BATCH_DURATION, SQL_QUEUE_BYTES, SQL_RECONNECTS
 
-# Load settings
-with open("settings.json") as f:
-    settings = json.load(f)
+logger = logging.getLogger("modbus")
 
-sql_config = settings.get("sql", {})
+QUEUE_FILE = "sql_queue.jsonl"
+COLUMNS = ("dedup_key", "timestamp", "device_id", "device_name", "variable_name", "address", "value", "unit")
 
-logger = logging.getLogger("modbus")
+sql_config = {}
+queue = None
 
-def upload_to_cloud():
-    while True:
-        try:
-            rows = load_cache()
+def configure(settings):
+    """Loads the "sql" section of settings.json and opens the durable queue that feeds the sink."""
+    global sql_config, queue
+    sql_config = settings.get("sql", {})
+    queue = DurableQueue(sql_config.get("queue_file", QUEUE_FILE))
 
-            if not rows:
-                time.sleep(10)
+def dedup_key(device_key, address, variable_name, timestamp):
+    """Stable key for one reading, so a batch replayed after a crash is not inserted twice."""
+    return hashlib.sha1(f"{device_key}|{address}|{variable_name}|{timestamp}".encode("utf-8")).hexdigest()
+
+def enqueue_snapshot(device_data):
+    """Appends the numeric readings of a snapshot (modbus_reader.get_data()) to the SQL queue."""
+    rows = []
+    for device_key, entries in list(device_data.items()):
+        for entry in list(entries):
+            value = entry.get("value")
+            if not isinstance(value, (int, float)):
                 continue
+            rows.append([
+                dedup_key(device_key, entry.get("address"), entry.get("variable_name"), entry.get("timestamp")),
+                entry.get("timestamp"),
+                device_key,
+                entry.get("device_name"),
+                entry.get("variable_name"),
+                entry.get("address"),
+                value,
+                entry.get("unit")
+            ])
+    queue.append(rows)
+    SQL_QUEUE_BYTES.set(queue.pending_bytes())
+
+# ----------------------
+# Connection
+# ----------------------
+def connect():
+    dialect = sql_config.get("dialect", "mssql")
+    if dialect == "sqlite":
+        conn = sqlite3.connect(sql_config.get("database", "modbus.db"), check_same_thread=False)
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {sql_config['table']} ("
+            "dedup_key TEXT PRIMARY KEY, timestamp TEXT, device_id TEXT, device_name TEXT, "
+            "variable_name TEXT, address INTEGER, value REAL, unit TEXT)"
+        )
+        conn.commit()
+        return conn
 
-            conn_str = (
-                f"DRIVER={{{sql_config['driver']}}};"
-                f"SERVER={sql_config['server']};"
-                f"DATABASE={sql_config['database']};"
-                f"UID={sql_config['uid']};"
-                f"PWD={sql_config['pwd']};"
-                "Encrypt=yes;"
-                "TrustServerCertificate=no;"
-                "Connection Timeout=30;"
-            )
-
-            conn = pyodbc.connect(conn_str)
-            cursor = conn.cursor()
-
-            insert_sql = f"""
-                INSERT INTO {sql_config['table']}
-                (timestamp, device_id, device_name, variable_name, address, value, unit)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """
-
-            values = []
-            for row in rows:
-                values.append((
-                    row.get("timestamp"),
-                    row.get("device_id"),
-                    row.get("device_name"),
-                    row.get("variable_name"),
-                    row.get("address"),
-                    row.get("value"),
-                    row.get("unit")
-                ))
-
-            cursor.executemany(insert_sql, values)
-            conn.commit()
-            conn.close()
-
-            logger.info(f"[SQL] Inserted {len(values)} records into {sql_config['table']}.")
-            clear_cache()
+    # pyodbc is only needed for the SQL Server sink
+    import pyodbc
+    conn_str = (
+        f"DRIVER={{{sql_config['driver']}}};"
+        f"SERVER={sql_config['server']};"
+        f"DATABASE={sql_config['database']};"
+        f"UID={sql_config['uid']};"
+        f"PWD={sql_config['pwd']};"
+        "Encrypt=yes;"
+        "TrustServerCertificate=no;"
+        "Connection Timeout=30;"
+    )
+    conn = pyodbc.connect(conn_str, autocommit=False)
+    return conn
 
+def insert_batch(conn, rows):
+    """
+    Inserts a batch in one transaction, skipping rows whose dedup_key is already stored.
+    SQL Server: rows are bulk-bound into a temp staging table with fast_executemany (parameter
+    arrays, one round trip) and merged with a single INSERT ... WHERE NOT EXISTS.
+    SQLite: INSERT OR IGNORE against the dedup_key primary key.
+    """
+    table = sql_config['table']
+    columns = ", ".join(COLUMNS)
+    placeholders = ", ".join("?" for _ in COLUMNS)
+    cursor = conn.cursor()
+    if sql_config.get("dialect", "mssql") == "sqlite":
+        cursor.executemany(f"INSERT OR IGNORE INTO {table} ({columns}) VALUES ({placeholders})", rows)
+    else:
+        cursor.fast_executemany = True
+        cursor.execute(f"IF OBJECT_ID('tempdb..#stage') IS NULL SELECT TOP 0 {columns} INTO #stage FROM {table}")
+        cursor.execute("TRUNCATE TABLE #stage")
+        cursor.executemany(f"INSERT INTO #stage ({columns}) VALUES ({placeholders})", rows)
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM #stage s "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.dedup_key = s.dedup_key)"
+        )
+    conn.commit()
+
+# ----------------------
+# Sink loop
+# ----------------------
+def drain_queue(conn):
+    """Inserts queued rows batch by batch until the queue is empty. Returns the number of rows."""
+    max_rows = sql_config.get("batch_rows", 5000)
+    max_bytes = sql_config.get("batch_bytes", 1024 * 1024)
+    total = 0
+    while True:
+        rows, end_offset = queue.read_batch(max_rows, max_bytes)
+        if not rows:
+            return total
+        start = time.perf_counter()
+        insert_batch(conn, [tuple(row) for row in rows])
+        # Only advance the queue after the commit; a crash in between replays the batch, which the dedup keys absorb
+        queue.commit(end_offset)
+        elapsed = time.perf_counter() - start
+        SQL_BATCH_DURATION.observe(elapsed)
+        SQL_ROWS_INSERTED.inc(len(rows))
+        SQL_QUEUE_BYTES.set(queue.pending_bytes())
+        total += len(rows)
+        logger.info(f"[SQL] Inserted {len(rows)} records into {sql_config['table']} ({len(rows) / elapsed:.0f} rows/s).")
+
+def upload_to_cloud():
+    conn = None
+    delay = 1
+    while True:
+        try:
+            if conn is None:
+                conn = connect()
+                SQL_RECONNECTS.inc()
+                logger.info(f"[SQL] Connected to {sql_config.get('server', sql_config.get('database'))}.")
+                delay = 1
+            drain_queue(conn)
         except Exception as e:
-            logger.error(f"[SQL] Failed to upload to cloud: {e}")
+            logger.error(f"[SQL] Failed to upload to cloud: {e}. Reconnecting in {delay}s.")
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+            continue
 
-        time.sleep(10)
+        time.sleep(sql_config.get("interval", 10))
 
 def start_uploader_thread():
     uploader_thread = threading.Thread(target=upload_to_cloud, daemon=True)
     uploader_thread.start()
     logger.info("Started cloud uploader thread.")
+
+# ----------------------
+# Benchmark against SQLite
+# ----------------------
+def benchmark(rows, batch_rows):
+    """Inserts synthetic rows through the queue into a temporary SQLite database and reports rows/s."""
+    workdir = tempfile.mkdtemp()
+    configure({"sql": {"dialect": "sqlite", "database": os.path.join(workdir, "bench.db"), "table": "modbus_data",
+                       "batch_rows": batch_rows, "queue_file": os.path.join(workdir, "queue.jsonl")}})
+    timestamp = datetime.now().isoformat()
+    device_data = {
+        f"{d}_1": [{"timestamp": timestamp, "device_name": f"Device {d}", "variable_name": f"var{v}", "address": 40000 + v,
+                    "value": float(v), "unit": "kW"} for v in range(100)]
+        for d in range(max(1, rows // 100))
+    }
+    start = time.perf_counter()
+    enqueue_snapshot(device_data)
+    enqueued = time.perf_counter() - start
+
+    conn = connect()
+    start = time.perf_counter()
+    inserted = drain_queue(conn)
+    elapsed = time.perf_counter() - start
+
+    # Replaying the same snapshot must not create duplicates
+    enqueue_snapshot(device_data)
+    drain_queue(conn)
+    stored = conn.execute("SELECT COUNT(*) FROM modbus_data").fetchone()[0]
+    conn.close()
+    print(f"enqueue: {inserted / enqueued:.0f} rows/s, insert+commit: {inserted / elapsed:.0f} rows/s, "
+          f"rows stored after replay: {stored} (expected {inserted})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the SQL sink against a local SQLite database.")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--batch-rows", type=int, default=5000)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+    benchmark(args.rows, args.batch_rows)
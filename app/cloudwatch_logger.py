@@ -1,7 +1,5 @@
 import json
 import logging
-import boto3
-import watchtower
 from datetime import datetime
 import os
 import re
@@ -55,6 +53,10 @@ def init_logger(config_path="aws_config.json", device_config="device.json"):
     """Initializes the logger to stream to AWS CloudWatch."""
     global current_pi_id
 
+    # boto3/watchtower are slow to import; defer them so they never sit on the startup path
+    import boto3
+    import watchtower
+
     try:
         aws_config = load_aws_config(config_path)
         boto3.setup_default_session(
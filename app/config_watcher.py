@@ -0,0 +1,66 @@
+# app/config_watcher.py
+
+import json
+import os
+import threading
+import time
+from app import modbus_reader
+from app.csv_parser import parse_register_map, parse_device_map, validate_config
+from app.logger import logger
+
+def get_mtimes(paths):
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+def reload_config(settings_path=modbus_reader.SETTINGS_FILE,
+                  register_map_path=modbus_reader.REGISTER_MAP_FILE,
+                  device_map_path=modbus_reader.DEVICE_MAP_FILE):
+    """
+    Parses and validates the configuration files and stages them for the poller.
+    Invalid configurations are rejected and the running configuration is kept.
+
+    Returns:
+        bool: True if the new configuration was staged.
+    """
+    try:
+        with open(settings_path) as f:
+            new_settings = json.load(f)
+        new_register_map = parse_register_map(register_map_path)
+        new_device_map = parse_device_map(device_map_path)
+    except Exception as e:
+        logger.error(f"Config reload failed, keeping current configuration: {e}")
+        return False
+
+    errors = validate_config(new_settings, new_register_map, new_device_map)
+    if errors:
+        for error in errors:
+            logger.error(f"Invalid configuration: {error}")
+        logger.error("Config reload rejected, keeping current configuration.")
+        return False
+
+    modbus_reader.stage_config(new_settings, new_register_map, new_device_map)
+    logger.info("Configuration change detected; staged for the next poll cycle.")
+    return True
+
+def watch_config(interval=2, paths=None):
+    paths = paths or [modbus_reader.SETTINGS_FILE, modbus_reader.REGISTER_MAP_FILE, modbus_reader.DEVICE_MAP_FILE]
+    last_mtimes = get_mtimes(paths)
+    while True:
+        time.sleep(interval)
+        mtimes = get_mtimes(paths)
+        if mtimes != last_mtimes:
+            # Editors often write files in several steps; wait for the writes to settle
+            time.sleep(interval / 2)
+            last_mtimes = get_mtimes(paths)
+            reload_config(*paths)
+
+def start_config_watcher(interval=2):
+    watcher_thread = threading.Thread(target=watch_config, args=(interval,), name="config-watcher", daemon=True)
+    watcher_thread.start()
+    logger.info("Started configuration watcher thread.")
+    return watcher_thread
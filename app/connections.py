@@ -0,0 +1,96 @@
+# app/connections.py
+
+import threading
+from pymodbus.client import ModbusTcpClient
+from app.rtu_bus import RtuBusMaster
+from app.pipelined_tcp import PipelinedTcpClient, PIPELINE_RETRY
+from app import capture
+from app.logger import logger
+
+# Long-lived Modbus clients keyed by endpoint, reused across poll cycles
+clients = {}
+clients_lock = threading.Lock()
+# Serial bus options from settings.json "rtu" (timeout, retries, turnaround, parity, stopbits, bytesize)
+rtu_options = {}
+# Gateway options from settings.json "tcp"; pipeline_depth > 1 enables the pipelined transport
+tcp_options = {}
+# "host:port" of gateways known to need serial mode (restored on warm start), so they are not re-probed
+serial_gateways = set()
+max_registers = 125
+
+def configure(settings):
+    global rtu_options, tcp_options, max_registers
+    rtu_options = dict(settings.get("rtu", {}))
+    if settings.get("tcp", {}) != tcp_options:
+        # New gateway options get a fresh chance at pipelining
+        serial_gateways.clear()
+    tcp_options = dict(settings.get("tcp", {}))
+    max_registers = settings.get("max_registers", 100)
+
+def endpoint_for(device):
+    """
+    Returns the (protocol, address, port_or_baudrate) tuple identifying the connection a device uses.
+    Devices sharing an endpoint (e.g. several unit IDs behind one gateway) share one client.
+    """
+    protocol = device.get('protocol', 'TCP').strip().upper()
+    address = device['address']
+    if protocol == 'TCP':
+        return (protocol, address, int(device.get('port_baudRate') or 502))
+    if protocol == 'RTU':
+        return (protocol, address, int(device.get('port_baudRate') or 9600))
+    return (protocol, address, None)
+
+def create_client(endpoint):
+    protocol, address, param = endpoint
+    if protocol == 'TCP':
+        if tcp_options.get("pipeline_depth", 1) > 1:
+            return PipelinedTcpClient(
+                address,
+                param,
+                depth=tcp_options["pipeline_depth"],
+                timeout=tcp_options.get("timeout", 3),
+                pipelined=f"{address}:{param}" not in serial_gateways,
+                retry_after=tcp_options.get("pipeline_retry", PIPELINE_RETRY)
+            )
+        return ModbusTcpClient(address, port=param, timeout=tcp_options.get("timeout", 3))
+    if protocol == 'RTU':
+        return RtuBusMaster(
+            address,
+            param,
+            timeout=rtu_options.get("timeout"),
+            retries=rtu_options.get("retries", 1),
+            turnaround=rtu_options.get("turnaround", 0.1),
+            max_registers=max_registers,
+            parity=rtu_options.get("parity", 'N'),
+            stopbits=rtu_options.get("stopbits", 1),
+            bytesize=rtu_options.get("bytesize", 8)
+        )
+    return None
+
+def get_client(device):
+    endpoint = endpoint_for(device)
+    with clients_lock:
+        client = clients.get(endpoint)
+        if client is None:
+            # Recording wraps the real client; replay replaces it
+            client = capture.wrap_client(create_client(endpoint), endpoint)
+            if client is not None:
+                clients[endpoint] = client
+        return client
+
+def learned_serial_gateways():
+    """Gateways currently or previously found to need serial mode, less those pipelining again."""
+    with clients_lock:
+        modes = {client.gateway: client.pipelined for client in clients.values() if hasattr(client, "pipelined")}
+    return {gateway for gateway in serial_gateways if modes.get(gateway) is not True} | {gateway for gateway, pipelined in modes.items() if not pipelined}
+
+def close_clients(endpoints):
+    """Closes and forgets the clients for the given endpoints; they are recreated on next use."""
+    with clients_lock:
+        stale = [(endpoint, clients.pop(endpoint)) for endpoint in endpoints if endpoint in clients]
+    for endpoint, client in stale:
+        try:
+            client.close()
+            logger.info(f"Closed connection to {endpoint[0]} {endpoint[1]}")
+        except Exception as e:
+            logger.error(f"Error closing connection to {endpoint[1]}: {e}")
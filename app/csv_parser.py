@@ -1,4 +1,5 @@
 import csv
+from app.read_plan import BIT_FUNCTION_CODES
 
 def parse_register_map(path):
     with open(path, mode='r', encoding='utf-8-sig', newline='') as csvfile:
@@ -13,7 +14,8 @@ def parse_register_map(path):
                 "unit": row["unit"].strip(),
                 "gain": float(row["gain"]),
                 "address": int(row["address"]),
-                "quantity": int(row["quantity"])
+                "quantity": int(row["quantity"]),
+                "function_code": int(row.get("function_code") or 3)
             })
         return register_map
 
@@ -33,3 +35,50 @@ def parse_device_map(path):
                 "byte_swap": row.get("byte_swap", "none").strip()
             })
         return device_map
+
+VALID_PROTOCOLS = ("TCP", "RTU")
+VALID_FUNCTION_CODES = (1, 2, 3, 4)
+# Bits in one coil/discrete-input row; its value is stored as an unsigned integer of that width
+MAX_BIT_FIELD = 32
+
+def validate_config(settings, register_map, device_map):
+    """
+    Checks a parsed configuration for problems that would break polling.
+    Returns a list of error messages; an empty list means the configuration is usable.
+    """
+    errors = []
+    max_registers = settings.get("max_registers", 100)
+    if not isinstance(max_registers, int) or not 1 <= max_registers <= 125:
+        errors.append(f"max_registers must be an integer between 1 and 125, got {max_registers!r}")
+
+    device_types = set()
+    for reg in register_map:
+        device_types.add(reg["device_type_id"])
+        if reg["function_code"] not in VALID_FUNCTION_CODES:
+            errors.append(f"Register {reg['variable_name']} at {reg['address']} has unsupported function code {reg['function_code']}")
+        if reg["quantity"] < 1:
+            errors.append(f"Register {reg['variable_name']} at {reg['address']} has quantity {reg['quantity']}")
+        elif reg["function_code"] in BIT_FUNCTION_CODES:
+            if reg["quantity"] > MAX_BIT_FIELD:
+                errors.append(f"Bit field {reg['variable_name']} at {reg['address']} is wider than {MAX_BIT_FIELD} bits")
+        elif isinstance(max_registers, int) and reg["quantity"] > max_registers:
+            errors.append(f"Register {reg['variable_name']} at {reg['address']} is larger than max_registers")
+        if not 0 <= reg["address"] <= 65535:
+            errors.append(f"Register {reg['variable_name']} has invalid address {reg['address']}")
+
+    device_keys = set()
+    for device in device_map:
+        device_key = f"{device['device_id']}_{device['slave_id']}"
+        if device_key in device_keys:
+            errors.append(f"Duplicate device {device_key}")
+        device_keys.add(device_key)
+        if device["protocol"] not in VALID_PROTOCOLS:
+            errors.append(f"Device {device_key} has unsupported protocol {device['protocol']!r}")
+        if device["device_type_id"] not in device_types:
+            errors.append(f"Device {device_key} references unknown device_type_id {device['device_type_id']!r}")
+        if not 0 <= device["slave_id"] <= 247:
+            errors.append(f"Device {device_key} has invalid slave_id {device['slave_id']}")
+        if not device["port_baudRate"].isdigit():
+            errors.append(f"Device {device_key} has invalid port_baudRate {device['port_baudRate']!r}")
+
+    return errors
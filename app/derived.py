@@ -0,0 +1,409 @@
+# app/derived.py
+#
+# Derived metrics from data/derived_metrics.csv, compiled into a dependency graph and evaluated
+# incrementally after each poll cycle; see the README for the expression syntax.
+
+import ast
+import csv
+import math
+import re
+import threading
+from datetime import datetime
+from app import clock
+from app.logger import logger
+
+DERIVED_FILE = "data/derived_metrics.csv"
+SITE_KEY = "site"
+SITE_NAME = "Site"
+SCOPES = ("device", "site")
+REFERENCE = re.compile(r"\{([^{}]+)\}")
+# Identifiers the compiler generates (_ref, _in, _pow); expressions may not use them
+RESERVED_NAME = re.compile(r"(?<![\w.])_\w*")
+
+AGGREGATES = {
+    "sum": math.fsum,
+    "avg": lambda values: math.fsum(values) / len(values) if values else math.nan,
+    "min": lambda values: min(values, default=math.nan),
+    "max": lambda values: max(values, default=math.nan),
+    "count": len,
+}
+FUNCTIONS = {"abs": abs, "min": min, "max": max, "round": round}
+# Largest exponent ** accepts; expressions run in the poll loop, so powers are kept cheap
+MAX_EXPONENT = 64
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.USub, ast.UAdd,
+)
+
+def bounded_pow(base, exponent):
+    """`base ** exponent` in floating point; exponents beyond MAX_EXPONENT give NaN instead of stalling the poll loop."""
+    if abs(exponent) > MAX_EXPONENT:
+        raise ValueError(f"exponent {exponent} is larger than {MAX_EXPONENT}")
+    return float(base) ** float(exponent)
+
+class DerivedError(Exception):
+    pass
+
+def parse_derived(path):
+    with open(path, mode='r', encoding='utf-8-sig', newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        metrics = []
+        for row in reader:
+            metrics.append({
+                "variable_name": row["variable_name"].strip(),
+                "scope": row["scope"].strip().lower(),
+                "device_type_id": (row.get("device_type_id") or "").strip(),
+                "expression": row["expression"].strip(),
+                "unit": (row.get("unit") or "").strip(),
+                "replaces_inputs": (row.get("replaces_inputs") or "").strip().lower() in ("yes", "true", "1")
+            })
+        return metrics
+
+class CompiledMetric:
+    """
+    One derived metric. `inputs` are the positional arguments of `function`:
+    ("var", name) / ("delta", name) for device scope, ("agg", fn, type_id, name) / ("site", name) for site scope.
+    """
+
+    def __init__(self, definition):
+        self.name = definition["variable_name"]
+        self.scope = definition["scope"]
+        self.device_type_id = definition["device_type_id"]
+        self.unit = definition["unit"]
+        self.replaces_inputs = definition["replaces_inputs"]
+        self.inputs = []
+        if self.scope not in SCOPES:
+            raise DerivedError(f"unknown scope {self.scope!r}")
+        if self.scope == "device" and not self.device_type_id:
+            raise DerivedError("device-scope metrics need a device_type_id")
+
+        reserved = RESERVED_NAME.search(REFERENCE.sub(" ", definition["expression"]))
+        if reserved:
+            raise DerivedError(f"reserved name {reserved.group()!r}; variables are written as {{name}}")
+        references = []
+        def placeholder(match):
+            references.append(match.group(1).strip())
+            return f"_ref{len(references) - 1}"
+        source = REFERENCE.sub(placeholder, definition["expression"])
+        try:
+            tree = ast.parse(source, mode="eval")
+        except SyntaxError as e:
+            raise DerivedError(f"invalid expression: {e.msg}")
+
+        arguments = {}
+        def argument(spec):
+            if spec not in arguments:
+                arguments[spec] = f"_in{len(self.inputs)}"
+                self.inputs.append(spec)
+            return ast.Name(id=arguments[spec], ctx=ast.Load())
+
+        def reference_of(node):
+            if isinstance(node, ast.Name) and node.id.startswith("_ref"):
+                return references[int(node.id[4:])]
+            return None
+
+        metric = self
+        class Binder(ast.NodeTransformer):
+            def visit_Call(self, node):
+                name = node.func.id if isinstance(node.func, ast.Name) else None
+                reference = reference_of(node.args[0]) if len(node.args) == 1 and not node.keywords else None
+                if metric.scope == "site" and name in AGGREGATES and reference and ":" in reference:
+                    type_id, variable = (part.strip() for part in reference.split(":", 1))
+                    return argument(("agg", name, type_id, variable))
+                if metric.scope == "device" and name == "delta" and reference and ":" not in reference:
+                    return argument(("delta", reference))
+                if name not in FUNCTIONS or node.keywords:
+                    raise DerivedError(f"unsupported function {name!r}")
+                self.generic_visit(node)
+                return node
+
+            def visit_BinOp(self, node):
+                self.generic_visit(node)
+                if isinstance(node.op, ast.Pow):
+                    return ast.Call(func=ast.Name(id="_pow", ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+                return node
+
+            def visit_Name(self, node):
+                reference = reference_of(node)
+                if reference is None:
+                    if node.id not in FUNCTIONS:
+                        raise DerivedError(f"unknown name {node.id!r}; variables are written as {{name}}")
+                    return node
+                if ":" in reference:
+                    raise DerivedError(f"{{{reference}}} can only be used inside sum/avg/min/max/count")
+                return argument(("var" if metric.scope == "device" else "site", reference))
+
+        tree = ast.fix_missing_locations(Binder().visit(tree))
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise DerivedError(f"unsupported syntax {type(node).__name__}")
+        code = f"lambda {', '.join(arguments[spec] for spec in self.inputs)}: {ast.unparse(tree.body)}"
+        self.expression = eval(compile(code, f"<derived {self.name}>", "eval"), {"__builtins__": {}, "_pow": bounded_pow, **FUNCTIONS})
+
+    def function(self, *args):
+        for value in args:
+            if value != value:
+                return math.nan
+        try:
+            return float(self.expression(*args))
+        except (ArithmeticError, ValueError, TypeError):
+            return math.nan
+
+    def key(self):
+        return ("device", self.device_type_id, self.name) if self.scope == "device" else ("site", self.name)
+
+    def dependencies(self):
+        """Keys of the derived metrics this one reads, whether or not they exist."""
+        for spec in self.inputs:
+            if spec[0] in ("var", "delta"):
+                yield ("device", self.device_type_id, spec[1])
+            elif spec[0] == "agg":
+                yield ("device", spec[2], spec[3])
+            else:
+                yield ("site", spec[1])
+
+class DerivedEngine:
+    """
+    Evaluates compiled metrics against the live DeviceRecords.
+
+    Args:
+        definitions: Parsed rows of the derived metrics file.
+        register_map: Parsed register map, to check raw variable references.
+        device_map: Parsed device map.
+    """
+
+    def __init__(self, definitions, register_map, device_map):
+        self.lock = threading.Lock()
+        self.definitions = definitions
+        self.raw = raw = {(reg["device_type_id"], reg["variable_name"]) for reg in register_map}
+        self.order = self.compile(definitions, raw)
+        self.units = {metric.key(): metric.unit for metric in self.order}
+        self.derived_keys = set(self.units)
+        self.hidden = {}
+        for metric in self.order:
+            if metric.replaces_inputs:
+                for spec in metric.inputs:
+                    if spec[0] in ("var", "delta") and (metric.device_type_id, spec[1]) in raw:
+                        self.hidden.setdefault(metric.device_type_id, set()).add(spec[1])
+                    elif spec[0] == "agg" and (spec[2], spec[3]) in raw:
+                        self.hidden.setdefault(spec[2], set()).add(spec[3])
+        self.device_values = {}
+        self.device_times = {}
+        self.site_values = {}
+        self.site_time = None
+        self.previous = {}
+        self.seqs = {}
+        self.name_slots = {}
+        self.configure(device_map)
+
+    def configure(self, device_map):
+        with self.lock:
+            self.device_types = {f"{d['device_id']}_{d['slave_id']}": d["device_type_id"] for d in device_map}
+            self.devices_by_type = {}
+            for device_key, type_id in self.device_types.items():
+                self.devices_by_type.setdefault(type_id, []).append(device_key)
+            for device_key in list(self.device_values):
+                if device_key not in self.device_types:
+                    del self.device_values[device_key]
+                    self.device_times.pop(device_key, None)
+            # Force a full recomputation on the next update
+            self.seqs.clear()
+
+    @staticmethod
+    def compile(definitions, raw):
+        """Compiles the definitions and orders them by dependency; invalid metrics and their dependents are dropped."""
+        compiled = {}
+        for definition in definitions:
+            try:
+                metric = CompiledMetric(definition)
+            except DerivedError as e:
+                logger.error(f"Derived metric {definition['variable_name']!r} skipped: {e}")
+                continue
+            if metric.key() in compiled or (metric.scope == "device" and (metric.device_type_id, metric.name) in raw):
+                logger.error(f"Derived metric {metric.name!r} skipped: the name is already used")
+                continue
+            compiled[metric.key()] = metric
+
+        def resolvable(dependency):
+            return dependency in compiled or (dependency[0] == "device" and (dependency[1], dependency[2]) in raw)
+
+        # Kahn's algorithm over derived-to-derived edges; what is left over is unresolved or cyclic
+        order, ready = [], []
+        waiting = {}
+        for key, metric in compiled.items():
+            missing = [d for d in metric.dependencies() if not resolvable(d)]
+            if missing:
+                logger.error(f"Derived metric {metric.name!r} skipped: unknown inputs {[d[-1] for d in missing]}")
+                continue
+            waiting[key] = {d for d in metric.dependencies() if d in compiled and d != key}
+        while True:
+            ready = [key for key, deps in waiting.items() if not deps]
+            if not ready:
+                break
+            for key in ready:
+                order.append(compiled[key])
+                del waiting[key]
+            for deps in waiting.values():
+                deps.difference_update(ready)
+        for key in waiting:
+            logger.error(f"Derived metric {compiled[key].name!r} skipped: circular or skipped inputs")
+        return order
+
+    # ----------------------
+    # Evaluation
+    # ----------------------
+    def slot_of(self, layout, name):
+        slots = self.name_slots.get(id(layout))
+        if slots is None or slots[0] is not layout:
+            names = {}
+            for slot, variable in enumerate(layout.variable_names):
+                names.setdefault(variable, slot)
+            slots = self.name_slots[id(layout)] = (layout, names)
+        return slots[1].get(name)
+
+    def value(self, record, type_id, name):
+        """A device's raw or derived value, NaN if unavailable."""
+        if ("device", type_id, name) in self.derived_keys:
+            return self.device_values.get(record.device_key, {}).get(name, math.nan)
+        slot = self.slot_of(record.layout, name)
+        if slot is None or not record.valid[slot]:
+            return math.nan
+        return record.values[slot]
+
+    def column(self, metric, spec, device_keys, records):
+        if spec[0] == "var":
+            return [self.value(records[key], metric.device_type_id, spec[1]) for key in device_keys]
+        # delta: change of the input since this metric last saw the device
+        column = []
+        for key in device_keys:
+            current = self.value(records[key], metric.device_type_id, spec[1])
+            previous = self.previous.get((metric.name, key), math.nan)
+            if current == current:
+                self.previous[(metric.name, key)] = current
+            column.append(current - previous)
+        return column
+
+    def update(self, records):
+        """Recomputes the metrics affected by records that changed since the last call."""
+        with self.lock:
+            changed_devices = set()
+            for device_key, record in records.items():
+                if self.seqs.get(device_key) != record.seq:
+                    self.seqs[device_key] = record.seq
+                    changed_devices.add(device_key)
+            if not changed_devices:
+                return
+            # (type_id, name) / site name -> device keys whose value changed this round
+            changed = {}
+            changed_site = set()
+            for metric in self.order:
+                if metric.scope == "device":
+                    derived_inputs = [("device", metric.device_type_id, spec[1]) in self.derived_keys for spec in metric.inputs]
+                    dirty = [
+                        key for key in self.devices_by_type.get(metric.device_type_id, ())
+                        if key in records and (key in changed_devices or any(
+                            is_derived and key in changed.get((metric.device_type_id, spec[1]), ())
+                            for spec, is_derived in zip(metric.inputs, derived_inputs)))
+                    ]
+                    if not dirty:
+                        continue
+                    columns = [self.column(metric, spec, dirty, records) for spec in metric.inputs]
+                    results = list(map(metric.function, *columns)) if columns else [metric.function()] * len(dirty)
+                    updated = set()
+                    for key, result in zip(dirty, results):
+                        values = self.device_values.setdefault(key, {})
+                        if values.get(metric.name) != result:
+                            values[metric.name] = result
+                            updated.add(key)
+                        self.device_times[key] = records[key].timestamp()
+                    changed[(metric.device_type_id, metric.name)] = updated
+                else:
+                    if not any(self.input_changed(spec, changed_devices, changed, changed_site) for spec in metric.inputs) and metric.name in self.site_values:
+                        continue
+                    result = metric.function(*(self.site_input(spec, records) for spec in metric.inputs))
+                    if self.site_values.get(metric.name) != result:
+                        self.site_values[metric.name] = result
+                        changed_site.add(metric.name)
+            self.site_time = clock.now()
+
+    def input_changed(self, spec, changed_devices, changed, changed_site):
+        if spec[0] == "site":
+            return spec[1] in changed_site
+        _, _, type_id, name = spec
+        if ("device", type_id, name) in self.derived_keys:
+            return bool(changed.get((type_id, name)))
+        return any(key in changed_devices for key in self.devices_by_type.get(type_id, ()))
+
+    def site_input(self, spec, records):
+        if spec[0] == "site":
+            return self.site_values.get(spec[1], math.nan)
+        _, function, type_id, name = spec
+        values = [self.value(records[key], type_id, name) for key in self.devices_by_type.get(type_id, ()) if key in records]
+        return AGGREGATES[function]([value for value in values if value == value])
+
+    # ----------------------
+    # Output
+    # ----------------------
+    def add_entries(self, data, device_names):
+        """Appends derived values to a get_data() snapshot, plus the site metrics under SITE_KEY."""
+        with self.lock:
+            for device_key, values in self.device_values.items():
+                entries = data.get(device_key)
+                if entries is None:
+                    continue
+                type_id = self.device_types.get(device_key)
+                timestamp = self.device_times.get(device_key)
+                iso = datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+                for name, value in values.items():
+                    if value == value:
+                        entries.append(self.entry(iso, device_key, device_names.get(device_key, ""), name, value,
+                                                  self.units.get(("device", type_id, name), "")))
+            site = [
+                self.entry(datetime.fromtimestamp(self.site_time).isoformat(), SITE_KEY, SITE_NAME, name, value, self.units[("site", name)])
+                for name, value in self.site_values.items() if value == value
+            ]
+            if site:
+                data[SITE_KEY] = site
+
+    @staticmethod
+    def entry(iso, device_key, device_name, name, value, unit):
+        return {
+            "timestamp": iso,
+            "device_key": device_key,
+            "variable_name": name,
+            "address": None,
+            "value": value,
+            "unit": unit,
+            "device_name": device_name,
+            "derived": True
+        }
+
+    def hidden_inputs(self, device_key):
+        """Raw variables of a device replaced by derived metrics in MQTT payloads."""
+        return self.hidden.get(self.device_types.get(device_key), ())
+
+# ----------------------
+# Process-wide engine, from settings.json "derived"
+# ----------------------
+engine = None
+
+def configure(settings, register_map, device_map):
+    """(Re)compiles the metrics when the definitions or the register map change."""
+    global engine
+    options = settings.get("derived", {})
+    if not options.get("enabled", False):
+        engine = None
+        return
+    path = options.get("file", DERIVED_FILE)
+    try:
+        definitions = parse_derived(path)
+    except Exception as e:
+        logger.error(f"Failed to load derived metrics from {path}: {e}")
+        engine = None
+        return
+    raw = {(reg["device_type_id"], reg["variable_name"]) for reg in register_map}
+    if engine is not None and engine.definitions == definitions and engine.raw == raw:
+        engine.configure(device_map)
+        return
+    engine = DerivedEngine(definitions, register_map, device_map)
+    logger.info(f"Compiled {len(engine.order)} of {len(definitions)} derived metrics from {path}.")
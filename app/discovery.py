@@ -0,0 +1,352 @@
+# app/discovery.py
+#
+# Commissioning scanner: finds the units on each gateway and serial port, matches them to register-map
+# device types and narrows read blocks down to the registers each unit can actually read.
+#
+#   python -m app.discovery --tcp 127.0.0.1:5020 --output discovery/
+#   python -m app.discovery --rtu /dev/ttyUSB0:9600 --units 1-32 --ranges 3:40000-40199 --output discovery/
+
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pymodbus.client import ModbusTcpClient
+from app.csv_parser import parse_register_map, parse_device_map
+from app.connections import endpoint_for
+from app.read_plan import build_read_plan, group_registers_by_type, BIT_FUNCTION_CODES, MAX_BITS
+from app.rtu_bus import RtuBusMaster
+from app.logger import logger
+
+READ_FUNCTIONS = {1: "read_coils", 2: "read_discrete_inputs", 3: "read_holding_registers", 4: "read_input_registers"}
+# Gateway path unavailable / target failed to respond: the gateway answered, the unit did not
+GATEWAY_EXCEPTIONS = (0x0A, 0x0B)
+# Answered with an exception: the unit is there, the addresses are not readable
+EXCEPTION = "exception"
+DEVICE_MAP_FIELDS = ["device_id", "slave_id", "device_name", "device_type_id", "address", "port_baudRate", "protocol", "byte_swap"]
+REGISTER_MAP_FIELDS = ["device_type_id", "device_type", "variable_name", "access", "type", "unit", "gain", "address", "quantity", "function_code"]
+
+class Scanner:
+    """
+    Discovery over a set of endpoints.
+
+    Args:
+        register_map: Parsed register map; its device types are what units are matched against.
+        max_registers: Largest register read, as in settings.json.
+        timeout: Seconds to wait for each probe; a unit that answers nothing within it is absent.
+        ranges: [(function_code, start, end)] scanned on units that match no known type.
+        resolution: Unknown ranges are bisected down to spans of this many addresses.
+    """
+
+    def __init__(self, register_map, max_registers=100, timeout=0.5, ranges=(), resolution=8):
+        self.registers_by_type = group_registers_by_type(register_map)
+        self.max_registers = max_registers
+        self.timeout = timeout
+        self.ranges = list(ranges)
+        self.resolution = resolution
+        self.plans = {type_id: build_read_plan(regs, max_registers) for type_id, regs in self.registers_by_type.items()}
+        # One register per type, tried in turn to tell whether a unit is there at all
+        self.presence = [(block['function_code'], block['start'], 1) for plan in self.plans.values() for block in plan[:1]]
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    # ----------------------
+    # Probing
+    # ----------------------
+    def open_client(self, endpoint):
+        protocol, address, param = endpoint
+        if protocol == 'TCP':
+            client = ModbusTcpClient(address, port=param, timeout=self.timeout, retries=0)
+        else:
+            client = RtuBusMaster(address, param, timeout=self.timeout, retries=0)
+        return client if client.connect() else None
+
+    def probe(self, client, unit_id, function_code, address, count):
+        """One read: the response if it succeeded, EXCEPTION if the unit refused it, None if nothing answered."""
+        with self.lock:
+            self.requests += 1
+        try:
+            result = getattr(client, READ_FUNCTIONS[function_code])(address=address, count=count, slave=unit_id)
+        except Exception:
+            # Timeout or dropped connection
+            return None
+        if result is None:
+            return None
+        if result.isError():
+            return None if getattr(result, "exception_code", None) in GATEWAY_EXCEPTIONS else EXCEPTION
+        return result
+
+    def bisect(self, client, unit_id, registers, readable, spans):
+        """Reads the span of registers (one function code, sorted by address); halves it on failure."""
+        function_code = registers[0]['function_code']
+        start = registers[0]['address']
+        end = max(reg['address'] + reg['quantity'] for reg in registers)
+        response = self.probe(client, unit_id, function_code, start, end - start)
+        if response not in (None, EXCEPTION):
+            readable.extend(registers)
+            spans.append((function_code, start, end))
+        elif len(registers) > 1:
+            middle = len(registers) // 2
+            self.bisect(client, unit_id, registers[:middle], readable, spans)
+            self.bisect(client, unit_id, registers[middle:], readable, spans)
+
+    def bisect_range(self, client, unit_id, function_code, start, end, spans):
+        """Readable parts of [start, end) of an unknown device, down to `resolution` addresses."""
+        response = self.probe(client, unit_id, function_code, start, end - start)
+        if response not in (None, EXCEPTION):
+            spans.append((function_code, start, end))
+        elif end - start > self.resolution:
+            middle = (start + end) // 2
+            self.bisect_range(client, unit_id, function_code, start, middle, spans)
+            self.bisect_range(client, unit_id, function_code, middle, end, spans)
+
+    def scan_unit(self, client, endpoint, unit_id):
+        """Identifies one unit; returns None if it does not answer."""
+        if not any(self.probe(client, unit_id, *read) is not None for read in self.presence):
+            return None
+
+        # Score each known type by the share of its registers readable with its normal read plan;
+        # on a tie the type with more readable registers wins (its map covers the other's)
+        best, best_score = None, (0.0, 0)
+        for type_id, plan in self.plans.items():
+            ok = sum(len(block['registers']) for block in plan
+                     if self.probe(client, unit_id, block['function_code'], block['start'], block['count']) not in (None, EXCEPTION))
+            score = (ok / max(1, len(self.registers_by_type[type_id])), ok)
+            if score > best_score:
+                best, best_score = type_id, score
+
+        unit = {"endpoint": endpoint, "unit_id": unit_id, "device_type_id": best, "registers": [], "spans": []}
+        if best is not None:
+            for block in self.plans[best]:
+                registers = sorted(block['registers'], key=lambda reg: reg['address'])
+                self.bisect(client, unit_id, registers, unit["registers"], unit["spans"])
+        else:
+            for function_code, start, end in self.ranges:
+                limit = MAX_BITS if function_code in BIT_FUNCTION_CODES else self.max_registers
+                for chunk in range(start, end, limit):
+                    self.bisect_range(client, unit_id, function_code, chunk, min(chunk + limit, end), unit["spans"])
+        return unit
+
+    def scan_units(self, endpoint, unit_ids):
+        """Probes units one after another over one connection."""
+        client = self.open_client(endpoint)
+        if client is None:
+            logger.warning(f"Discovery: cannot connect to {endpoint[1]}:{endpoint[2]}")
+            return []
+        try:
+            return [unit for unit in (self.scan_unit(client, endpoint, unit_id) for unit_id in unit_ids) if unit]
+        finally:
+            client.close()
+
+    def scan(self, endpoints, unit_ids, per_gateway=4, workers=32):
+        """
+        Scans every endpoint: TCP gateways over `per_gateway` connections, each probing every
+        per_gateway-th unit; serial ports over their single bus. At most `workers` connections at once.
+
+        Returns:
+            list: Found units as {"endpoint", "unit_id", "device_type_id", "registers", "spans"}.
+        """
+        tasks = []
+        for endpoint in endpoints:
+            connections = per_gateway if endpoint[0] == 'TCP' else 1
+            tasks.extend((endpoint, unit_ids[i::connections]) for i in range(min(connections, len(unit_ids))))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda task: self.scan_units(*task), tasks)
+            units = [unit for found in results for unit in found]
+        return sorted(units, key=lambda unit: (unit["endpoint"], unit["unit_id"]))
+
+# ----------------------
+# Proposals
+# ----------------------
+def merge_intervals(spans):
+    """(function_code, start, end) spans as sorted, non-overlapping intervals per function code."""
+    merged = defaultdict(list)
+    for function_code, start, end in sorted(spans):
+        intervals = merged[function_code]
+        if intervals and start <= intervals[-1][1]:
+            intervals[-1][1] = max(intervals[-1][1], end)
+        else:
+            intervals.append([start, end])
+    return {fc: [tuple(interval) for interval in intervals] for fc, intervals in merged.items()}
+
+def intersect_intervals(a, b):
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+def plan_blocks(registers, intervals, max_registers):
+    """
+    Read plan for registers known to be readable: the usual greedy plan (build_read_plan), built
+    separately within each readable interval so no block spans addresses the devices refused.
+    """
+    plan = []
+    for function_code, fc_intervals in sorted(intervals.items()):
+        for start, end in fc_intervals:
+            inside = [reg for reg in registers if reg['function_code'] == function_code
+                      and start <= reg['address'] and reg['address'] + reg['quantity'] <= end]
+            plan.extend(build_read_plan(inside, max_registers))
+    return plan
+
+def propose(units, register_rows, register_map, device_map, max_registers):
+    """
+    Builds the proposed maps from the scan. A known type keeps the registers readable on every
+    unit found of that type; units of no known type sharing the same readable ranges become one
+    new type with one U16 (or BIT) row per address.
+
+    Returns:
+        tuple: (device rows, register rows, block plans by device_type_id)
+    """
+    rows_by_key = {(reg['device_type_id'], reg['function_code'], reg['address'], reg['variable_name']): row
+                   for reg, row in zip(register_map, register_rows)}
+    known = {(endpoint_for(d), d['slave_id']): d for d in device_map}
+    next_id = max((d['device_id'] for d in device_map), default=0) + 1
+
+    by_type = defaultdict(list)
+    new_types = {}
+    for unit in units:
+        if unit["device_type_id"] is None:
+            signature = tuple(sorted(unit["spans"]))
+            if not signature:
+                continue
+            unit["device_type_id"] = new_types.setdefault(signature, f"new-{len(new_types) + 1}")
+        by_type[unit["device_type_id"]].append(unit)
+
+    register_out, plans = [], {}
+    for type_id, type_units in sorted(by_type.items()):
+        if type_id in new_types.values():
+            intervals = merge_intervals(type_units[0]["spans"])
+            registers = [
+                {"device_type_id": type_id, "function_code": fc, "address": address, "quantity": 1,
+                 "variable_name": f"{'Bit' if fc in BIT_FUNCTION_CODES else 'Register'} {address}"}
+                for fc, fc_intervals in intervals.items() for start, end in fc_intervals for address in range(start, end)
+            ]
+            for reg in registers:
+                bit = reg['function_code'] in BIT_FUNCTION_CODES
+                register_out.append({
+                    "device_type_id": type_id, "device_type": "Unknown device", "variable_name": reg['variable_name'],
+                    "access": "RO", "type": "BIT" if bit else "U16", "unit": "N/A", "gain": 1,
+                    "address": reg['address'], "quantity": 1, "function_code": reg['function_code']
+                })
+        else:
+            keys = [{id(reg) for reg in unit["registers"]} for unit in type_units]
+            registers = [reg for reg in type_units[0]["registers"] if all(id(reg) in k for k in keys)]
+            registers.sort(key=lambda reg: (reg['function_code'], reg['address']))
+            intervals = merge_intervals(type_units[0]["spans"])
+            for unit in type_units[1:]:
+                other = merge_intervals(unit["spans"])
+                intervals = {fc: intersect_intervals(a, other.get(fc, [])) for fc, a in intervals.items()}
+            for reg in registers:
+                register_out.append(rows_by_key[(type_id, reg['function_code'], reg['address'], reg['variable_name'])])
+        plans[type_id] = plan_blocks(registers, intervals, max_registers)
+
+    device_out = []
+    for unit in sorted((u for units_of_type in by_type.values() for u in units_of_type), key=lambda u: (u["endpoint"], u["unit_id"])):
+        protocol, address, param = unit["endpoint"]
+        existing = known.get((unit["endpoint"], unit["unit_id"]))
+        if existing is None:
+            device_id, next_id = next_id, next_id + 1
+            name, byte_swap = f"{unit['device_type_id']}-{unit['unit_id']} at {address}", "none"
+        else:
+            device_id, name, byte_swap = existing['device_id'], existing['device_name'], existing['byte_swap']
+        device_out.append({
+            "device_id": device_id, "slave_id": unit["unit_id"], "device_name": name,
+            "device_type_id": unit["device_type_id"], "address": address, "port_baudRate": param,
+            "protocol": protocol, "byte_swap": byte_swap
+        })
+    return device_out, register_out, plans
+
+def write_proposal(output, devices, registers, plans):
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, "device_map.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=DEVICE_MAP_FIELDS)
+        writer.writeheader()
+        writer.writerows(devices)
+    with open(os.path.join(output, "register_map.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=REGISTER_MAP_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(registers)
+    with open(os.path.join(output, "block_plan.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            type_id: [{"function_code": block['function_code'], "start": block['start'], "count": block['count'],
+                       "registers": [reg['variable_name'] for reg in block['registers']]} for block in plan]
+            for type_id, plan in plans.items()
+        }, f, indent=2)
+
+# ----------------------
+# Command line
+# ----------------------
+def parse_endpoint(text, protocol):
+    address, _, param = text.rpartition(":")
+    return (protocol, address, int(param))
+
+def parse_units(text):
+    units = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        units.extend(range(int(first), int(last or first) + 1))
+    return units
+
+def parse_range(text):
+    """"fc:start-end" (end exclusive) as (function_code, start, end)."""
+    function_code, _, span = text.partition(":")
+    start, _, end = span.partition("-")
+    return (int(function_code), int(start), int(end))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discover Modbus units and propose device and register maps.")
+    parser.add_argument("--tcp", action="append", default=[], help="Gateway host:port (repeatable)")
+    parser.add_argument("--rtu", action="append", default=[], help="Serial port:baudrate (repeatable)")
+    parser.add_argument("--units", default="1-247", help="Unit IDs, e.g. 1-247 or 1-10,20")
+    parser.add_argument("--ranges", action="append", default=[], type=parse_range,
+                        help="fc:start-end scanned on units of no known type, e.g. 3:40000-40200 (repeatable)")
+    parser.add_argument("--resolution", type=int, default=8, help="Smallest address span bisected in --ranges")
+    parser.add_argument("--timeout", type=float, default=0.5)
+    parser.add_argument("--per-gateway", type=int, default=4, help="Concurrent connections per TCP gateway")
+    parser.add_argument("--workers", type=int, default=32, help="Concurrent connections overall")
+    parser.add_argument("--settings", default="settings.json")
+    parser.add_argument("--register-map", default="data/register_map.csv")
+    parser.add_argument("--device-map", default="data/device_map.csv")
+    parser.add_argument("--output", default="discovery")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logger.setLevel(args.log_level)
+    # Absent units time out by design; pymodbus would log every one of them
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+
+    with open(args.settings) as f:
+        max_registers = json.load(f).get("max_registers", 100)
+    with open(args.register_map, mode='r', encoding='utf-8-sig', newline='') as f:
+        register_rows = list(csv.DictReader(f))
+    register_map = parse_register_map(args.register_map)
+    device_map = parse_device_map(args.device_map) if os.path.exists(args.device_map) else []
+
+    endpoints = [parse_endpoint(text, 'TCP') for text in args.tcp] + [parse_endpoint(text, 'RTU') for text in args.rtu]
+    if not endpoints:
+        endpoints = sorted({endpoint_for(device) for device in device_map})
+
+    scanner = Scanner(register_map, max_registers, args.timeout, args.ranges, args.resolution)
+    start = time.perf_counter()
+    units = scanner.scan(endpoints, parse_units(args.units), args.per_gateway, args.workers)
+    elapsed = time.perf_counter() - start
+    devices, registers, plans = propose(units, register_rows, register_map, device_map, max_registers)
+    write_proposal(args.output, devices, registers, plans)
+
+    for unit in units:
+        protocol, address, param = unit["endpoint"]
+        print(f"{protocol} {address}:{param} unit {unit['unit_id']}: type {unit['device_type_id'] or '?'}, "
+              f"{len(unit['registers']) or sum(end - start for _, start, end in unit['spans'])} readable")
+    print(f"Scanned {len(endpoints)} endpoints in {elapsed:.1f}s with {scanner.requests} requests: "
+          f"{len(devices)} devices, {len(registers)} registers, "
+          f"{sum(len(plan) for plan in plans.values())} read blocks. Wrote {args.output}/")
@@ -1,18 +1,157 @@
+import hmac
 import os
-from flask import Flask, render_template, jsonify
+import time
+from functools import wraps
+from flask import Flask, render_template, jsonify, Response, request
+from app import modbus_reader
 from app.modbus_reader import get_data
+from app import startup
+from app import timeseries
+from app import alarms
+from app import writes
+from app.writes import write_queue, WriteError
+from app import tracing
+from app.governor import governor
+from app.metrics import render_metrics
 
 # Force Flask to use the correct templates directory
 TEMPLATE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'templates'))
 app = Flask(__name__, template_folder=TEMPLATE_DIR)
+# Seconds between dashboard refreshes when not shedding load
+DASHBOARD_REFRESH = 5
+
+def control_endpoint(view):
+    """
+    Guards endpoints that change the gateway or its devices, or load it (writes, tracing,
+    profiling). The caller must send the settings
+    "api": {"token"} as "Authorization: Bearer <token>" and/or connect from one of "api":
+    {"allowed_hosts"}; with neither configured these endpoints are closed.
+    """
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        options = modbus_reader.settings.get("api", {})
+        token = options.get("token") or ""
+        allowed_hosts = options.get("allowed_hosts") or []
+        if not token and not allowed_hosts:
+            return jsonify({"error": "Control endpoints are disabled; configure api.token or api.allowed_hosts in settings.json"}), 403
+        if allowed_hosts and request.remote_addr not in allowed_hosts:
+            return jsonify({"error": f"Host {request.remote_addr} is not allowed"}), 403
+        if token:
+            supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+            if not hmac.compare_digest(supplied.encode(), token.encode()):
+                return jsonify({"error": "Missing or invalid API token"}), 401
+        return view(*args, **kwargs)
+    return guarded
+
+def create_app(data_source=get_data):
+    """
+    Args:
+        data_source: Returns the live snapshot for /data. Server workers that do not poll can pass
+            shared_snapshot.SnapshotReader(path).as_device_data to serve the poller's shared snapshot.
+    """
+    @app.after_request
+    def record_first_response(response):
+        startup.mark("first_http_response")
+        return response
 
-def create_app():
     @app.route('/')
     def index():
         return render_template("index.html")
 
     @app.route('/data')
     def data():
-        return jsonify(get_data())
+        response = jsonify(data_source())
+        # The dashboard refreshes less often while the gateway sheds load
+        response.headers["X-Refresh-Interval"] = str(governor.dashboard_refresh(DASHBOARD_REFRESH))
+        return response
+
+    @app.route('/governor')
+    def governor_status():
+        return jsonify(governor.status())
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    @app.route('/alarms')
+    def active_alarms():
+        if alarms.engine is None:
+            return jsonify([])
+        return jsonify(alarms.engine.active())
+
+    @app.route('/write', methods=['POST'])
+    @control_endpoint
+    def write():
+        # {"writes": [{"device": "2_12", "variable": "...", "value": 50}, {"device_type_id": "2", "address": 40125, "value": 800}]}
+        # ?wait=<seconds> waits for the read-back confirmations
+        if not write_queue.enabled:
+            return jsonify({"error": "Register writes are disabled"}), 403
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            return jsonify({"error": "The request body must be a JSON object"}), 400
+        if not body.get("writes"):
+            return jsonify({"error": "No writes given"}), 400
+        try:
+            queued = write_queue.submit(body["writes"], source="http")
+        except WriteError as e:
+            return jsonify({"error": str(e)}), 400
+        timeout = min(request.args.get("wait", 0, type=float), 60)
+        finished = writes.wait(queued, timeout) if timeout > 0 else False
+        return jsonify({"writes": [r.result() for r in queued]}), 200 if finished else 202
+
+    @app.route('/write/<request_id>')
+    @control_endpoint
+    def write_status(request_id):
+        queued = write_queue.get(request_id)
+        if queued is None:
+            return jsonify({"error": f"Unknown write request {request_id}"}), 404
+        return jsonify(queued.result())
+
+    @app.route('/trace/start', methods=['POST'])
+    @control_endpoint
+    def trace_start():
+        max_events = request.args.get("max_events", tracing.DEFAULT_MAX_EVENTS, type=int)
+        tracing.start(min(max(max_events, 1), tracing.MAX_EVENTS_LIMIT))
+        return jsonify({"tracing": True})
+
+    @app.route('/trace/stop', methods=['POST'])
+    @control_endpoint
+    def trace_stop():
+        # Chrome trace-event JSON: open in chrome://tracing or https://ui.perfetto.dev
+        trace = tracing.stop()
+        tracing.write(f"logs/trace-{int(time.time())}.json")
+        return jsonify(trace)
+
+    @app.route('/profile', methods=['POST'])
+    @control_endpoint
+    def profile():
+        # Folded stacks for flamegraph.pl / speedscope; blocks for the sampling period
+        seconds = min(request.args.get("seconds", 10, type=float), tracing.MAX_PROFILE_SECONDS)
+        interval = max(request.args.get("interval", 0.005, type=float), 0.001)
+        try:
+            return Response(tracing.profile(seconds, interval), mimetype="text/plain")
+        except tracing.ProfilerBusy as e:
+            return jsonify({"error": str(e)}), 409
+
+    @app.route('/history')
+    def history():
+        # /history?device=1_1&address=40001&variable=Voltage&start=<epoch>&end=<epoch>[&resolution=1h]
+        if timeseries.store is None:
+            return jsonify({"error": "Time-series store is disabled"}), 404
+        end = request.args.get("end", time.time(), type=float)
+        start = request.args.get("start", end - 86400, type=float)
+        try:
+            result = timeseries.store.query(
+                request.args.get("device", ""),
+                request.args.get("address", type=int),
+                request.args.get("variable", ""),
+                start,
+                end,
+                resolution=request.args.get("resolution"),
+                max_points=request.args.get("max_points", 1000, type=int)
+            )
+        except KeyError as e:
+            return jsonify({"error": e.args[0]}), 404
+        return jsonify(result)
 
     return app
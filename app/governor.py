@@ -0,0 +1,212 @@
+# app/governor.py
+#
+# Load-shedding governor: steps through LEVEL_ACTIONS as cycle time, CPU, memory or spool depth
+# go over budget, and back down once they have headroom. Critical blocks are never stretched.
+
+import logging
+import threading
+import time
+from app import alarms
+from app import metrics
+from app.logger import logger
+
+MAX_LEVEL = 6
+LEVEL_ACTIONS = {
+    1: "sample_logs",
+    2: "slow_dashboard",
+    3: "pause_backlog",
+    4: "stretch_slow_blocks_x2",
+    5: "stretch_slow_blocks_x4",
+    6: "stretch_slow_blocks_x8",
+}
+# A growing spool alone sheds no further than the dashboard: pausing its replay would only grow it
+SPOOL_MAX_LEVEL = 2
+DEFAULTS = {
+    "enabled": False,
+    "max_cycle_load": 0.9,
+    "max_cpu": 0.85,
+    "max_memory": 0.9,
+    "max_spool_bytes": 50 * 1024 * 1024,
+    "headroom": 0.7,
+    "restore_cycles": 5,
+    "log_sample": 10,
+    "dashboard_slowdown": 4,
+    "critical": {}
+}
+
+def read_cpu_times():
+    """(busy, total) jiffies over all CPUs from /proc/stat, or None where it does not exist."""
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(value) for value in f.readline().split()[1:9]]
+    except (OSError, ValueError):
+        return None
+    idle = fields[3] + fields[4]
+    return sum(fields) - idle, sum(fields)
+
+def memory_used():
+    """Share of memory in use (MemAvailable against MemTotal), 0 where /proc/meminfo does not exist."""
+    try:
+        with open("/proc/meminfo") as f:
+            info = {line.split(":")[0]: int(line.split()[1]) for line in f}
+        return 1 - info["MemAvailable"] / info["MemTotal"]
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        return 0.0
+
+class LogSampler(logging.Filter):
+    """Passes warnings and errors, and 1 in `every` records below that."""
+
+    def __init__(self):
+        super().__init__()
+        self.every = 1
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.every <= 1:
+            return True
+        self.count += 1
+        return self.count % self.every == 0
+
+class Governor:
+    def __init__(self):
+        self.options = dict(DEFAULTS)
+        self.level = 0
+        self.cycle = 0
+        self.headroom_cycles = 0
+        self.loads = {}
+        self.reason = None
+        self.changed = time.time()
+        self.cpu_times = read_cpu_times()
+        # id(layout) -> (layout, block numbers that are read every cycle)
+        self.critical_blocks = {}
+        self.sampler = LogSampler()
+        logger.addFilter(self.sampler)
+        self.lock = threading.Lock()
+
+    def configure(self, settings):
+        self.options = dict(DEFAULTS, **settings.get("governor", {}))
+        self.critical_blocks = {}
+        if not self.options["enabled"] and self.level:
+            self.set_level(0, "disabled")
+
+    # ----------------------
+    # Control loop
+    # ----------------------
+    def sample(self, duration, interval):
+        """Each signal as a share of its budget; above 1 is over budget."""
+        options = self.options
+        loads = {
+            "cycle": duration / interval / options["max_cycle_load"] if interval > 0 else 0.0,
+            "memory": memory_used() / options["max_memory"],
+            "spool": (metrics.SPOOL_BYTES.get() + metrics.SQL_QUEUE_BYTES.get()) / options["max_spool_bytes"]
+        }
+        cpu_times = read_cpu_times()
+        if cpu_times and self.cpu_times and cpu_times[1] > self.cpu_times[1]:
+            busy = (cpu_times[0] - self.cpu_times[0]) / (cpu_times[1] - self.cpu_times[1])
+            loads["cpu"] = busy / options["max_cpu"]
+        self.cpu_times = cpu_times
+        return loads
+
+    def observe(self, duration, interval):
+        """Called after every poll cycle with its duration; moves at most one level."""
+        with self.lock:
+            self.cycle += 1
+            if not self.options["enabled"]:
+                return
+            self.loads = self.sample(duration, interval)
+            over = sorted(name for name, load in self.loads.items() if load > 1)
+            # Levels above SPOOL_MAX_LEVEL pause the backlog replay, which is what drains the
+            # spool, so there the spool counts neither for going up nor against stepping down
+            loads = self.loads
+            if self.level > SPOOL_MAX_LEVEL:
+                over = [name for name in over if name != "spool"]
+                loads = {name: load for name, load in loads.items() if name != "spool"}
+            if over:
+                self.headroom_cycles = 0
+                limit = SPOOL_MAX_LEVEL if over == ["spool"] else MAX_LEVEL
+                if self.level < limit:
+                    self.set_level(self.level + 1, f"over budget: {', '.join(over)}")
+            elif max(loads.values()) < self.options["headroom"]:
+                self.headroom_cycles += 1
+                if self.level and self.headroom_cycles >= self.options["restore_cycles"]:
+                    self.headroom_cycles = 0
+                    self.set_level(self.level - 1, "headroom restored")
+            else:
+                self.headroom_cycles = 0
+
+    def set_level(self, level, reason):
+        direction = "up" if level > self.level else "down"
+        self.level = level
+        self.reason = reason
+        self.changed = time.time()
+        self.sampler.every = self.options["log_sample"] if level >= 1 else 1
+        metrics.GOVERNOR_LEVEL.set(level)
+        metrics.GOVERNOR_CHANGES.inc(direction=direction)
+        loads = ", ".join(f"{name} {load:.2f}" for name, load in sorted(self.loads.items()))
+        logger.warning(f"Load shedding level {level} ({LEVEL_ACTIONS.get(level, 'nothing shed')}): {reason} [{loads}]")
+
+    def follow(self, level, cycle):
+        """Takes the main process's level and cycle count (sharded poll workers)."""
+        self.cycle = cycle
+        if level != self.level:
+            self.level = level
+            self.sampler.every = self.options["log_sample"] if level >= 1 else 1
+
+    # ----------------------
+    # Shedding decisions
+    # ----------------------
+    def stretch(self):
+        return 2 ** (self.level - 3) if self.level >= 4 else 1
+
+    def critical_variables(self, device_type_id):
+        names = set(self.options["critical"].get(device_type_id, ()))
+        engine = alarms.engine
+        if engine is not None:
+            names.update(rule["variable_name"] for rule in engine.rules_by_type.get(device_type_id, ()) if rule["variable_name"] != "*")
+        return names
+
+    def block_due(self, device_type_id, layout, block_number):
+        """Whether a read block is polled this cycle: critical blocks always, the others every stretch() cycles."""
+        stretch = self.stretch()
+        if stretch == 1:
+            return True
+        cached = self.critical_blocks.get(id(layout))
+        if cached is None or cached[0] is not layout:
+            names = self.critical_variables(device_type_id)
+            blocks = frozenset(
+                n for n, block in enumerate(layout.plan) if any(reg['variable_name'] in names for reg in block['registers'])
+            )
+            cached = self.critical_blocks[id(layout)] = (layout, blocks)
+        if block_number in cached[1]:
+            return True
+        # Offset by block number so the stretched blocks are spread over the cycles
+        if (self.cycle + block_number) % stretch == 0:
+            return True
+        metrics.SHED_BLOCKS.inc()
+        return False
+
+    def backlog_paused(self):
+        return self.level >= 3
+
+    def dashboard_refresh(self, seconds):
+        return seconds * self.options["dashboard_slowdown"] if self.level >= 2 else seconds
+
+    def worker_options(self):
+        """The "governor" settings for poll worker processes, which have no alarm engine: alarm-watched variables listed as critical."""
+        type_ids = set(self.options["critical"])
+        if alarms.engine is not None:
+            type_ids.update(alarms.engine.rules_by_type)
+        return dict(self.options, critical={type_id: sorted(self.critical_variables(type_id)) for type_id in type_ids})
+
+    def status(self):
+        return {
+            "enabled": self.options["enabled"],
+            "level": self.level,
+            "shedding": [LEVEL_ACTIONS[level] for level in range(1, self.level + 1)],
+            "reason": self.reason,
+            "since": self.changed,
+            "loads": {name: round(load, 3) for name, load in self.loads.items()},
+            "cycle": self.cycle
+        }
+
+governor = Governor()
@@ -0,0 +1,177 @@
+# app/live_records.py
+#
+# Live values: one DeviceRecord per device with compact value/validity arrays; register metadata is
+# shared per device type in a TypeLayout.
+
+import base64
+import math
+from array import array
+from datetime import datetime
+from app import clock
+from app.read_plan import flat_registers, BIT_FUNCTION_CODES
+
+class TypeLayout:
+    """
+    Static register metadata for one device type, in read-plan order (read_plan.flat_registers),
+    which is also the slot order of the shared snapshot and the time-series store.
+    """
+
+    __slots__ = ("plan", "variable_names", "addresses", "units", "block_slots", "slot_index", "bit_blocks")
+
+    def __init__(self, plan):
+        registers = flat_registers(plan)
+        self.plan = plan
+        self.variable_names = tuple(reg['variable_name'] for reg in registers)
+        self.addresses = tuple(int(reg['address']) for reg in registers)
+        self.units = tuple(reg.get('unit', "") for reg in registers)
+        # First slot of each block, plus the end
+        self.block_slots = [0]
+        for block in plan:
+            self.block_slots.append(self.block_slots[-1] + len(block['registers']))
+        self.slot_index = {(address, name): i for i, (address, name) in enumerate(zip(self.addresses, self.variable_names))}
+        # Block numbers of the FC1/FC2 blocks, in plan order
+        self.bit_blocks = tuple(n for n, block in enumerate(plan) if block['function_code'] in BIT_FUNCTION_CODES)
+
+    def __len__(self):
+        return len(self.variable_names)
+
+# Layout of device types without registers
+EMPTY_LAYOUT = TypeLayout([])
+
+def build_layouts(read_plans, layouts=None):
+    """TypeLayouts for the given read plans, reusing those from `layouts` whose plan is unchanged."""
+    layouts = layouts or {}
+    return {
+        type_id: layouts[type_id] if type_id in layouts and layouts[type_id].plan is plan else TypeLayout(plan)
+        for type_id, plan in read_plans.items()
+    }
+
+class DeviceRecord:
+    """
+    Latest values of one device. Written in place by its poller; `seq` increases with every poll
+    so consumers can tell whether anything changed. `failures` counts consecutive polls that read
+    nothing; `stale` is set while the values are the last-known ones restored after a restart.
+    `bits` holds the packed bitset of each of the layout's bit blocks, in bit_blocks order.
+    """
+
+    __slots__ = ("device_key", "device_name", "layout", "values", "valid", "block_times", "seq", "failures", "stale", "bits")
+
+    def __init__(self, device_key, device_name, layout):
+        self.device_key = device_key
+        self.device_name = device_name
+        self.layout = layout
+        self.values = array("d", bytes(8 * len(layout)))
+        self.valid = bytearray(len(layout))
+        self.block_times = array("d", bytes(8 * (len(layout.block_slots) - 1)))
+        self.seq = 0
+        self.failures = 0
+        self.stale = False
+        self.bits = [b""] * len(layout.bit_blocks)
+
+    def begin_poll(self, skipped=()):
+        """
+        Marks every value stale; blocks that read successfully mark theirs valid again. Blocks in
+        `skipped` are not read this poll (load shedding) and keep their last values.
+        """
+        block_slots = self.layout.block_slots
+        kept = [(block_slots[n], self.valid[block_slots[n]:block_slots[n + 1]]) for n in skipped]
+        self.valid[:] = bytes(len(self.valid))
+        for start, valid in kept:
+            self.valid[start:start + len(valid)] = valid
+        self.seq += 1
+        self.stale = False
+
+    def end_poll(self):
+        self.failures = 0 if 1 in self.valid else self.failures + 1
+
+    def set_block_time(self, block_number, timestamp=None):
+        self.block_times[block_number] = timestamp or clock.now()
+
+    def set(self, slot, value):
+        self.values[slot] = value
+        self.valid[slot] = 1
+
+    def set_bits(self, block_number, packed):
+        self.bits[self.layout.bit_blocks.index(block_number)] = packed
+
+    def bitmask(self, block_number):
+        """
+        A bit block as one compact payload item: {"function_code", "start", "count", "bits"}, bits
+        being the packed bitset in base64 (bit i of the block is bit i % 8 of byte i // 8).
+        """
+        block = self.layout.plan[block_number]
+        return {
+            "function_code": block['function_code'],
+            "start": block['start'],
+            "count": block['count'],
+            "bits": base64.b64encode(self.bits[self.layout.bit_blocks.index(block_number)]).decode("ascii")
+        }
+
+    def count(self):
+        return self.valid.count(1)
+
+    def slot_values(self):
+        """Values in slot order with NaN for registers not read in the last poll."""
+        return [value if valid else math.nan for value, valid in zip(self.values, self.valid)]
+
+    def timestamp(self):
+        """Time of the newest block read, or None if nothing has been read yet."""
+        newest = max(self.block_times, default=0.0)
+        return newest or None
+
+    def bitmasks(self):
+        """bitmask() of every bit block read in the last poll, which payloads send instead of the individual bits."""
+        layout = self.layout
+        return [
+            self.bitmask(block_number) for block_number in layout.bit_blocks
+            if 1 in self.valid[layout.block_slots[block_number]:layout.block_slots[block_number + 1]]
+        ]
+
+    def entries(self):
+        """
+        The record as the dashboard/MQTT dicts, one per register read in the last poll. Entries of
+        coils and discrete inputs are flagged "bit".
+        """
+        layout = self.layout
+        entries = []
+        for block_number, start in enumerate(layout.block_slots[:-1]):
+            end = layout.block_slots[block_number + 1]
+            bit = block_number in layout.bit_blocks
+            iso = None
+            for slot in range(start, end):
+                if not self.valid[slot]:
+                    continue
+                if iso is None:
+                    iso = datetime.fromtimestamp(self.block_times[block_number]).isoformat()
+                entry = {
+                    "timestamp": iso,
+                    "device_key": self.device_key,
+                    "variable_name": layout.variable_names[slot],
+                    "address": layout.addresses[slot],
+                    "value": self.values[slot],
+                    "unit": layout.units[slot],
+                    "device_name": self.device_name
+                }
+                if bit:
+                    entry["bit"] = True
+                if self.stale:
+                    entry["stale"] = True
+                entries.append(entry)
+        return entries
+
+    def state(self):
+        """Compact, picklable copy of the mutable part, for shipping between processes and warm restarts."""
+        return (self.seq, self.values, bytes(self.valid), self.block_times, self.failures, tuple(self.bits))
+
+    def load_state(self, state, stale=False):
+        seq, values, valid, block_times, failures, bits = state
+        if len(values) != len(self.values) or len(block_times) != len(self.block_times) or len(bits) != len(self.bits):
+            return False
+        self.seq = seq
+        self.values[:] = values
+        self.valid[:] = valid
+        self.block_times[:] = block_times
+        self.failures = failures
+        self.bits[:] = bits
+        self.stale = stale
+        return True
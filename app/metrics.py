@@ -0,0 +1,186 @@
+# app/metrics.py
+#
+# Minimal Prometheus-style metrics: counters, gauges and histograms with optional labels,
+# rendered in the Prometheus text exposition format for the /metrics endpoint.
+
+import bisect
+import threading
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        if not self.label_names and self.metric_type in ("counter", "gauge"):
+            # Unlabelled series are exported as 0 from the start
+            self.values[()] = 0
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            items = list(self.values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            items = [(k, (list(counts), total, count)) for k, (counts, total, count) in self.values.items()]
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, label_values, ("le", format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in list(REGISTRY):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ----------------------
+# Polling (modbus_reader)
+# ----------------------
+POLL_DURATION = Histogram("modbus_poll_duration_seconds", "Time to poll all blocks of one device", ("device",))
+POLL_REQUESTS = Counter("modbus_requests_total", "Modbus read requests issued")
+POLL_REGISTERS = Counter("modbus_registers_total", "Registers decoded successfully")
+CYCLE_REQUESTS = Gauge("modbus_cycle_requests", "Read requests issued in the last poll cycle")
+CYCLE_REGISTERS = Gauge("modbus_cycle_registers", "Registers decoded in the last poll cycle")
+CONNECT_FAILURES = Counter("modbus_connect_failures_total", "Failed connection attempts", ("device",))
+FAILED_BLOCKS = Counter("modbus_failed_blocks_total", "Read blocks that failed or returned an exception", ("device",))
+DECODE_ERRORS = Counter("modbus_decode_errors_total", "Registers that could not be decoded", ("device",))
+CYCLE_DURATION = Histogram("modbus_cycle_duration_seconds", "Duration of a full poll cycle",
+                           buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+CYCLE_OVERRUNS = Counter("modbus_cycle_overruns_total", "Poll cycles that took longer than the poll interval")
+DEVICES_CONFIGURED = Gauge("modbus_devices", "Devices in the active device map")
+TCP_IN_FLIGHT = Gauge("modbus_tcp_in_flight", "Requests awaiting a response on a pipelined gateway", ("gateway",))
+PIPELINE_FALLBACKS = Counter("modbus_tcp_pipeline_fallbacks_total", "Gateways switched to serial mode", ("gateway",))
+
+# ----------------------
+# Publishing (mqtt_manager)
+# ----------------------
+PUBLISH_DURATION = Histogram("mqtt_publish_duration_seconds", "Time from publish to broker acknowledgement")
+PUBLISHES_IN_FLIGHT = Gauge("mqtt_publishes_in_flight", "Publishes awaiting acknowledgement")
+PUBLISHES = Counter("mqtt_publishes_total", "Payloads published, by outcome", ("result",))
+PUBLISHED_BYTES = Counter("mqtt_published_bytes_total", "Payload bytes acknowledged by the broker")
+
+# ----------------------
+# Spool (cache_manager)
+# ----------------------
+SPOOL_PAYLOADS = Gauge("cache_spool_payloads", "Payloads waiting in the local MQTT spool")
+SPOOL_BYTES = Gauge("cache_spool_bytes", "Size of the local MQTT spool file in bytes")
+
+# ----------------------
+# SQL sink (cloud_uploader)
+# ----------------------
+SQL_ROWS_INSERTED = Counter("sql_rows_inserted_total", "Rows committed to the SQL sink")
+SQL_BATCH_DURATION = Histogram("sql_batch_duration_seconds", "Time to insert and commit one batch")
+SQL_QUEUE_BYTES = Gauge("sql_queue_bytes", "Bytes waiting in the SQL sink queue")
+SQL_RECONNECTS = Counter("sql_reconnects_total", "SQL connections (re)opened")
+
+# ----------------------
+# Edge alarms (alarms)
+# ----------------------
+ALARM_EVENTS = Counter("alarm_events_total", "Alarm state changes", ("state", "severity"))
+ALARMS_ACTIVE = Gauge("alarms_active", "Alarms currently raised")
+ALARM_PUBLISH_DELAY = Histogram("alarm_publish_delay_seconds", "Time from an alarm state change to its broker acknowledgement")
+
+# ----------------------
+# Register writes (writes)
+# ----------------------
+WRITES = Counter("modbus_writes_total", "Register write requests by outcome", ("result",))
+WRITE_TRANSACTIONS = Counter("modbus_write_transactions_total", "FC6/FC16 write transactions issued", ("function_code",))
+WRITE_LATENCY = Histogram("modbus_write_latency_seconds", "Time from a write request to its read-back confirmation")
+
+# ----------------------
+# Load shedding (governor)
+# ----------------------
+GOVERNOR_LEVEL = Gauge("governor_level", "Current load-shedding level (0 = nothing shed)")
+GOVERNOR_CHANGES = Counter("governor_level_changes_total", "Load-shedding level changes", ("direction",))
+SHED_BLOCKS = Counter("governor_shed_blocks_total", "Non-critical read blocks skipped by load shedding")
@@ -2,152 +2,411 @@ import csv
 import json
 import threading
 import time
-from pymodbus.client import ModbusTcpClient, ModbusSerialClient
+from contextlib import nullcontext
 from app.csv_parser import parse_register_map, parse_device_map
-from app.utils import apply_byte_order
-from datetime import datetime
+from app.read_plan import compile_read_plans, group_registers_by_type, BIT_FUNCTION_CODES
+from app.live_records import DeviceRecord, EMPTY_LAYOUT, build_layouts
+from app import connections
+from app.connections import endpoint_for, get_client, close_clients
+from app.utils import apply_byte_order, pack_bits
 import os
 from collections import defaultdict
 from app.logger import logger
+from app import startup
+from app import metrics
+from app import shared_snapshot
+from app import timeseries
+from app import capture
+from app import alarms
+from app import derived
+from app.governor import governor
+from app.writes import write_queue
+from app import tracing
+from app.tracing import span
 
-# Load configuration
-with open("settings.json") as f:
-    settings = json.load(f)
+SETTINGS_FILE = "settings.json"
+REGISTER_MAP_FILE = "data/register_map.csv"
+DEVICE_MAP_FILE = "data/device_map.csv"
 
-register_map = parse_register_map("data/register_map.csv")
-device_map = parse_device_map("data/device_map.csv")
+# Configuration is loaded explicitly via load_config()/configure() so importing this module has no side effects
+settings = {}
+register_map = []
+device_map = []
+max_registers = 100
+# Compiled read blocks per device_type_id, rebuilt only when that type's registers change
+read_plans = {}
+# Register metadata per device_type_id, shared by every DeviceRecord of that type
+type_layouts = {}
 
-max_registers = settings.get("max_registers", 100)
+# Configuration staged by the config watcher, swapped in between poll cycles
+pending_config = None
+config_lock = threading.Lock()
 
 data_lock = threading.Lock()
-device_data = defaultdict(list)
+# Live values: device_key -> DeviceRecord, updated in place by the pollers
+device_data = {}
 polling_locks = defaultdict(threading.Lock)
 
+def load_config(settings_path=SETTINGS_FILE, register_map_path=REGISTER_MAP_FILE, device_map_path=DEVICE_MAP_FILE):
+    with open(settings_path) as f:
+        new_settings = json.load(f)
+    configure(new_settings, parse_register_map(register_map_path), parse_device_map(device_map_path))
+    return new_settings
+
+def sync_records():
+    """Creates records for new devices and for devices whose type layout or name changed; drops removed ones."""
+    global type_layouts
+    type_layouts = build_layouts(read_plans, type_layouts)
+    with data_lock:
+        records = {}
+        for device in device_map:
+            device_key = f"{device['device_id']}_{device['slave_id']}"
+            layout = type_layouts.get(device['device_type_id'], EMPTY_LAYOUT)
+            record = device_data.get(device_key)
+            if record is None or record.layout is not layout or record.device_name != device['device_name']:
+                record = DeviceRecord(device_key, device['device_name'], layout)
+            records[device_key] = record
+        device_data.clear()
+        device_data.update(records)
+
+def configure(new_settings, new_register_map, new_device_map, compiled_plans=None):
+    """Applies a configuration; compiled_plans, if given, are read plans already compiled for this register map."""
+    global settings, register_map, device_map, max_registers, read_plans
+    settings = new_settings
+    register_map = new_register_map
+    device_map = new_device_map
+    max_registers = settings.get("max_registers", 100)
+    # Open clients may wrap a closed recorder or predate a replay; they are recreated on first use
+    close_clients(list(connections.clients))
+    connections.configure(settings)
+    capture.configure(settings, register_map, device_map)
+    write_queue.configure(register_map, device_map, settings)
+    read_plans = compiled_plans if compiled_plans is not None else compile_read_plans(register_map, max_registers)
+    sync_records()
+    shared_snapshot.configure(settings, device_map, read_plans)
+    timeseries.configure(settings, device_map, read_plans)
+    alarms.configure(settings, register_map, device_map)
+    derived.configure(settings, register_map, device_map)
+    governor.configure(settings)
+    metrics.DEVICES_CONFIGURED.set(len(device_map))
+    logger.info(f"Loaded {len(device_map)} devices and {len(register_map)} registers.")
+
+def stage_config(new_settings, new_register_map, new_device_map):
+    """Queues a validated configuration to be applied at the start of the next poll cycle."""
+    global pending_config
+    with config_lock:
+        pending_config = (new_settings, new_register_map, new_device_map)
+
+def apply_pending_config():
+    """
+    Swaps in a staged configuration, rebuilding only the read plans and connections it affects.
+    Must only be called between poll cycles, while no poll_device threads are running.
+    """
+    global settings, register_map, device_map, max_registers, read_plans, pending_config
+    with config_lock:
+        staged, pending_config = pending_config, None
+    if staged is None:
+        return
+
+    new_settings, new_register_map, new_device_map = staged
+    new_max_registers = new_settings.get("max_registers", 100)
+
+    # Device types whose register set changed (or all of them if the block size limit changed)
+    old_regs = group_registers_by_type(register_map)
+    new_regs = group_registers_by_type(new_register_map)
+    if new_max_registers != max_registers:
+        changed_types = set(new_regs)
+    else:
+        changed_types = {t for t in new_regs if old_regs.get(t) != new_regs[t]}
+    new_plans = {t: plan for t, plan in read_plans.items() if t in new_regs and t not in changed_types}
+    new_plans.update(compile_read_plans(new_register_map, new_max_registers, changed_types))
+
+    old_devices = {f"{d['device_id']}_{d['slave_id']}": d for d in device_map}
+    new_devices = {f"{d['device_id']}_{d['slave_id']}": d for d in new_device_map}
+    added = new_devices.keys() - old_devices.keys()
+    removed = old_devices.keys() - new_devices.keys()
+    changed = {k for k in new_devices.keys() & old_devices.keys() if new_devices[k] != old_devices[k]}
+
+    # Connections no longer used by any device are closed; new ones are opened lazily on first poll
+    stale_endpoints = {endpoint_for(d) for d in old_devices.values()} - {endpoint_for(d) for d in new_devices.values()}
+    if new_settings.get("rtu", {}) != settings.get("rtu", {}) or new_max_registers != max_registers:
+        # Serial timing depends on these settings; reopen every bus with the new values
+        stale_endpoints |= {endpoint for endpoint in connections.clients if endpoint[0] == 'RTU'}
+    if new_settings.get("tcp", {}) != settings.get("tcp", {}):
+        stale_endpoints |= {endpoint for endpoint in connections.clients if endpoint[0] == 'TCP'}
+    if new_settings.get("capture", {}) != settings.get("capture", {}):
+        # Clients are wrapped for recording or replaced for replay when created
+        stale_endpoints |= set(connections.clients)
+    close_clients(stale_endpoints)
+    connections.configure(new_settings)
+    capture.configure(new_settings, new_register_map, new_device_map)
+    write_queue.configure(new_register_map, new_device_map, new_settings)
+
+    for device_key in removed:
+        for metric in (metrics.POLL_DURATION, metrics.CONNECT_FAILURES, metrics.FAILED_BLOCKS, metrics.DECODE_ERRORS):
+            metric.remove(device=device_key)
+    metrics.DEVICES_CONFIGURED.set(len(new_device_map))
+
+    settings = new_settings
+    register_map = new_register_map
+    device_map = new_device_map
+    max_registers = new_max_registers
+    read_plans = new_plans
+    sync_records()
+    shared_snapshot.configure(settings, device_map, read_plans)
+    timeseries.configure(settings, device_map, read_plans)
+    alarms.configure(settings, register_map, device_map)
+    derived.configure(settings, register_map, device_map)
+    governor.configure(settings)
+    logger.info(
+        f"Applied new configuration: {len(added)} devices added, {len(removed)} removed, {len(changed)} changed; "
+        f"rebuilt read plans for {len(changed_types)} device types; closed {len(stale_endpoints)} connections."
+    )
+
+def get_poll_interval():
+    # settings.json historically used "polling_interval"; accept both keys
+    return settings.get("poll_interval", settings.get("polling_interval", 5))
+
 def poll_device(device):
+    start = time.perf_counter()
+    device_key = f"{device['device_id']}_{device['slave_id']}"
+    try:
+        with span("poll_device", device=device_key):
+            read_device(device)
+            # Alarms see each device as soon as it is polled, not at the end of the cycle
+            if alarms.engine:
+                with span("alarms"):
+                    alarms.engine.evaluate(device_data.get(device_key))
+    finally:
+        metrics.POLL_DURATION.observe(time.perf_counter() - start, device=device_key)
+
+def read_device(device):
     protocol = device.get('protocol', 'TCP').strip().upper()
     swap_bytes = device.get('byte_swap', 'none')
     unit_id = int(device['slave_id'])
     device_key = f"{device['device_id']}_{unit_id}"
+    address = device['address']
 
-    if protocol == 'TCP':
-        address = device['address']
-        port = int(device.get('port_baudRate', 502))
-        client = ModbusTcpClient(address, port=port)
-    elif protocol == 'RTU':
-        address = device['address']
-        baudrate = int(device.get('port_baudRate', 9600))
-        client = ModbusSerialClient(
-            port=address,
-            baudrate=baudrate,
-            timeout=3,
-            parity='N',
-            stopbits=1,
-            bytesize=8
-        )
-    else:
+    client = get_client(device)
+    if client is None:
         logger.error(f"Unsupported protocol '{protocol}' for device ID: {device['device_id']}")
+        write_queue.fail(device_key, f"Unsupported protocol '{protocol}'")
+        return
+    record = device_data.get(device_key)
+    if record is None:
+        write_queue.fail(device_key, "Device is not configured in this poller")
         return
 
-    with polling_locks[address]:
-        if not client.connect():
+    # One lock per connection: devices behind the same gateway/serial port share a client.
+    # A pipelined gateway interleaves its devices' requests on one socket and limits them itself.
+    lock = nullcontext() if getattr(client, "concurrent", False) else polling_locks[endpoint_for(device)]
+    with tracing.acquire(lock, endpoint=f"{address}:{device.get('port_baudRate', '')}"):
+        with span("connect"):
+            connected = client.connect()
+        if not connected:
             logger.warning(f"Unable to connect to Address: {address}, ID: {unit_id}")
+            metrics.CONNECT_FAILURES.inc(device=device_key)
+            record.failures += 1
+            write_queue.fail(device_key, "Unable to connect to the device")
             return
 
         logger.info(f"Connected to device at Address: {address}, ID: {unit_id}")
-        with data_lock:
-            device_data[device_key] = []
-
-        regs = [r for r in register_map if r['device_type_id'] == device['device_type_id']]
-        regs.sort(key=lambda r: (int(r.get('function_code', 3)), int(r['address'])))
-
-        i = 0
-        while i < len(regs):
-            current_fc = int(regs[i].get('function_code', 3))
-            start_address = int(regs[i]['address'])
-            block = [regs[i]]
-            total_regs = int(regs[i]['quantity'])
-            j = i + 1
-
-            while j < len(regs):
-                next_fc = int(regs[j].get('function_code', 3))
-                if next_fc != current_fc:
-                    break
-
-                next_addr = int(regs[j]['address'])
-                next_qty = int(regs[j]['quantity'])
-                if next_addr + next_qty - start_address <= max_registers:
-                    block.append(regs[j])
-                    total_regs = (next_addr + next_qty) - start_address
-                    j += 1
-                else:
-                    break
+        # Queued writes go first, on the same connection, so setpoints take effect before this poll reads
+        if write_queue.has_pending(device_key):
+            with span("writes"):
+                write_queue.execute(client, device_key, unit_id)
+        plan = read_plans.get(device['device_type_id'], [])
+        # Under load shedding, non-critical blocks are only read every few cycles
+        due = [governor.block_due(device['device_type_id'], record.layout, n) for n in range(len(plan))]
+        record.begin_poll(skipped=[n for n, block_due in enumerate(due) if not block_due])
+        slot = 0
 
+        for block_number, block in enumerate(plan):
+            current_fc = block['function_code']
+            start_address = block['start']
+            total_regs = block['count']
             end_address = start_address + total_regs - 1
+            block_start_slot = slot
+            slot += len(block['registers'])
+            if not due[block_number]:
+                continue
             logger.info(f"Reading FC {current_fc} from Device Address: {address}, ID: {unit_id}, Block: {start_address} to {end_address}")
 
             read_func = {
+                1: client.read_coils,
+                2: client.read_discrete_inputs,
                 3: client.read_holding_registers,
                 4: client.read_input_registers
             }.get(current_fc)
 
             if read_func is None:
                 logger.warning(f"Unsupported function code {current_fc} at address {start_address}")
-                i = j
                 continue
 
-            result = read_func(address=start_address, count=total_regs, slave=unit_id)
-
-            if result and not result.isError():
-                for reg in block:
-                    addr = int(reg['address'])
-                    offset = addr - start_address
-                    quantity = int(reg['quantity'])
-                    variable = reg['variable_name']
-
-                    try:
-                        raw_values = result.registers[offset:offset+quantity]
-                        value = apply_byte_order(raw_values, reg['type'], swap_bytes)
-
-                        gain = float(reg.get('gain', 1))
-                        if gain != 0:
-                            value = value / gain
-
-                        with data_lock:
-                            entry = {
-                                "timestamp": datetime.now().isoformat(),
-                                "device_key": device_key,
-                                "variable_name": variable,
-                                "address": addr,
-                                "value": value,
-                                "unit": reg.get("unit", ""),
-                                "device_name": device["device_name"]
-                            }
-                            device_data[device_key].append(entry)
-
-                        logger.info(f"Read {variable} = {value} from Address: {address}, ID: {unit_id}, Address: {addr}")
-                    except Exception as e:
-                        logger.error(f"Error decoding register {variable} at address {addr}: {e}")
+            metrics.POLL_REQUESTS.inc()
+            try:
+                with span("read_block", fc=current_fc, start=start_address, count=total_regs):
+                    result = read_func(address=start_address, count=total_regs, slave=unit_id)
+            except Exception as e:
+                # Drop the connection so the next cycle starts from a clean socket
+                logger.warning(f"Error reading FC {current_fc} block at {start_address} from Address: {address}, ID: {unit_id}: {e}")
+                metrics.FAILED_BLOCKS.inc(device=device_key)
+                client.close()
+                record.end_poll()
+                return
+
+            if result and not result.isError() and current_fc in BIT_FUNCTION_CODES:
+                record.set_block_time(block_number)
+                with span("decode_bits", start=start_address, bits=total_regs):
+                    decoded = decode_bits(record, block_number, block, block_start_slot, result.bits)
+                metrics.POLL_REGISTERS.inc(decoded)
+            elif result and not result.isError():
+                record.set_block_time(block_number)
+                decoded = 0
+                with span("decode_block", start=start_address, registers=len(block['registers'])):
+                    for register_slot, reg in enumerate(block['registers'], block_start_slot):
+                        addr = int(reg['address'])
+                        offset = reg['offset']
+                        quantity = int(reg['quantity'])
+                        variable = reg['variable_name']
+
+                        try:
+                            raw_values = result.registers[offset:offset+quantity]
+                            value = apply_byte_order(raw_values, reg['type'], swap_bytes)
+
+                            gain = float(reg.get('gain', 1))
+                            if gain != 0:
+                                value = value / gain
+
+                            record.set(register_slot, value)
+                            decoded += 1
+                            logger.info(f"Read {variable} = {value} from Address: {address}, ID: {unit_id}, Address: {addr}")
+                        except Exception as e:
+                            metrics.DECODE_ERRORS.inc(device=device_key)
+                            logger.error(f"Error decoding register {variable} at address {addr}: {e}")
+                metrics.POLL_REGISTERS.inc(decoded)
             else:
+                metrics.FAILED_BLOCKS.inc(device=device_key)
                 logger.warning(f"Failed to read FC {current_fc} block at {start_address} from Address: {address}, ID: {unit_id}")
 
-            i = j
+        record.end_poll()
 
-        client.close()
-        logger.info(f"Disconnected from Address: {address}, ID: {unit_id}")
+        if shared_snapshot.writer or timeseries.store:
+            with span("write_outputs"):
+                values = record.slot_values()
+                if shared_snapshot.writer:
+                    shared_snapshot.writer.write_device(device_key, values)
+                if timeseries.store:
+                    # Stamped with the newest block read, or the poll time if every block failed
+                    timeseries.store.write_device(device_key, values, None if record.failures else record.timestamp())
 
-def poll_devices():
-    while True:
-        threads = []
-        for device in device_map:
-            t = threading.Thread(target=poll_device, args=(device,))
-            t.start()
-            threads.append(t)
+def decode_bits(record, block_number, block, first_slot, bits):
+    """
+    Stores an FC1/FC2 response: the packed bitset of the block, and for each register row the
+    unsigned value of its `quantity` bits (first address least significant). Returns the rows decoded.
+    """
+    packed = pack_bits(bits[:block['count']])
+    record.set_bits(block_number, packed)
+    word = int.from_bytes(packed, "little")
+    for slot, reg in enumerate(block['registers'], first_slot):
+        record.set(slot, (word >> reg['offset']) & ((1 << int(reg['quantity'])) - 1))
+    return len(block['registers'])
 
-        for t in threads:
-            t.join()
+def poll_bus(port, devices):
+    """
+    Polls every slave on one serial bus back to back, in slave ID order, over the bus's open port.
+    Logs the achieved cycle time against the bus's theoretical minimum.
+    """
+    start = time.perf_counter()
+    for device in sorted(devices, key=lambda d: int(d['slave_id'])):
+        poll_device(device)
 
-        time.sleep(settings.get("poll_interval", 5))
+    bus = connections.clients.get(endpoint_for(devices[0]))
+    if bus is not None:
+        theoretical = sum(
+            bus.transaction_time(block['count'], block['function_code'])
+            for device in devices
+            for block in read_plans.get(device['device_type_id'], [])
+        )
+        logger.info(f"RTU bus {port}: polled {len(devices)} slaves in {time.perf_counter() - start:.3f}s "
+                    f"(theoretical minimum {theoretical:.3f}s)")
+
+def poll_cycle():
+    """
+    Polls every configured device once and waits for all of them: one thread per TCP device,
+    and one thread per serial bus that polls that bus's slaves in sequence.
+    """
+    apply_pending_config()
+    start = time.perf_counter()
+    requests_before = metrics.POLL_REQUESTS.get()
+    registers_before = metrics.POLL_REGISTERS.get()
+    threads = []
+    buses = defaultdict(list)
+    for device in device_map:
+        if device.get('protocol', 'TCP').strip().upper() == 'RTU':
+            buses[device['address']].append(device)
+            continue
+        t = threading.Thread(target=poll_device, args=(device,))
+        t.start()
+        threads.append(t)
+
+    for port, bus_devices in buses.items():
+        t = threading.Thread(target=poll_bus, args=(port, bus_devices))
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    update_derived()
+    metrics.CYCLE_REQUESTS.set(metrics.POLL_REQUESTS.get() - requests_before)
+    metrics.CYCLE_REGISTERS.set(metrics.POLL_REGISTERS.get() - registers_before)
+    duration = time.perf_counter() - start
+    metrics.CYCLE_DURATION.observe(duration)
+    return duration
+
+def poll_devices(cycle=None):
+    """
+    Polls forever on a fixed-rate schedule.
+
+    Args:
+        cycle: Function running one poll cycle and returning its duration; defaults to the
+            in-process poll_cycle (ShardedPoller.poll_cycle spreads it over worker processes).
+    """
+    cycle = cycle or poll_cycle
+    while True:
+        startup.mark("first_poll")
+        write_queue.wake.clear()
+        cycle_start_ns = time.perf_counter_ns()
+        with span("poll_cycle"):
+            duration = cycle()
+        startup.mark("first_poll_cycle")
+        interval = get_poll_interval()
+        governor.observe(duration, interval)
+        if duration > interval:
+            metrics.CYCLE_OVERRUNS.inc()
+            logger.warning(f"Poll cycle took {duration:.2f}s, longer than the {interval}s poll interval")
+            if tracing.enabled:
+                path = tracing.write(f"logs/trace-overrun-{int(time.time())}.json", since_ns=cycle_start_ns)
+                logger.warning(f"Wrote trace of the overrunning cycle to {path}")
+        # Fixed-rate schedule: the interval is measured from the start of each cycle. Queued
+        # register writes start the next cycle early so they reach every device at once.
+        write_queue.wake.wait(max(0, interval - duration))
+
+def update_derived():
+    """Recomputes the derived metrics affected by this cycle's reads."""
+    if derived.engine:
+        with data_lock:
+            records = dict(device_data)
+        with span("derived"):
+            derived.engine.update(records)
 
 def get_data():
+    """The live values as {device_key: [entry dict, ...]}, built from the records on each call."""
     with data_lock:
-        return device_data
+        records = list(device_data.values())
+    data = {record.device_key: record.entries() for record in records}
+    engine = derived.engine
+    if engine:
+        engine.add_entries(data, {record.device_key: record.device_name for record in records})
+    return data
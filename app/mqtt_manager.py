@@ -1,14 +1,23 @@
 # app/mqtt_manager.py
 
 import json
+import queue
 import threading
 import time
 import logging
 from awscrt import io, mqtt5
 from awsiot import mqtt5_client_builder
 from pathlib import Path
-from concurrent.futures import Future
 from app.cache_manager import save_payload_to_cache, load_cached_payloads, clear_cache
+from app import startup
+from app.tracing import span
+from app import writes
+from app import derived
+from app import modbus_reader
+from app.governor import governor
+from app.writes import write_queue, WriteError
+from app.metrics import PUBLISH_DURATION, PUBLISHES_IN_FLIGHT, PUBLISHES, PUBLISHED_BYTES, ALARM_PUBLISH_DELAY
+from collections import deque
 import os
 
 mqtt_client_instance = None
@@ -18,10 +27,9 @@ logger = logging.getLogger("modbus")
 # Configuration
 # ----------------------
 DEVICE_FILE = "device.json"
-# Load configuration
-with open(DEVICE_FILE, 'r') as f:
-    config = json.load(f)
-pi_id = config.get('pi_id')
+# Loaded explicitly by load_device_config() so importing this module has no side effects
+config = {}
+pi_id = None
 
 # Endpoint for AWS IoT Core
 AWS_IOT_ENDPOINT = "d037955127pwy1xzu5whf-ats.iot.eu-west-1.amazonaws.com"
@@ -29,13 +37,25 @@ AWS_IOT_ENDPOINT = "d037955127pwy1xzu5whf-ats.iot.eu-west-1.amazonaws.com"
 # Get the directory two levels up (Root Folder)
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-CERT_PATH = f"{pi_id}-certificate.pem.crt"
-KEY_PATH = f"{pi_id}-private.pem.key"
 CA_PATH = "AmazonRootCA1.pem"
 
 # Event to signal when the script is done (e.g., on KeyboardInterrupt).
 is_sample_done = threading.Event()
-future_connection_success = Future()
+# Set while the MQTT5 client has a live session; publishes fall back to the cache otherwise.
+mqtt_connected = threading.Event()
+
+def load_device_config(path=DEVICE_FILE):
+    """
+    Loads the device identity (pi_id, tenant/customer/site IDs) written by auto-provision.py.
+
+    Args:
+        path: Path to device.json.
+    """
+    global config, pi_id
+    with open(path, 'r') as f:
+        config = json.load(f)
+    pi_id = config.get('pi_id')
+    return config
 # ----------------------
 # Lifecycle Callbacks
 # ----------------------
@@ -47,8 +67,23 @@ def on_lifecycle_connection_success(lifecycle_connect_success_data: mqtt5.Lifecy
         lifecycle_connect_success_data: Data about the connection success event.
     """
     print("Lifecycle Connection Success")
-    global future_connection_success
-    future_connection_success.set_result(lifecycle_connect_success_data)
+    mqtt_connected.set()
+    logger.info(f"Connected to AWS IoT Core at {AWS_IOT_ENDPOINT}")
+    startup.mark("mqtt_connected")
+    if mqtt_client_instance:
+        mqtt_client_instance.subscribe(mqtt5.SubscribePacket(
+            subscriptions=[mqtt5.Subscription(topic_filter=site_topic("write"), qos=mqtt5.QoS.AT_LEAST_ONCE)]
+        ))
+
+def on_lifecycle_disconnection(lifecycle_disconnect_data: mqtt5.LifecycleDisconnectData):
+    """
+    Callback for when the MQTT5 client loses its connection. The client reconnects on its own.
+
+    Args:
+        lifecycle_disconnect_data: Data about the disconnection event.
+    """
+    mqtt_connected.clear()
+    logger.warning("Disconnected from AWS IoT Core; client will reconnect in the background.")
 
 def on_lifecycle_stopped(lifecycle_stopped_data: mqtt5.LifecycleStoppedData):
     """
@@ -58,90 +93,217 @@ def on_lifecycle_stopped(lifecycle_stopped_data: mqtt5.LifecycleStoppedData):
         lifecycle_stopped_data: Data about the stop event.
     """
     print("Client Stopped.")
+    mqtt_connected.clear()
     is_sample_done.set()
 
 
-def initialize_mqtt(settings):
+def start_mqtt_client():
+    """
+    Builds and starts the MQTT5 client. start() is non-blocking; the connection completes
+    (and is retried by the CRT client) in the background, signalled through mqtt_connected.
+    Raises if the client cannot be built, e.g. when the device certificates are missing.
+    """
     global mqtt_client_instance
+    if not config:
+        load_device_config()
+
+    client = mqtt5_client_builder.mtls_from_path(
+                           endpoint=AWS_IOT_ENDPOINT,
+                           port=8883,
+                           cert_filepath=f"{pi_id}-certificate.pem.crt",
+                           pri_key_filepath=f"{pi_id}-private.pem.key",
+                           ca_filepath=CA_PATH,
+                           client_id=pi_id,
+                           clean_session=False,
+                           keep_alive_secs=30,
+                           on_lifecycle_connection_success=on_lifecycle_connection_success,
+                           on_lifecycle_disconnection=on_lifecycle_disconnection,
+                           on_lifecycle_stopped=on_lifecycle_stopped,
+                           on_publish_received=on_publish_received)
+
+    client.start()
+    mqtt_client_instance = client
+    logger.info(f"Connecting to AWS IoT Core at {AWS_IOT_ENDPOINT} in the background...")
+
+def initialize_mqtt(settings):
+    """
+    Starts the MQTT connection without blocking the caller. Payloads are cached until connected.
+
+    Args:
+        settings: Parsed settings.json.
+    """
     mqtt_config = settings.get("mqtt", {})
     if mqtt_config.get("enabled", False):
-        try:
+        startup.start_background("mqtt", start_mqtt_client)
 
-            mqtt_client_instance = mqtt5_client_builder.mtls_from_path(
-                                   endpoint=AWS_IOT_ENDPOINT,
-                                   port=8883,
-                                   cert_filepath=CERT_PATH,
-                                   pri_key_filepath=KEY_PATH,
-                                   ca_filepath=CA_PATH,
-                                   client_id=pi_id,
-                                   clean_session=False,
-                                   keep_alive_secs=30,
-                                   on_lifecycle_connection_success=on_lifecycle_connection_success,
-                                   on_lifecycle_stopped=on_lifecycle_stopped)                               
-
-            mqtt_client_instance.start()
-            future_connection_success.result()
-            logger.info(f"Connected to AWS IoT Core at {AWS_IOT_ENDPOINT}")
+def publish_and_wait(topic, payload_bytes):
+    """
+    Publishes a payload at QoS 1 and waits for the broker acknowledgement, recording latency metrics.
 
-        except Exception as e:
-            logger.error(f"MQTT (AWS IoT) connection failed: {e}")
-            mqtt_client_instance = None
-
-def publish_to_mqtt(device_data, settings):
-    organized_devices = []
-    for device_key, entries in device_data.items():
-        if not entries:
-            continue
-
-        # Use first entry to extract static info
-        first_entry = entries[0]
-        device_type = first_entry.get("device_type", "")
-        device_name = first_entry.get("device_name", "")
-
-        metrics = {}
-        for entry in entries:
-            variable = entry["variable_name"]
-            value = entry["value"]
-            metrics[variable] = value
-
-        organized_devices.append({
-            "device_id": device_key,
-            "device_type": device_type,
-            "device_name": device_name,
-            "metrics": metrics
-        })
-    
-    payload = {
-        "tenant_id": config["tenant_id"],
-        "customer_id": config["customer_id"],
-        "site_id": config["site_id"],
-        "pi_id": pi_id,
-        "timestamp": int(time.time() * 1000),
-        "devices": organized_devices
-    }
-    
-    topic = f"solar/{payload['tenant_id']}/{payload['customer_id']}/{payload['site_id']}/{payload['pi_id']}/data"
-    if mqtt_client_instance:
-        try:
-            payload_json = json.dumps(payload, default=str)
-            publish_future = mqtt_client_instance.publish(
+    Args:
+        topic: MQTT topic.
+        payload_bytes: Encoded payload.
+    """
+    PUBLISHES_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    try:
+        with span("mqtt_publish", bytes=len(payload_bytes)):
+            mqtt_client_instance.publish(
                 mqtt5.PublishPacket(
                     topic=topic,
-                    payload=payload_json.encode("utf-8"),
+                    payload=payload_bytes,
                     qos=mqtt5.QoS.AT_LEAST_ONCE,
                 )
-            )
-            publish_future.result()
+            ).result()
+    except Exception:
+        PUBLISHES.inc(result="failed")
+        raise
+    finally:
+        PUBLISHES_IN_FLIGHT.dec()
+    PUBLISH_DURATION.observe(time.perf_counter() - start)
+    PUBLISHES.inc(result="ok")
+    PUBLISHED_BYTES.inc(len(payload_bytes))
+
+def publish_to_mqtt(device_data, settings, records=None):
+    """
+    Args:
+        device_data: get_data() snapshot.
+        records: device_key -> DeviceRecord the snapshot was built from, for the packed bit
+            blocks; modbus_reader.device_data by default.
+    """
+    if records is None:
+        records = modbus_reader.device_data
+    with span("build_payload", devices=len(device_data)):
+        organized_devices = []
+        for device_key, entries in device_data.items():
+            if not entries:
+                continue
+
+            # Use first entry to extract static info
+            first_entry = entries[0]
+            device_type = first_entry.get("device_type", "")
+            device_name = first_entry.get("device_name", "")
+
+            # Raw inputs replaced by derived metrics are not sent
+            hidden = derived.engine.hidden_inputs(device_key) if derived.engine else ()
+            metrics = {}
+            for entry in entries:
+                variable = entry["variable_name"]
+                if variable in hidden and not entry.get("derived"):
+                    continue
+                if entry.get("bit"):
+                    # Coils and discrete inputs travel as one packed bitset per read block instead
+                    continue
+                value = entry["value"]
+                metrics[variable] = value
+
+            device = {
+                "device_id": device_key,
+                "device_type": device_type,
+                "device_name": device_name,
+                "metrics": metrics
+            }
+            record = records.get(device_key)
+            bitmasks = record.bitmasks() if record is not None else []
+            if bitmasks:
+                device["bitmasks"] = bitmasks
+            if first_entry.get("stale"):
+                # Last-known values from before a restart; the device has not been polled since
+                device["stale"] = True
+            organized_devices.append(device)
+    
+        payload = {
+            "tenant_id": config.get("tenant_id"),
+            "customer_id": config.get("customer_id"),
+            "site_id": config.get("site_id"),
+            "pi_id": pi_id,
+            "timestamp": int(time.time() * 1000),
+            "devices": organized_devices
+        }
+
+    topic = f"solar/{payload['tenant_id']}/{payload['customer_id']}/{payload['site_id']}/{payload['pi_id']}/data"
+    if mqtt_client_instance and mqtt_connected.is_set():
+        try:
+            with span("json_encode"):
+                payload_json = json.dumps(payload, default=str)
+            publish_and_wait(topic, payload_json.encode("utf-8"))
             logger.info(f"Published payload to AWS IoT Core topic: {topic}")
-            sync_cached_payloads()  # Sync if there are any cached payloads
+            if not governor.backlog_paused():
+                sync_cached_payloads()  # Sync if there are any cached payloads
         except Exception as e:
             logger.error(f"Failed to publish to AWS IoT: {e}")
             save_payload_to_cache(payload)  # Save to cache
     else:
+        PUBLISHES.inc(result="cached")
         save_payload_to_cache(payload)
         logger.warning("MQTT client not connected. Skipping publish.")
 
 
+def site_topic(suffix):
+    return f"solar/{config.get('tenant_id')}/{config.get('customer_id')}/{config.get('site_id')}/{pi_id}/{suffix}"
+
+# ----------------------
+# Register write commands
+# ----------------------
+def on_publish_received(publish_received_data):
+    packet = publish_received_data.publish_packet
+    if packet.topic == site_topic("write"):
+        # Waiting for the read-back must not block the client's event loop
+        threading.Thread(target=handle_write_command, args=(packet.payload,), daemon=True).start()
+
+# Longest a write command may wait for its read-back confirmations, in seconds
+MAX_WRITE_WAIT = 60
+
+def handle_write_command(payload_bytes):
+    """
+    Queues the writes of a command published on .../write, {"command_id": ..., "writes": [...],
+    "timeout": seconds}, and publishes the outcome of each on .../write/result.
+    """
+    command = {}
+    try:
+        command = json.loads(payload_bytes)
+        if not isinstance(command, dict):
+            raise WriteError("A write command must be a JSON object")
+        timeout = command.get("timeout", 30)
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not 0 <= timeout <= MAX_WRITE_WAIT:
+            raise WriteError(f"Timeout must be a number of seconds from 0 to {MAX_WRITE_WAIT}, got {timeout!r}")
+        queued = write_queue.submit(command.get("writes", []), source="mqtt")
+    except (ValueError, AttributeError, WriteError) as e:
+        result = {"error": str(e)}
+    else:
+        writes.wait(queued, timeout)
+        result = {"writes": [request.result() for request in queued]}
+    result["command_id"] = command.get("command_id") if isinstance(command, dict) else None
+    try:
+        publish_and_wait(site_topic("write/result"), json.dumps(result, default=str).encode("utf-8"))
+    except Exception as e:
+        logger.error(f"Failed to publish write results: {e}")
+
+# ----------------------
+# Alarm events
+# ----------------------
+def run_alarm_publisher(events, max_backlog=1000):
+    """
+    Publishes alarm events from the alarm engine's queue one by one as they arrive, on the
+    site's alarms topic, independently of the periodic data payloads. Events raised while the
+    broker is unreachable are kept (up to max_backlog) and sent in order on reconnect.
+    """
+    backlog = deque(maxlen=max_backlog)
+    while True:
+        try:
+            backlog.append(events.get(timeout=1))
+        except queue.Empty:
+            pass
+        while backlog and mqtt_client_instance and mqtt_connected.is_set():
+            event = backlog[0]
+            try:
+                publish_and_wait(site_topic("alarms"), json.dumps(dict(event, pi_id=pi_id), default=str).encode("utf-8"))
+            except Exception as e:
+                logger.error(f"Failed to publish alarm {event['alarm']}: {e}")
+                break
+            backlog.popleft()
+            ALARM_PUBLISH_DELAY.observe(max(time.time() - event["timestamp"] / 1000, 0))
+
 def sync_cached_payloads():
     cached_payloads = load_cached_payloads()
     for payload in cached_payloads:
@@ -152,13 +314,8 @@ def sync_cached_payloads():
 
             topic = f"solar/{payload['tenant_id']}/{payload['customer_id']}/{payload['site_id']}/{payload['pi_id']}/data"
 
-            if mqtt_client_instance:
-                message = mqtt5.PublishPacket(
-                    topic=topic,
-                    payload=json.dumps(payload).encode("utf-8"),
-                    qos=mqtt5.QoS.AT_LEAST_ONCE,
-                )
-                mqtt_client_instance.publish(message).result()
+            if mqtt_client_instance and mqtt_connected.is_set():
+                publish_and_wait(topic, json.dumps(payload).encode("utf-8"))
                 logger.info(f"Synced cached payload to: {topic}")
             else:
                 logger.warning("MQTT not available. Skipping cache sync.")
@@ -0,0 +1,327 @@
+# app/pipelined_tcp.py
+#
+# Pipelined Modbus TCP transport: one socket per gateway with up to `depth` requests in flight
+# across unit IDs, responses matched by MBAP transaction ID. Gateways that answer out of order or
+# with mismatched frames are switched to serial mode (one outstanding transaction) until they have
+# been quiet for a while.
+
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from app import metrics
+from app.logger import logger
+from app.read_plan import BIT_FUNCTION_CODES
+from app.utils import unpack_bits
+
+MBAP = struct.Struct(">HHHB")
+READ_REQUEST = struct.Struct(">HH")
+WRITE_MULTIPLE_REQUEST = struct.Struct(">HHB")
+WRITE_FUNCTION_CODES = (6, 16)
+# Seconds in serial mode before pipelining is tried again; doubles each time it has to fall back again
+PIPELINE_RETRY = 300
+MAX_PIPELINE_RETRY = 3600
+# Timed-out transaction IDs remembered so their late responses can be told apart from stray frames
+ABANDONED_LIMIT = 256
+
+class ModbusTcpError(Exception):
+    pass
+
+class RegisterResponse:
+    """Minimal stand-in for pymodbus's register and bit responses: registers, bits, isError() and exception_code."""
+
+    def __init__(self, function_code, registers=None, exception_code=None, bits=None):
+        self.function_code = function_code
+        self.registers = registers or []
+        self.bits = bits or []
+        self.exception_code = exception_code
+
+    def isError(self):
+        return self.exception_code is not None
+
+    def __repr__(self):
+        if self.isError():
+            return f"RegisterResponse(fc={self.function_code & 0x7F}, exception={self.exception_code})"
+        if self.function_code in BIT_FUNCTION_CODES:
+            return f"RegisterResponse(fc={self.function_code}, bits={len(self.bits)})"
+        return f"RegisterResponse(fc={self.function_code}, registers={len(self.registers)})"
+
+def pdu_problem(pdu):
+    """Returns why a response PDU is malformed, or None. Read responses must carry exactly their byte count."""
+    function_code = pdu[0]
+    if function_code & 0x80 or function_code in WRITE_FUNCTION_CODES:
+        return None
+    if len(pdu) < 2 or len(pdu) != 2 + pdu[1]:
+        return f"PDU of {len(pdu)} bytes for function {function_code}" + (f" with byte count {pdu[1]}" if len(pdu) > 1 else "")
+    if function_code not in BIT_FUNCTION_CODES and pdu[1] % 2:
+        return f"odd byte count {pdu[1]} for function {function_code}"
+    return None
+
+class PendingRequest:
+    def __init__(self, transaction_id, unit_id, function_code, sequence):
+        self.transaction_id = transaction_id
+        # Send order, which unlike the transaction ID does not wrap
+        self.sequence = sequence
+        self.unit_id = unit_id
+        self.function_code = function_code
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+class PipelinedTcpClient:
+    """
+    Thread-safe Modbus TCP client for one gateway. Each read blocks its caller until the matching
+    response arrives, but callers on different threads share the socket with up to `depth`
+    transactions outstanding.
+
+    Args:
+        host, port: Gateway address.
+        depth: Maximum requests in flight while pipelining.
+        timeout: Seconds to wait for each response.
+        pipelined: False to start in serial mode, e.g. for a gateway known to need it.
+        retry_after: Seconds in serial mode before pipelining is tried again.
+    """
+
+    # Safe to call from several threads at once; the poller does not serialise its devices
+    concurrent = True
+
+    def __init__(self, host, port=502, depth=4, timeout=3.0, pipelined=True, retry_after=PIPELINE_RETRY):
+        self.host = host
+        self.port = port
+        self.depth = depth
+        self.timeout = timeout
+        self.gateway = f"{host}:{port}"
+        self.pipelined = depth > 1 and pipelined
+        self.retry_after = retry_after
+        self.serial_since = None if self.pipelined else time.monotonic()
+        self.retried = False
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.slots = threading.Semaphore(depth)
+        # Serial mode: a single permit that every request must hold
+        self.serial = threading.Lock()
+        self.pending = {}
+        self.abandoned = OrderedDict()
+        # When the reader got the first bytes of a frame it has not finished receiving
+        self.frame_started = None
+        self.next_transaction_id = 0
+        self.sent = 0
+        # Sequence of the newest request answered so far
+        self.answered = 0
+
+    # ----------------------
+    # Connection
+    # ----------------------
+    def connect(self):
+        with self.lock:
+            if self.sock is not None:
+                return True
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as e:
+                logger.warning(f"Unable to connect to gateway {self.gateway}: {e}")
+                return False
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(None)
+            self.sock = sock
+            self.reader = threading.Thread(target=self.read_responses, args=(sock,), daemon=True)
+            self.reader.start()
+            return True
+
+    def close(self):
+        with self.lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self.fail_pending(ModbusTcpError(f"Connection to {self.gateway} closed"), sock)
+
+    def fail_pending(self, error, sock=None):
+        with self.lock:
+            if sock is not None and self.sock is not None and self.sock is not sock:
+                # A newer connection owns the pending table
+                return
+            pending, self.pending = self.pending, {}
+        for request in pending.values():
+            request.error = error
+            request.done.set()
+        metrics.TCP_IN_FLIGHT.set(0, gateway=self.gateway)
+
+    def fall_back(self, reason):
+        if self.pipelined:
+            self.pipelined = False
+            if self.retried:
+                # It misbehaved again after a retry; wait longer before the next one
+                self.retry_after = min(2 * self.retry_after, MAX_PIPELINE_RETRY)
+            metrics.PIPELINE_FALLBACKS.inc(gateway=self.gateway)
+            logger.warning(f"Gateway {self.gateway}: {reason}; switching to serial mode for {self.retry_after}s.")
+        # Any misbehaviour restarts the quiet period
+        self.serial_since = time.monotonic()
+
+    def retry_pipelining(self):
+        if self.pipelined or self.depth <= 1 or time.monotonic() - self.serial_since < self.retry_after:
+            return
+        self.pipelined = True
+        self.retried = True
+        logger.info(f"Gateway {self.gateway} quiet for {self.retry_after}s; pipelining again.")
+
+    # ----------------------
+    # Receiving
+    # ----------------------
+    def recv_exact(self, sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ModbusTcpError(f"Gateway {self.gateway} closed the connection")
+            data += chunk
+        return data
+
+    def read_responses(self, sock):
+        try:
+            while True:
+                self.frame_started = None
+                first = sock.recv(MBAP.size)
+                if not first:
+                    raise ModbusTcpError(f"Gateway {self.gateway} closed the connection")
+                self.frame_started = time.monotonic()
+                transaction_id, protocol_id, length, unit_id = MBAP.unpack(first + self.recv_exact(sock, MBAP.size - len(first)))
+                if protocol_id != 0 or not 2 <= length <= 254:
+                    # Not a Modbus TCP frame: the stream cannot be resynchronised
+                    self.fall_back("framing error")
+                    raise ModbusTcpError(f"Framing error from {self.gateway} (protocol {protocol_id}, length {length})")
+                pdu = self.recv_exact(sock, length - 1)
+                problem = pdu_problem(pdu)
+                if problem:
+                    # The MBAP length and the PDU disagree, so the next frame cannot be trusted either
+                    self.fall_back("framing error")
+                    raise ModbusTcpError(f"Framing error from {self.gateway} in transaction {transaction_id}: {problem}")
+                self.dispatch(transaction_id, unit_id, pdu)
+        except (OSError, ModbusTcpError) as e:
+            if self.sock is sock:
+                logger.warning(f"Gateway {self.gateway} connection lost: {e}")
+                with self.lock:
+                    if self.sock is sock:
+                        self.sock = None
+                sock.close()
+            self.fail_pending(ModbusTcpError(str(e)), sock)
+
+    def dispatch(self, transaction_id, unit_id, pdu):
+        with self.lock:
+            request = self.pending.pop(transaction_id, None)
+            late = request is None and self.abandoned.pop(transaction_id, None) is not None
+            # A request still waiting for its answer may never get one (a missing unit), so only an
+            # answer overtaken by a newer one's counts as out of order
+            overtaken = request is not None and request.sequence < self.answered
+            if request is not None:
+                self.answered = max(self.answered, request.sequence)
+            in_flight = len(self.pending)
+        metrics.TCP_IN_FLIGHT.set(in_flight, gateway=self.gateway)
+        if late:
+            logger.debug(f"Gateway {self.gateway}: discarding late response to transaction {transaction_id}")
+            return
+        if request is None:
+            self.fall_back(f"unexpected transaction ID {transaction_id}")
+            return
+        if overtaken:
+            self.fall_back(f"response {transaction_id} arrived after a newer one")
+        if unit_id != request.unit_id or not pdu or pdu[0] & 0x7F != request.function_code:
+            self.fall_back(f"response {transaction_id} does not match its request")
+            request.error = ModbusTcpError(f"Mismatched response from {self.gateway} for transaction {transaction_id}")
+        elif pdu[0] & 0x80:
+            request.response = RegisterResponse(pdu[0], exception_code=pdu[1] if len(pdu) > 1 else None)
+        elif pdu[0] in WRITE_FUNCTION_CODES:
+            # Echo of the written address and value/count
+            request.response = RegisterResponse(pdu[0])
+        elif pdu[0] in BIT_FUNCTION_CODES:
+            # Packed bits, padded to whole bytes like pymodbus's bit responses
+            byte_count = pdu[1]
+            request.response = RegisterResponse(pdu[0], bits=unpack_bits(pdu[2:2 + byte_count], 8 * byte_count))
+        else:
+            byte_count = pdu[1]
+            request.response = RegisterResponse(pdu[0], list(struct.unpack(f">{byte_count // 2}H", pdu[2:2 + byte_count])))
+        request.done.set()
+
+    # ----------------------
+    # Requests
+    # ----------------------
+    def execute(self, unit_id, function_code, body):
+        """Sends one request PDU and waits for its response."""
+        self.retry_pipelining()
+        serial = not self.pipelined
+        if serial:
+            self.serial.acquire()
+        self.slots.acquire()
+        try:
+            return self.transact(unit_id, function_code, body)
+        finally:
+            self.slots.release()
+            if serial:
+                self.serial.release()
+
+    def transact(self, unit_id, function_code, body):
+        if not self.connect():
+            raise ModbusTcpError(f"Not connected to {self.gateway}")
+        # Transaction IDs go on the wire in the order they are assigned, so responses can be checked against it
+        with self.send_lock:
+            with self.lock:
+                sock = self.sock
+                self.next_transaction_id = (self.next_transaction_id + 1) & 0xFFFF
+                self.abandoned.pop(self.next_transaction_id, None)
+                self.sent += 1
+                request = PendingRequest(self.next_transaction_id, unit_id, function_code, self.sent)
+                self.pending[request.transaction_id] = request
+                in_flight = len(self.pending)
+            metrics.TCP_IN_FLIGHT.set(in_flight, gateway=self.gateway)
+            pdu = bytes([function_code]) + body
+            frame = MBAP.pack(request.transaction_id, 0, len(pdu) + 1, unit_id) + pdu
+            try:
+                sock.sendall(frame)
+            except (OSError, AttributeError) as e:
+                send_error = e
+            else:
+                send_error = None
+        if send_error is not None:
+            self.close()
+            raise ModbusTcpError(f"Error sending to {self.gateway}: {send_error}")
+
+        if not request.done.wait(self.timeout):
+            with self.lock:
+                if self.pending.pop(request.transaction_id, None) is not None:
+                    self.abandoned[request.transaction_id] = unit_id
+                    while len(self.abandoned) > ABANDONED_LIMIT:
+                        self.abandoned.popitem(last=False)
+                frame_started = self.frame_started
+            # A unit that does not answer (e.g. it is missing behind the gateway) only fails its own
+            # request; the socket is reset only if the reader is stuck halfway through a frame
+            if frame_started is not None and time.monotonic() - frame_started > self.timeout:
+                self.close()
+            raise ModbusTcpError(f"No response from {self.gateway} (unit {unit_id}) within {self.timeout}s")
+        if request.error is not None:
+            raise request.error
+        return request.response
+
+    def read_coils(self, address, count=1, slave=1):
+        return self.execute(slave, 1, READ_REQUEST.pack(address, count))
+
+    def read_discrete_inputs(self, address, count=1, slave=1):
+        return self.execute(slave, 2, READ_REQUEST.pack(address, count))
+
+    def read_holding_registers(self, address, count=1, slave=1):
+        return self.execute(slave, 3, READ_REQUEST.pack(address, count))
+
+    def read_input_registers(self, address, count=1, slave=1):
+        return self.execute(slave, 4, READ_REQUEST.pack(address, count))
+
+    def write_register(self, address, value, slave=1):
+        return self.execute(slave, 6, READ_REQUEST.pack(address, value))
+
+    def write_registers(self, address, values, slave=1):
+        body = WRITE_MULTIPLE_REQUEST.pack(address, len(values), 2 * len(values)) + struct.pack(f">{len(values)}H", *values)
+        return self.execute(slave, 16, body)
@@ -0,0 +1,78 @@
+# app/read_plan.py
+
+from collections import defaultdict
+
+# Coils (FC1) and discrete inputs (FC2) are read as bits, up to 2000 per request
+BIT_FUNCTION_CODES = (1, 2)
+MAX_BITS = 2000
+
+def group_registers_by_type(register_map):
+    registers_by_type = defaultdict(list)
+    for reg in register_map:
+        registers_by_type[reg['device_type_id']].append(reg)
+    return registers_by_type
+
+def build_read_plan(registers, max_registers):
+    """
+    Groups one device type's registers into the fewest contiguous read blocks per function code.
+
+    Args:
+        registers: Register map rows for a single device type.
+        max_registers: Maximum number of registers a single request may span. Bit blocks
+            (FC1/FC2) may span up to MAX_BITS coils or inputs instead.
+
+    Returns:
+        list: Blocks of {"function_code", "start", "count", "registers"}; each register carries
+        its "offset" into the block. For bit blocks, count and offsets are in bits.
+    """
+    regs = sorted(registers, key=lambda r: (int(r.get('function_code', 3)), int(r['address'])))
+    plan = []
+
+    i = 0
+    while i < len(regs):
+        current_fc = int(regs[i].get('function_code', 3))
+        limit = MAX_BITS if current_fc in BIT_FUNCTION_CODES else max_registers
+        start_address = int(regs[i]['address'])
+        block = [regs[i]]
+        total_regs = int(regs[i]['quantity'])
+        j = i + 1
+
+        while j < len(regs):
+            next_fc = int(regs[j].get('function_code', 3))
+            if next_fc != current_fc:
+                break
+
+            next_addr = int(regs[j]['address'])
+            next_qty = int(regs[j]['quantity'])
+            if next_addr + next_qty - start_address <= limit:
+                block.append(regs[j])
+                total_regs = max(total_regs, (next_addr + next_qty) - start_address)
+                j += 1
+            else:
+                break
+
+        plan.append({
+            "function_code": current_fc,
+            "start": start_address,
+            "count": total_regs,
+            "registers": [dict(reg, offset=int(reg['address']) - start_address) for reg in block]
+        })
+        i = j
+
+    return plan
+
+def flat_registers(plan):
+    """Registers of a read plan in plan order; their positions are stable slot indexes for the plan."""
+    return [reg for block in plan for reg in block['registers']]
+
+def compile_read_plans(register_map, max_registers, device_type_ids=None):
+    """
+    Builds read plans keyed by device_type_id, optionally only for the given device types.
+    """
+    registers_by_type = group_registers_by_type(register_map)
+    if device_type_ids is None:
+        device_type_ids = registers_by_type.keys()
+    return {
+        type_id: build_read_plan(registers_by_type.get(type_id, []), max_registers)
+        for type_id in device_type_ids
+    }
@@ -0,0 +1,241 @@
+# app/sharded_poller.py
+#
+# Multi-process polling: device_map is sharded by gateway (connection endpoint) across worker
+# processes. Each worker owns its connections and read plans and runs the normal poll_cycle();
+# the main process keeps the snapshot, publishing and the dashboard.
+
+import multiprocessing
+import time
+from app import modbus_reader
+from app import metrics
+from app import shared_snapshot
+from app import timeseries
+from app import alarms
+from app.governor import governor
+from app.connections import endpoint_for
+from app.writes import write_queue
+from app.logger import logger
+
+# Counters whose per-cycle deltas are shipped from the workers to the main process
+FORWARDED_COUNTERS = (
+    metrics.POLL_REQUESTS,
+    metrics.POLL_REGISTERS,
+    metrics.CONNECT_FAILURES,
+    metrics.FAILED_BLOCKS,
+    metrics.DECODE_ERRORS,
+    metrics.WRITE_TRANSACTIONS,
+)
+
+# ----------------------
+# Worker process
+# ----------------------
+def counter_snapshot():
+    return [dict(counter.values) for counter in FORWARDED_COUNTERS]
+
+def counter_deltas(before):
+    deltas = []
+    for counter, old in zip(FORWARDED_COUNTERS, before):
+        with counter.lock:
+            current = dict(counter.values)
+        deltas.append({key: value - old.get(key, 0) for key, value in current.items() if value != old.get(key, 0)})
+    return deltas
+
+def collect_results(sent_seqs):
+    """
+    Returns {device_key: record state} for devices polled since the last call. Only the value
+    arrays cross the process boundary; the main process owns the metadata (names, units, addresses).
+    """
+    results = {}
+    with modbus_reader.data_lock:
+        records = list(modbus_reader.device_data.values())
+    for record in records:
+        if sent_seqs.get(record.device_key) == record.seq:
+            continue
+        sent_seqs[record.device_key] = record.seq
+        results[record.device_key] = record.state()
+    for device_key in list(sent_seqs):
+        if device_key not in modbus_reader.device_data:
+            del sent_seqs[device_key]
+    return results
+
+def worker_settings(settings, index):
+    # The shared snapshot, the time-series store, the alarm engine and derived metrics live in the main process.
+    # Each worker records to its own capture file, holding its shard's devices. The governor's level comes
+    # with every poll; its critical variables include the alarm-watched ones the worker cannot see.
+    capture = dict(settings.get("capture", {}))
+    if capture.get("record"):
+        capture["record"] = f"{capture['record']}.{index}"
+    return dict(settings, shared_snapshot={}, timeseries={}, alarms={}, derived={}, capture=capture,
+                governor=governor.worker_options())
+
+def worker_main(conn, settings, register_map, devices):
+    if settings.get("log_level"):
+        logger.setLevel(settings["log_level"])
+    modbus_reader.configure(settings, register_map, devices)
+    sent_seqs = {}
+    while True:
+        command, payload = conn.recv()
+        if command == "poll":
+            before = counter_snapshot()
+            # Register writes queued in the main process for this worker's devices, and its shedding level
+            writes, (level, cycle) = payload
+            governor.follow(level, cycle)
+            forwarded = write_queue.add_forwarded(writes or {})
+            modbus_reader.poll_cycle()
+            # Every forwarded write is reported back, including those for devices this worker did not poll
+            write_queue.fail_unfinished(forwarded, "Device was not polled by its worker")
+            write_results = {request.request_id: (request.status, request.error) for request in forwarded}
+            conn.send((collect_results(sent_seqs), counter_deltas(before), write_results))
+        elif command == "config":
+            modbus_reader.stage_config(*payload)
+        elif command == "stop":
+            break
+
+# ----------------------
+# Main process
+# ----------------------
+class ShardedPoller:
+    """
+    Polls device_map with a pool of worker processes, sharded by gateway so each connection is
+    owned by exactly one worker. Shards are sticky across config reloads: existing gateways stay on
+    their worker and new gateways go to the least loaded one.
+
+    Args:
+        workers: Number of worker processes.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = []
+        self.connections = []
+        self.assignments = {}
+        self.active_device_map = None
+
+    def shard(self, device_map):
+        gateways = {}
+        for device in device_map:
+            gateways.setdefault(endpoint_for(device), []).append(device)
+
+        self.assignments = {gw: w for gw, w in self.assignments.items() if gw in gateways}
+        load = [0] * self.workers
+        for gateway, worker in self.assignments.items():
+            load[worker] += len(gateways[gateway])
+        for gateway in sorted(gateways, key=lambda gw: len(gateways[gw]), reverse=True):
+            if gateway not in self.assignments:
+                worker = load.index(min(load))
+                self.assignments[gateway] = worker
+                load[worker] += len(gateways[gateway])
+
+        shards = [[] for _ in range(self.workers)]
+        for gateway, devices in gateways.items():
+            shards[self.assignments[gateway]].extend(devices)
+        return shards
+
+    def start(self):
+        shards = self.shard(modbus_reader.device_map)
+        for index, shard in enumerate(shards):
+            parent_conn, child_conn = self.context.Pipe()
+            process = self.context.Process(
+                target=worker_main,
+                args=(child_conn, worker_settings(modbus_reader.settings, index), modbus_reader.register_map, shard),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+            self.connections.append(parent_conn)
+        self.active_device_map = modbus_reader.device_map
+        logger.info(f"Started {self.workers} polling workers with shards of {[len(s) for s in shards]} devices.")
+
+    def sync_config(self):
+        """Pushes the main process's current configuration to the workers if it changed."""
+        if modbus_reader.device_map is self.active_device_map:
+            return False
+        shards = self.shard(modbus_reader.device_map)
+        for index, (conn, shard) in enumerate(zip(self.connections, shards)):
+            conn.send(("config", (worker_settings(modbus_reader.settings, index), modbus_reader.register_map, shard)))
+        self.active_device_map = modbus_reader.device_map
+        logger.info(f"Resharded polling workers: {[len(s) for s in shards]} devices.")
+        return True
+
+    def poll_cycle(self):
+        """Runs one poll cycle on every worker and merges their results into the main snapshot."""
+        if not self.processes:
+            self.start()
+        modbus_reader.apply_pending_config()
+        self.sync_config()
+        start = time.perf_counter()
+        requests_before = metrics.POLL_REQUESTS.get()
+        registers_before = metrics.POLL_REGISTERS.get()
+
+        per_worker = self.split_writes(write_queue.take_all())
+        forwarded_ids = [request_id for writes in per_worker for items in writes.values() for request_id, *_ in items]
+        try:
+            for conn, writes in zip(self.connections, per_worker):
+                conn.send(("poll", (writes, (governor.level, governor.cycle))))
+
+            for conn in self.connections:
+                results, deltas, write_results = conn.recv()
+                self.merge(results)
+                write_queue.complete_forwarded(write_results)
+                for counter, delta in zip(FORWARDED_COUNTERS, deltas):
+                    with counter.lock:
+                        for key, value in delta.items():
+                            counter.values[key] = counter.values.get(key, 0) + value
+        except (EOFError, OSError) as e:
+            # Restart the whole pool on the next cycle; shards and connections are rebuilt. Writes
+            # handed to the pool this cycle and not reported back would otherwise stay queued forever.
+            logger.error(f"Polling worker failed: {e}. Restarting workers.")
+            write_queue.complete_forwarded({request_id: ("failed", f"Polling worker failed: {e}") for request_id in forwarded_ids})
+            self.stop()
+
+        # Every record, merged or not: devices that were not read this cycle still age towards their staleness alarms
+        if alarms.engine:
+            for record in list(modbus_reader.device_data.values()):
+                alarms.engine.evaluate(record)
+        modbus_reader.update_derived()
+
+        metrics.CYCLE_REQUESTS.set(metrics.POLL_REQUESTS.get() - requests_before)
+        metrics.CYCLE_REGISTERS.set(metrics.POLL_REGISTERS.get() - registers_before)
+        duration = time.perf_counter() - start
+        metrics.CYCLE_DURATION.observe(duration)
+        return duration
+
+    def split_writes(self, forwarded):
+        """Queued writes per worker, following the gateway assignments."""
+        per_worker = [{} for _ in self.connections]
+        devices = {f"{d['device_id']}_{d['slave_id']}": d for d in modbus_reader.device_map}
+        for device_key, items in forwarded.items():
+            device = devices.get(device_key)
+            worker = self.assignments.get(endpoint_for(device)) if device else None
+            if worker is None:
+                write_queue.complete_forwarded({request_id: ("failed", "Device is no longer configured") for request_id, *_ in items})
+                continue
+            per_worker[worker][device_key] = items
+        return per_worker
+
+    def merge(self, results):
+        for device_key, state in results.items():
+            record = modbus_reader.device_data.get(device_key)
+            # A worker that has not applied the latest layout yet sends arrays of the old size
+            if record is None or not record.load_state(state):
+                continue
+            if shared_snapshot.writer or timeseries.store:
+                values = record.slot_values()
+                if shared_snapshot.writer:
+                    shared_snapshot.writer.write_device(device_key, values)
+                if timeseries.store:
+                    timeseries.store.write_device(device_key, values, None if record.failures else record.timestamp())
+
+    def stop(self):
+        for conn in self.connections:
+            try:
+                conn.send(("stop", None))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.connections = []
@@ -0,0 +1,261 @@
+# app/shared_snapshot.py
+#
+# Latest register values in a fixed-layout memory-mapped file (one seqlocked float64 record per
+# device, slot names in "<path>.layout.json") so other local processes can read them without IPC.
+#
+#   python -m app.shared_snapshot /dev/shm/modbus_dashboard.snapshot
+
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from datetime import datetime
+from app.read_plan import flat_registers
+from app.logger import logger
+
+MAGIC = b"MBSS"
+VERSION = 1
+HEADER = struct.Struct("<4sIQII")
+HEADER_SIZE = 32
+RECORD_HEADER = struct.Struct("<Qd")
+SEQ = struct.Struct("<Q")
+RETIRED = struct.Struct("<I")
+RETIRED_OFFSET = 16
+
+DEFAULT_PATH = "/dev/shm/modbus_dashboard.snapshot" if os.path.isdir("/dev/shm") else "modbus_dashboard.snapshot"
+
+def build_layout(device_map, read_plans):
+    """
+    Computes the slot layout for the given configuration.
+
+    Returns:
+        dict: {"hash", "size", "devices": [{"device_key", "device_name", "offset", "slots": [...]}]}
+    """
+    devices = []
+    offset = HEADER_SIZE
+    for device in device_map:
+        registers = flat_registers(read_plans.get(device['device_type_id'], []))
+        devices.append({
+            "device_key": f"{device['device_id']}_{device['slave_id']}",
+            "device_name": device["device_name"],
+            "offset": offset,
+            "slots": [{"variable_name": r['variable_name'], "address": r['address'], "unit": r.get('unit', "")} for r in registers]
+        })
+        offset += RECORD_HEADER.size + 8 * len(registers)
+    digest = hashlib.sha1(json.dumps(devices, sort_keys=True).encode("utf-8")).digest()
+    return {"hash": int.from_bytes(digest[:8], "little"), "size": offset, "devices": devices}
+
+class SnapshotWriter:
+    """
+    Single writer for the shared snapshot. rebuild() must be called whenever the device map or read
+    plans change; it creates a new file and marks the old one retired so readers reopen.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.mm = None
+        self.layout = None
+        self.records = {}
+
+    def rebuild(self, device_map, read_plans):
+        layout = build_layout(device_map, read_plans)
+        if self.layout and layout["hash"] == self.layout["hash"]:
+            return
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.truncate(layout["size"])
+        with open(f"{self.path}.layout.json.tmp", "w") as f:
+            json.dump(layout, f)
+        with open(tmp_path, "r+b") as f:
+            mm = mmap.mmap(f.fileno(), layout["size"])
+        HEADER.pack_into(mm, 0, MAGIC, VERSION, layout["hash"], 0, len(layout["devices"]))
+        for device in layout["devices"]:
+            values = [math.nan] * len(device["slots"])
+            RECORD_HEADER.pack_into(mm, device["offset"], 0, 0.0)
+            struct.pack_into(f"<{len(values)}d", mm, device["offset"] + RECORD_HEADER.size, *values)
+
+        # Sidecar first, then the data file; readers match them by hash
+        os.replace(f"{self.path}.layout.json.tmp", f"{self.path}.layout.json")
+        os.replace(tmp_path, self.path)
+        if self.mm is not None:
+            RETIRED.pack_into(self.mm, RETIRED_OFFSET, 1)
+            self.mm.close()
+        self.mm = mm
+        self.layout = layout
+        self.records = {
+            device["device_key"]: (
+                device["offset"],
+                struct.Struct(f"<{len(device['slots'])}d"),
+                len(device["slots"])
+            )
+            for device in layout["devices"]
+        }
+        logger.info(f"Shared snapshot {self.path}: {len(layout['devices'])} devices, {layout['size']} bytes")
+
+    def write_device(self, device_key, values, timestamp=None):
+        """Writes one device's latest values (in slot order, NaN for missing) under its seqlock."""
+        record = self.records.get(device_key)
+        if record is None or self.mm is None:
+            return
+        offset, values_struct, slot_count = record
+        if len(values) != slot_count:
+            return
+
+        seq = SEQ.unpack_from(self.mm, offset)[0]
+        SEQ.pack_into(self.mm, offset, seq + 1)
+        RECORD_HEADER.pack_into(self.mm, offset, seq + 1, timestamp or time.time())
+        values_struct.pack_into(self.mm, offset + RECORD_HEADER.size, *values)
+        SEQ.pack_into(self.mm, offset, seq + 2)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+class SnapshotReader:
+    """
+    Reads the shared snapshot written by another process. Reopens automatically when the writer
+    publishes a new layout, or when a new writer (e.g. the poller after a crash) replaced the file.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.mm = None
+        self.layout = None
+        self.devices = {}
+        # (st_dev, st_ino) of the file mapped; a different one at self.path is a new writer's file
+        self.file_id = None
+
+    def open(self):
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # Views handed out by view() still reference the old mapping; let GC release it
+                pass
+            self.mm = None
+        with open(f"{self.path}.layout.json") as f:
+            layout = json.load(f)
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+        magic, version, layout_hash, _, _ = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION or layout_hash != layout["hash"]:
+            mm.close()
+            raise ValueError(f"Shared snapshot {self.path} does not match its layout file")
+        self.mm = mm
+        self.layout = layout
+        self.devices = {device["device_key"]: device for device in layout["devices"]}
+        self.file_id = (stat.st_dev, stat.st_ino)
+
+    def replaced(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino) != self.file_id
+
+    def ensure_current(self):
+        if self.mm is None or RETIRED.unpack_from(self.mm, RETIRED_OFFSET)[0] or self.replaced():
+            # The writer may be between replacing the two files; retry briefly
+            for _ in range(10):
+                try:
+                    self.open()
+                    return
+                except (OSError, ValueError):
+                    time.sleep(0.01)
+            self.open()
+
+    def view(self, device_key):
+        """Zero-copy float64 view of a device's slots. Not consistency-checked; use read_device for that."""
+        self.ensure_current()
+        device = self.devices[device_key]
+        start = device["offset"] + RECORD_HEADER.size
+        return memoryview(self.mm)[start:start + 8 * len(device["slots"])].cast("d")
+
+    def read_device(self, device_key, timeout=0.1):
+        """
+        Returns (timestamp, values) for one device, retrying until a consistent copy is read.
+
+        Raises:
+            TimeoutError: If the record stayed mid-update for `timeout` seconds (e.g. the writer died while writing it).
+        """
+        self.ensure_current()
+        return self.read_record(self.devices[device_key], timeout)
+
+    def read_record(self, device, timeout):
+        offset = device["offset"]
+        values_struct = struct.Struct(f"<{len(device['slots'])}d")
+        deadline = time.monotonic() + timeout
+        delay = 0.0
+        while True:
+            seq_before, timestamp = RECORD_HEADER.unpack_from(self.mm, offset)
+            if not seq_before & 1:
+                values = values_struct.unpack_from(self.mm, offset + RECORD_HEADER.size)
+                if SEQ.unpack_from(self.mm, offset)[0] == seq_before:
+                    return timestamp, values
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Could not read a consistent snapshot for {device['device_key']}")
+            # Yield to the writer first, then back off up to 1 ms between attempts
+            time.sleep(delay)
+            delay = min(max(delay * 2, 0.00005), 0.001)
+
+    def as_device_data(self):
+        """The snapshot in the same shape as modbus_reader.get_data(), for the dashboard."""
+        self.ensure_current()
+        data = {}
+        for device_key, device in self.devices.items():
+            try:
+                timestamp, values = self.read_record(device, 0.1)
+            except TimeoutError as e:
+                logger.warning(f"{e}; leaving it out of this response")
+                continue
+            if not timestamp:
+                continue
+            iso = datetime.fromtimestamp(timestamp).isoformat()
+            data[device_key] = [
+                {
+                    "timestamp": iso,
+                    "device_key": device_key,
+                    "variable_name": slot["variable_name"],
+                    "address": slot["address"],
+                    "value": value,
+                    "unit": slot["unit"],
+                    "device_name": device["device_name"]
+                }
+                for slot, value in zip(device["slots"], values)
+                if not math.isnan(value)
+            ]
+        return data
+
+# Process-wide writer, enabled by settings.json "shared_snapshot"
+writer = None
+
+def configure(settings, device_map, read_plans):
+    global writer
+    options = settings.get("shared_snapshot", {})
+    if not options.get("enabled", False):
+        if writer is not None:
+            writer.close()
+            writer = None
+        return
+    if writer is None or writer.path != options.get("path", DEFAULT_PATH):
+        if writer is not None:
+            writer.close()
+        writer = SnapshotWriter(options.get("path", DEFAULT_PATH))
+    writer.rebuild(device_map, read_plans)
+
+if __name__ == "__main__":
+    reader = SnapshotReader(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH)
+    reader.ensure_current()
+    for device_key, device in reader.devices.items():
+        timestamp, values = reader.read_device(device_key)
+        age = f"{time.time() - timestamp:.1f}s ago" if timestamp else "never polled"
+        print(f"{device_key} {device['device_name']} ({age})")
+        for slot, value in zip(device["slots"], values):
+            print(f"    {slot['variable_name']:<50} {value:>14} {slot['unit']}")
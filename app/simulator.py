@@ -0,0 +1,306 @@
+# app/simulator.py
+#
+# Local Modbus TCP slave simulator built on pymodbus's server. Stands up N virtual slaves
+# serving the registers from data/register_map.csv, with optional latency, jitter,
+# packet loss and exception injection. Used by benchmark.py and for offline testing.
+#
+#   python -m app.simulator --devices 10 --port 5020 --latency 0.005 --write-device-map sim_devices.csv
+
+import argparse
+import asyncio
+import csv
+import random
+import socket
+import time
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import Future
+from pymodbus.datastore import ModbusServerContext
+from pymodbus.datastore.context import ModbusBaseSlaveContext
+from pymodbus.exceptions import NoSuchSlaveException
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.server import ModbusTcpServer
+from pymodbus.server.requesthandler import ServerRequestHandler
+from pymodbus.transaction import TransactionManager
+from app.csv_parser import parse_register_map
+from app.read_plan import group_registers_by_type
+
+# Unit IDs 1..247 are valid Modbus addresses; larger fleets are spread over consecutive ports
+MAX_UNITS_PER_PORT = 247
+
+DEFAULT_FAULTS = {
+    "latency": 0.0,          # seconds added to every response
+    "jitter": 0.0,           # extra uniformly distributed delay, seconds
+    "loss_rate": 0.0,        # fraction of requests that never get a response
+    "exception_rate": 0.0,   # fraction of requests answered with an exception response
+    "exception_code": ExceptionResponse.SLAVE_BUSY,
+}
+
+# Datastore of each read function code
+STORES = {1: "c", 2: "d", 3: "h", 4: "i"}
+
+# ----------------------
+# Register images
+# ----------------------
+def build_register_images(register_map):
+    """
+    Builds one register image per device type and store, covering the full address span of
+    its register map so every read block a plan can produce is answerable.
+
+    Returns:
+        dict: {device_type_id: {store: (base_address, values)}} with store "h" (FC3), "i" (FC4),
+        "c" (FC1 coils) or "d" (FC2 discrete inputs).
+    """
+    images = {}
+    for type_id, regs in group_registers_by_type(register_map).items():
+        spans = defaultdict(list)
+        for reg in regs:
+            spans[STORES.get(int(reg.get("function_code", 3)), "h")].append(reg)
+        images[type_id] = {}
+        for store, store_regs in spans.items():
+            base = min(r["address"] for r in store_regs)
+            end = max(r["address"] + r["quantity"] for r in store_regs)
+            # Deterministic, non-zero values so decoding is exercised
+            if store in ("c", "d"):
+                values = [bool((address * 31 + 7) & 0x10) for address in range(base, end)]
+            else:
+                values = [(address * 31 + 7) & 0xFFFF for address in range(base, end)]
+            images[type_id][store] = (base, values)
+    return images
+
+class SimulatedSlave(ModbusBaseSlaveContext):
+    """A virtual slave serving a (shared, copy-on-write) register image with injected faults."""
+
+    def __init__(self, image, faults, rng):
+        self.store = image
+        self.faults = faults
+        self.rng = rng
+        self.owns_store = False
+
+    def reset(self):
+        pass
+
+    async def async_getValues(self, fc_as_hex, address, count=1):
+        delay = self.faults["latency"] + self.rng.uniform(0, self.faults["jitter"])
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.faults["loss_rate"] and self.rng.random() < self.faults["loss_rate"]:
+            # With ignore_missing_slaves the server sends nothing and the client times out
+            raise NoSuchSlaveException("simulated packet loss")
+        if self.faults["exception_rate"] and self.rng.random() < self.faults["exception_rate"]:
+            return self.faults["exception_code"]
+        return self.getValues(fc_as_hex, address, count)
+
+    def getValues(self, fc_as_hex, address, count=1):
+        base, values = self.store.get(self.decode(fc_as_hex), (0, []))
+        offset = address - base
+        if offset < 0 or offset + count > len(values):
+            return ExceptionResponse.ILLEGAL_ADDRESS
+        return values[offset:offset + count]
+
+    def setValues(self, fc_as_hex, address, values):
+        store = self.decode(fc_as_hex)
+        if store not in self.store:
+            return ExceptionResponse.ILLEGAL_ADDRESS
+        if not self.owns_store:
+            self.store = {k: (base, list(v)) for k, (base, v) in self.store.items()}
+            self.owns_store = True
+        base, image = self.store[store]
+        offset = address - base
+        if offset < 0 or offset + len(values) > len(image):
+            return ExceptionResponse.ILLEGAL_ADDRESS
+        image[offset:offset + len(values)] = values
+        return None
+
+class PipelinedRequestHandler(ServerRequestHandler):
+    """
+    pymodbus's handler decodes one frame per read and answers through shared state, so requests
+    sent back to back on one connection are dropped. This one works on every frame concurrently
+    and answers in request order, like a gateway that accepts several outstanding transactions.
+    """
+
+    previous = None
+
+    def callback_data(self, data, addr=None):
+        used = 0
+        while used < len(data):
+            cut = TransactionManager.callback_data(self, data[used:], addr)
+            if not cut:
+                break
+            used += cut
+            if self.last_pdu:
+                self.previous = self.loop.create_task(self.answer(self.last_pdu, addr, self.previous))
+        return used
+
+    async def answer(self, pdu, addr, previous):
+        response = await self.respond(pdu)
+        if previous is not None:
+            await previous
+        if response is not None:
+            response.transaction_id = pdu.transaction_id
+            response.dev_id = pdu.dev_id
+            self.server_send(response, addr)
+
+    async def respond(self, pdu):
+        try:
+            response = await pdu.update_datastore(self.server.context[pdu.dev_id])
+        except NoSuchSlaveException:
+            if self.server.ignore_missing_slaves:
+                return None
+            response = ExceptionResponse(0x00, ExceptionResponse.GATEWAY_NO_RESPONSE)
+        except Exception:
+            response = ExceptionResponse(0x00, ExceptionResponse.SLAVE_FAILURE)
+        return response
+
+class PipelinedTcpServer(ModbusTcpServer):
+    def callback_new_connection(self):
+        return PipelinedRequestHandler(self, self.trace_packet, self.trace_pdu, self.trace_connect)
+
+# ----------------------
+# Device map
+# ----------------------
+def simulated_device_map(n_devices, register_map, host="127.0.0.1", base_port=5020, units_per_port=MAX_UNITS_PER_PORT):
+    """
+    Generates device map rows (same shape as parse_device_map) for n virtual devices, cycling
+    through the device types in the register map and spreading them over consecutive ports,
+    one simulated gateway per port.
+    """
+    units_per_port = min(units_per_port, MAX_UNITS_PER_PORT)
+    type_ids = sorted(group_registers_by_type(register_map))
+    devices = []
+    for i in range(n_devices):
+        port = base_port + i // units_per_port
+        unit_id = i % units_per_port + 1
+        type_id = type_ids[i % len(type_ids)]
+        devices.append({
+            "device_id": i + 1,
+            "slave_id": unit_id,
+            "device_name": f"Sim {type_id}-{i + 1}",
+            "device_type_id": type_id,
+            "address": host,
+            "port_baudRate": str(port),
+            "protocol": "TCP",
+            "byte_swap": "none"
+        })
+    return devices
+
+def write_device_map(devices, path):
+    fields = ["device_id", "slave_id", "device_name", "device_type_id", "address", "port_baudRate", "protocol", "byte_swap"]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(devices)
+
+# ----------------------
+# Server
+# ----------------------
+async def serve(devices, register_map, faults=None, seed=0, pipelined=False):
+    """
+    Serves the given simulated devices, one pymodbus TCP server per (host, port). With pipelined,
+    gateways answer concurrent transactions; otherwise they behave like pymodbus (one at a time).
+    """
+    faults = dict(DEFAULT_FAULTS, **(faults or {}))
+    images = build_register_images(register_map)
+    rng = random.Random(seed)
+
+    slaves_by_endpoint = defaultdict(dict)
+    for device in devices:
+        endpoint = (device["address"], int(device["port_baudRate"]))
+        image = images.get(device["device_type_id"], {})
+        slaves_by_endpoint[endpoint][int(device["slave_id"])] = SimulatedSlave(image, faults, rng)
+
+    servers = []
+    for endpoint, slaves in slaves_by_endpoint.items():
+        context = ModbusServerContext(slaves=slaves, single=False)
+        server_class = PipelinedTcpServer if pipelined else ModbusTcpServer
+        servers.append(server_class(context, address=endpoint, ignore_missing_slaves=True))
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+def run_simulator(devices, register_map, faults=None, seed=0, pipelined=False):
+    asyncio.run(serve(devices, register_map, faults, seed, pipelined))
+
+def start_simulator_processes(devices, register_map, faults=None, seed=0, processes=1, timeout=30, pipelined=False):
+    """
+    Starts the simulator in separate processes (so it does not compete with the poller for the GIL),
+    splitting the simulated gateways over them, and waits until every endpoint accepts connections.
+
+    Returns:
+        list: The started processes; terminate them to stop the simulator.
+    """
+    by_endpoint = defaultdict(list)
+    for device in devices:
+        by_endpoint[(device["address"], int(device["port_baudRate"]))].append(device)
+    endpoints = sorted(by_endpoint)
+    groups = [endpoints[i::processes] for i in range(min(processes, len(endpoints)))]
+
+    started = []
+    for i, group in enumerate(groups):
+        group_devices = [device for endpoint in group for device in by_endpoint[endpoint]]
+        process = multiprocessing.Process(target=run_simulator, args=(group_devices, register_map, faults, seed + i, pipelined), daemon=True)
+        process.start()
+        started.append(process)
+
+    deadline = time.monotonic() + timeout
+    for endpoint in endpoints:
+        while True:
+            try:
+                socket.create_connection(endpoint, timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or not all(p.is_alive() for p in started):
+                    for process in started:
+                        process.terminate()
+                    raise RuntimeError(f"Simulator did not start listening on {endpoint[0]}:{endpoint[1]}")
+                time.sleep(0.05)
+    return started
+
+# ----------------------
+# MQTT stand-in
+# ----------------------
+class LoopbackMqttClient:
+    """
+    Stands in for the AWS IoT MQTT5 client on the publish path: accepts PublishPackets,
+    optionally delays the acknowledgement, and counts messages and bytes.
+    """
+
+    def __init__(self, ack_latency=0.0):
+        self.ack_latency = ack_latency
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, packet):
+        if self.ack_latency:
+            time.sleep(self.ack_latency)
+        self.messages += 1
+        self.bytes += len(packet.payload or b"")
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def stop(self):
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run simulated Modbus TCP slaves from the register map.")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--units-per-port", type=int, default=MAX_UNITS_PER_PORT)
+    parser.add_argument("--register-map", default="data/register_map.csv")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--loss-rate", type=float, default=0.0)
+    parser.add_argument("--exception-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pipelined", action="store_true", help="Answer several outstanding transactions per connection")
+    parser.add_argument("--write-device-map", help="Write a device_map.csv pointing at the simulated slaves")
+    args = parser.parse_args()
+
+    register_map = parse_register_map(args.register_map)
+    devices = simulated_device_map(args.devices, register_map, args.host, args.port, args.units_per_port)
+    if args.write_device_map:
+        write_device_map(devices, args.write_device_map)
+        print(f"Wrote {len(devices)} devices to {args.write_device_map}")
+    faults = {"latency": args.latency, "jitter": args.jitter, "loss_rate": args.loss_rate, "exception_rate": args.exception_rate}
+    print(f"Serving {len(devices)} simulated devices on {args.host}:{args.port}+")
+    run_simulator(devices, register_map, faults, args.seed, args.pipelined)
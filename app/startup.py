@@ -0,0 +1,52 @@
+# app/startup.py
+
+import threading
+import time
+from app.logger import logger
+
+# Reference point for startup timings; reset by main() once the process starts.
+start_time = time.monotonic()
+startup_marks = {}
+marks_lock = threading.Lock()
+
+def reset_clock():
+    global start_time
+    with marks_lock:
+        start_time = time.monotonic()
+        startup_marks.clear()
+
+def mark(event):
+    """Record the first time a startup milestone is reached (e.g. first poll, first HTTP response)."""
+    with marks_lock:
+        if event in startup_marks:
+            return
+        elapsed_ms = (time.monotonic() - start_time) * 1000
+        startup_marks[event] = elapsed_ms
+    logger.info(f"Startup: {event} after {elapsed_ms:.0f} ms")
+
+def get_timings():
+    with marks_lock:
+        return dict(startup_marks)
+
+def start_background(name, func, *args, retry_delay=2, max_delay=60):
+    """
+    Runs func(*args) in a daemon thread, retrying with exponential backoff until it succeeds.
+    Used for network-bound initialization (MQTT, CloudWatch) so it never delays polling or the dashboard.
+    """
+    def runner():
+        delay = retry_delay
+        attempt = 1
+        while True:
+            try:
+                func(*args)
+                mark(f"{name}_ready")
+                return
+            except Exception as e:
+                logger.warning(f"{name} initialization failed (attempt {attempt}): {e}. Retrying in {delay}s")
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+                attempt += 1
+
+    thread = threading.Thread(target=runner, name=f"{name}-init", daemon=True)
+    thread.start()
+    return thread
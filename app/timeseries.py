@@ -0,0 +1,409 @@
+# app/timeseries.py
+#
+# On-device time-series store: raw values plus 1m/15m/1h min/max/avg rollups in append-only
+# float64 segment files per device and resolution (<path>/<device_key>/<resolution>-<start>-<hash>.ts).
+
+import bisect
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from app import clock
+from app.read_plan import flat_registers
+from app.logger import logger
+
+RESOLUTIONS = ("raw", "1m", "15m", "1h")
+STEPS = {"1m": 60, "15m": 900, "1h": 3600}
+# Each rollup is aggregated from the next finer resolution
+SOURCES = {"1m": "raw", "15m": "1m", "1h": "15m"}
+SEGMENT_SPANS = {"raw": 3600, "1m": 86400, "15m": 7 * 86400, "1h": 28 * 86400}
+DEFAULT_RETENTION = {"raw": 2 * 86400, "1m": 14 * 86400, "15m": 90 * 86400, "1h": 730 * 86400}
+DEFAULT_PATH = "data/timeseries"
+
+def record_width(resolution, slot_count):
+    """Number of float64 columns in one record of the given resolution."""
+    return 1 + (slot_count if resolution == "raw" else 4 * slot_count)
+
+class Segment:
+    """Read-only mmap view of one segment file; only whole records are visible."""
+
+    def __init__(self, path, width):
+        self.width = width
+        self.mm = None
+        self.rows = 0
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= 8 * width:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.rows = size // (8 * width)
+        if self.mm is not None:
+            self.data = memoryview(self.mm)[:self.rows * 8 * width].cast("d")
+            self.timestamps = self.data[0::width]
+
+    def column(self, index):
+        return self.data[index::self.width]
+
+    def row(self, i):
+        return self.data[i * self.width:(i + 1) * self.width].tolist()
+
+    def range(self, start, end):
+        """Row indexes with start <= timestamp < end."""
+        if not self.rows:
+            return range(0)
+        return range(bisect.bisect_left(self.timestamps, start), bisect.bisect_left(self.timestamps, end))
+
+    def close(self):
+        if self.mm is not None:
+            self.timestamps.release()
+            self.data.release()
+            self.mm.close()
+            self.mm = None
+
+class DeviceSeries:
+    """Layout, open rollup buckets and the write lock of one device."""
+
+    def __init__(self, device_key, slots):
+        self.device_key = device_key
+        self.slots = slots
+        self.slot_index = {(slot["address"], slot["variable_name"]): i for i, slot in enumerate(slots)}
+        self.hash = hashlib.sha1(json.dumps(slots, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        # resolution -> [bucket_start, mins, maxs, sums, counts]
+        self.buckets = {}
+        # resolution -> (path, unbuffered append handle) of the segment being written
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def close_files(self):
+        for _, f in self.files.values():
+            f.close()
+        self.files = {}
+
+class TimeSeriesStore:
+    """
+    Append-only time-series store for polled values.
+
+    Args:
+        path: Root directory of the store.
+        retention: Seconds to keep per resolution; missing entries use DEFAULT_RETENTION.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, retention=None):
+        self.path = path
+        self.retention = dict(DEFAULT_RETENTION, **(retention or {}))
+        self.devices = {}
+        self.poll_interval = 5
+        self.structs = {}
+
+    # ----------------------
+    # Configuration
+    # ----------------------
+    def configure(self, device_map, read_plans, poll_interval=5):
+        """Registers the current devices and their slot layouts, recovering open rollup buckets."""
+        self.poll_interval = poll_interval
+        devices = {}
+        now = clock.now()
+        for device in device_map:
+            device_key = f"{device['device_id']}_{device['slave_id']}"
+            registers = flat_registers(read_plans.get(device['device_type_id'], []))
+            slots = [{"variable_name": r['variable_name'], "address": r['address'], "unit": r.get('unit', "")} for r in registers]
+            series = self.devices.get(device_key)
+            if series is not None and series.slots == slots:
+                devices[device_key] = series
+                continue
+            if series is not None:
+                # Layout changed: close the old layout's buckets so they are not lost
+                with series.lock:
+                    self.flush(series, math.inf)
+                    series.close_files()
+            series = DeviceSeries(device_key, slots)
+            directory = os.path.join(self.path, device_key)
+            os.makedirs(directory, exist_ok=True)
+            layout_path = os.path.join(directory, f"layout-{series.hash}.json")
+            if not os.path.exists(layout_path):
+                with open(f"{layout_path}.tmp", "w") as f:
+                    json.dump(slots, f)
+                os.replace(f"{layout_path}.tmp", layout_path)
+            self.recover(series, now)
+            devices[device_key] = series
+        for device_key, series in self.devices.items():
+            if device_key not in devices:
+                with series.lock:
+                    series.close_files()
+        self.devices = devices
+
+    def recover(self, series, now):
+        """
+        Rebuilds each rollup's open bucket, and any buckets closed while the process was down,
+        from the finer resolution on disk. Only records newer than the last written bucket are read.
+        """
+        # Buckets closed here are not cascaded: the next resolution re-reads them from disk
+        for resolution in STEPS:
+            step = STEPS[resolution]
+            last = self.last_timestamp(series, resolution)
+            since = last + step if last is not None else math.floor(now / step) * step
+            for row in self.rows(series, SOURCES[resolution], since, math.inf):
+                self.add_to_bucket(series, resolution, row, SOURCES[resolution] == "raw", cascade=False)
+            self.flush(series, now, resolutions=(resolution,), cascade=False)
+
+    # ----------------------
+    # Writing
+    # ----------------------
+    def write_device(self, device_key, values, timestamp=None):
+        """Appends one poll of a device (values in slot order, NaN for missing) and folds it into the rollups."""
+        series = self.devices.get(device_key)
+        if series is None or len(values) != len(series.slots):
+            return
+        if timestamp is None:
+            timestamp = clock.now()
+        row = [timestamp] + values
+        with series.lock:
+            self.append(series, "raw", row)
+            self.add_to_bucket(series, "1m", row, True)
+
+    def add_to_bucket(self, series, resolution, row, raw, cascade=True):
+        """Adds a raw row or a finer rollup row to the open bucket, closing the bucket it ends."""
+        step = STEPS[resolution]
+        bucket_start = math.floor(row[0] / step) * step
+        bucket = series.buckets.get(resolution)
+        if bucket is not None and bucket[0] != bucket_start:
+            self.close_bucket(series, resolution, cascade)
+            bucket = None
+        if bucket is None:
+            n = len(series.slots)
+            bucket = series.buckets[resolution] = [bucket_start, [math.inf] * n, [-math.inf] * n, [0.0] * n, [0.0] * n]
+        _, mins, maxs, sums, counts = bucket
+        for i in range(len(series.slots)):
+            if raw:
+                value = row[1 + i]
+                if value != value:
+                    continue
+                low = high = total = value
+                count = 1
+            else:
+                low, high, total, count = row[1 + 4 * i:5 + 4 * i]
+                if not count:
+                    continue
+            if low < mins[i]:
+                mins[i] = low
+            if high > maxs[i]:
+                maxs[i] = high
+            sums[i] += total
+            counts[i] += count
+
+    def close_bucket(self, series, resolution, cascade=True):
+        bucket_start, mins, maxs, sums, counts = series.buckets.pop(resolution)
+        row = [bucket_start]
+        for i in range(len(series.slots)):
+            if counts[i]:
+                row.extend((mins[i], maxs[i], sums[i], counts[i]))
+            else:
+                row.extend((math.nan, math.nan, 0.0, 0.0))
+        self.append(series, resolution, row)
+        if cascade and resolution in SOURCES.values():
+            coarser = next(r for r, source in SOURCES.items() if source == resolution)
+            self.add_to_bucket(series, coarser, row, False)
+
+    def flush(self, series, now, resolutions=tuple(STEPS), cascade=True):
+        """Closes open buckets that ended before now, finest first so they cascade."""
+        for resolution in resolutions:
+            bucket = series.buckets.get(resolution)
+            if bucket is not None and bucket[0] + STEPS[resolution] <= now:
+                self.close_bucket(series, resolution, cascade)
+
+    def segment_path(self, series, resolution, timestamp):
+        span = SEGMENT_SPANS[resolution]
+        start = int(timestamp // span * span)
+        return os.path.join(self.path, series.device_key, f"{resolution}-{start}-{series.hash}.ts")
+
+    def append(self, series, resolution, row):
+        width = len(row)
+        record = self.structs.get(width)
+        if record is None:
+            record = self.structs[width] = struct.Struct(f"<{width}d")
+        path = self.segment_path(series, resolution, row[0])
+        current = series.files.get(resolution)
+        if current is None or current[0] != path:
+            # Segment rollover: later rows go to the new file
+            if current is not None:
+                current[1].close()
+            # Unbuffered so each record reaches the file, and the readers' mmaps, in one write
+            f = open(path, "ab", buffering=0)
+            # A crash mid-write leaves a partial record; drop it so rows stay aligned
+            size = f.tell()
+            if size % record.size:
+                f.truncate(size - size % record.size)
+                f.seek(0, os.SEEK_END)
+            current = series.files[resolution] = (path, f)
+        current[1].write(record.pack(*row))
+
+    # ----------------------
+    # Reading
+    # ----------------------
+    def segments(self, series, resolution, start, end):
+        """Segment paths of the current layout that may hold timestamps in [start, end), oldest first."""
+        directory = os.path.join(self.path, series.device_key)
+        span = SEGMENT_SPANS[resolution]
+        found = []
+        for name in os.listdir(directory):
+            parts = name[:-3].split("-") if name.endswith(".ts") else []
+            if len(parts) != 3 or parts[0] != resolution or parts[2] != series.hash:
+                continue
+            segment_start = int(parts[1])
+            if segment_start < end and segment_start + span > start:
+                found.append((segment_start, os.path.join(directory, name)))
+        return [path for _, path in sorted(found)]
+
+    def rows(self, series, resolution, start, end):
+        width = record_width(resolution, len(series.slots))
+        for path in self.segments(series, resolution, start, end):
+            segment = Segment(path, width)
+            try:
+                for i in segment.range(start, end):
+                    yield segment.row(i)
+            finally:
+                segment.close()
+
+    def last_timestamp(self, series, resolution):
+        width = record_width(resolution, len(series.slots))
+        for path in reversed(self.segments(series, resolution, 0, math.inf)):
+            segment = Segment(path, width)
+            try:
+                if segment.rows:
+                    return segment.timestamps[segment.rows - 1]
+            finally:
+                segment.close()
+        return None
+
+    def pick_resolution(self, start, end, max_points):
+        """The finest resolution that still covers start and returns at most max_points per series."""
+        now = clock.now()
+        for resolution in RESOLUTIONS:
+            step = STEPS.get(resolution, self.poll_interval)
+            if (end - start) / step <= max_points and now - start <= self.retention[resolution]:
+                return resolution
+        return RESOLUTIONS[-1]
+
+    def query(self, device_key, address, variable_name, start, end, resolution=None, max_points=1000):
+        """
+        Returns the history of one register.
+
+        Returns:
+            dict: {"resolution", "points"}; raw points are [timestamp, value], rollup points are
+            [bucket_start, min, max, avg].
+        """
+        series = self.devices.get(device_key)
+        if series is None:
+            raise KeyError(f"Unknown device {device_key}")
+        index = series.slot_index.get((address, variable_name))
+        if index is None:
+            raise KeyError(f"Unknown register {variable_name} at {address} on {device_key}")
+        resolution = resolution or self.pick_resolution(start, end, max_points)
+        width = record_width(resolution, len(series.slots))
+
+        points = []
+        for path in self.segments(series, resolution, start, end):
+            segment = Segment(path, width)
+            try:
+                rows = segment.range(start, end)
+                if not rows:
+                    continue
+                timestamps = segment.timestamps[rows.start:rows.stop].tolist()
+                if resolution == "raw":
+                    values = segment.column(1 + index)[rows.start:rows.stop].tolist()
+                    points.extend([t, v] for t, v in zip(timestamps, values) if v == v)
+                else:
+                    base = 1 + 4 * index
+                    mins, maxs, sums, counts = (segment.column(base + k)[rows.start:rows.stop].tolist() for k in range(4))
+                    points.extend(
+                        [t, low, high, total / count]
+                        for t, low, high, total, count in zip(timestamps, mins, maxs, sums, counts) if count
+                    )
+            finally:
+                segment.close()
+        if resolution != "raw":
+            # Include the bucket still being aggregated, plus the finer open buckets not yet folded into it
+            step = STEPS[resolution]
+            with series.lock:
+                chain = []
+                for finer in STEPS:
+                    bucket = series.buckets.get(finer)
+                    if bucket is not None and bucket[4][index]:
+                        chain.append((math.floor(bucket[0] / step) * step, bucket))
+                    if finer == resolution:
+                        break
+                if chain:
+                    current = max(bucket_start for bucket_start, _ in chain)
+                    chain = [bucket for bucket_start, bucket in chain if bucket_start == current]
+                    count = sum(bucket[4][index] for bucket in chain)
+                    if start <= current < end:
+                        points.append([
+                            current,
+                            min(bucket[1][index] for bucket in chain),
+                            max(bucket[2][index] for bucket in chain),
+                            sum(bucket[3][index] for bucket in chain) / count
+                        ])
+        return {"resolution": resolution, "points": points}
+
+    def close(self):
+        """Closes the open segment files; the next write reopens them."""
+        for series in list(self.devices.values()):
+            with series.lock:
+                series.close_files()
+
+    # ----------------------
+    # Maintenance
+    # ----------------------
+    def maintain(self, now=None):
+        """Closes finished buckets of devices that stopped reporting and deletes expired segments."""
+        if now is None:
+            now = clock.now()
+        removed = 0
+        for series in list(self.devices.values()):
+            with series.lock:
+                self.flush(series, now)
+        for device_key in os.listdir(self.path):
+            directory = os.path.join(self.path, device_key)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                parts = name[:-3].split("-") if name.endswith(".ts") else []
+                if len(parts) != 3 or parts[0] not in SEGMENT_SPANS:
+                    continue
+                if int(parts[1]) + SEGMENT_SPANS[parts[0]] < now - self.retention[parts[0]]:
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+        if removed:
+            logger.info(f"Time-series retention removed {removed} expired segments.")
+        return removed
+
+# Process-wide store, enabled by settings.json "timeseries"
+store = None
+
+def configure(settings, device_map, read_plans):
+    global store
+    options = settings.get("timeseries", {})
+    if not options.get("enabled", False):
+        if store is not None:
+            store.close()
+        store = None
+        return
+    if store is None or store.path != options.get("path", DEFAULT_PATH):
+        if store is not None:
+            store.close()
+        store = TimeSeriesStore(options.get("path", DEFAULT_PATH), options.get("retention"))
+    else:
+        store.retention = dict(DEFAULT_RETENTION, **options.get("retention", {}))
+    store.configure(device_map, read_plans, settings.get("poll_interval", settings.get("polling_interval", 5)))
+
+def run_maintenance(interval=60):
+    while True:
+        time.sleep(interval)
+        if store is not None:
+            try:
+                store.maintain()
+            except Exception as e:
+                logger.error(f"Time-series maintenance failed: {e}")
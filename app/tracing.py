@@ -0,0 +1,198 @@
+# app/tracing.py
+#
+# Stage tracing (span(), exported as Chrome trace-event JSON) and a sampling profiler producing folded stacks.
+
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+DEFAULT_MAX_EVENTS = 200000
+MAX_EVENTS_LIMIT = 1000000
+# Longest profile() run; only one runs at a time
+MAX_PROFILE_SECONDS = 60
+
+enabled = False
+events = deque(maxlen=DEFAULT_MAX_EVENTS)
+# Original handle() of log handlers wrapped while tracing is on
+traced_handlers = {}
+state_lock = threading.Lock()
+profile_lock = threading.Lock()
+
+class ProfilerBusy(Exception):
+    pass
+
+class Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        events.append((self.name, self.start, end - self.start, threading.current_thread().name, self.args))
+        return False
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def span(name, **args):
+    """Context manager timing one stage; args are shown with the event in the trace viewer."""
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, args)
+
+def traced(name):
+    """Decorator running the whole function inside span(name)."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class acquire:
+    """Acquires a lock (or any context manager) inside a "lock_wait" span and holds it for the with block."""
+
+    __slots__ = ("lock", "args")
+
+    def __init__(self, lock, **args):
+        self.lock = lock
+        self.args = args
+
+    def __enter__(self):
+        with span("lock_wait", **self.args):
+            self.lock.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self.lock.__exit__(exc_type, exc, tb)
+
+# ----------------------
+# Switching on and off
+# ----------------------
+def traced_handle(handler, handle):
+    def handle_with_span(record):
+        with span("log", handler=type(handler).__name__, level=record.levelname):
+            return handle(record)
+    return handle_with_span
+
+def start(max_events=DEFAULT_MAX_EVENTS, logger_name="modbus"):
+    """Starts recording spans, including time spent in the logger's handlers."""
+    global enabled, events
+    with state_lock:
+        if enabled:
+            return
+        events = deque(maxlen=max_events)
+        for handler in logging.getLogger(logger_name).handlers:
+            traced_handlers[handler] = handler.__dict__.get("handle")
+            handler.handle = traced_handle(handler, handler.handle)
+        enabled = True
+
+def stop():
+    """Stops recording and returns the Chrome trace of everything recorded since start()."""
+    global enabled
+    with state_lock:
+        enabled = False
+        for handler, handle in traced_handlers.items():
+            if handle is None:
+                del handler.handle
+            else:
+                handler.handle = handle
+        traced_handlers.clear()
+    return export()
+
+# ----------------------
+# Export
+# ----------------------
+def export(since_ns=0):
+    """Recorded spans (optionally only those starting after since_ns) as a Chrome trace-event document."""
+    pid = os.getpid()
+    thread_ids = {}
+    trace_events = []
+    for name, start_ns, duration_ns, thread_name, args in list(events):
+        if start_ns < since_ns:
+            continue
+        tid = thread_ids.setdefault(thread_name, len(thread_ids) + 1)
+        trace_events.append({
+            "name": name,
+            "cat": "stage",
+            "ph": "X",
+            "ts": start_ns / 1000,
+            "dur": duration_ns / 1000,
+            "pid": pid,
+            "tid": tid,
+            "args": args
+        })
+    for thread_name, tid in thread_ids.items():
+        trace_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}})
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+def write(path, since_ns=0):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(export(since_ns), f)
+    return path
+
+# ----------------------
+# Sampling profiler
+# ----------------------
+def profile(seconds, interval=0.005):
+    """
+    Samples the Python stack of every other thread every `interval` seconds for `seconds`
+    (at most MAX_PROFILE_SECONDS).
+
+    Returns:
+        str: Folded stacks, "thread;outer (file:line);...;inner (file:line) samples" per line,
+        most frequent first.
+
+    Raises:
+        ProfilerBusy: If another profile is running.
+    """
+    if not profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        return sample_stacks(min(seconds, MAX_PROFILE_SECONDS), interval)
+    finally:
+        profile_lock.release()
+
+def sample_stacks(seconds, interval):
+    samples = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in samples.most_common()) + "\n"
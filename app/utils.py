@@ -1,10 +1,10 @@
 import struct
 
 def apply_byte_order(raw_values, data_type, swap_bytes):
-    # Combine registers into bytes
-    if swap_bytes == "word":
+    # Combine registers into bytes; word order only matters for values spanning several registers
+    if swap_bytes == "word" and len(raw_values) > 1:
         raw_values = [raw_values[i ^ 1] for i in range(len(raw_values))]
-    elif swap_bytes == "both":
+    elif swap_bytes == "both" and len(raw_values) > 1:
         raw_values = [raw_values[i ^ 1] for i in range(len(raw_values))]
         raw_values.reverse()
 
@@ -26,3 +26,34 @@ def apply_byte_order(raw_values, data_type, swap_bytes):
             return int.from_bytes(byte_array, byteorder='big')  # fallback
     except Exception as e:
         return f"decode error: {e}"
+
+def pack_bits(bits):
+    """Coil/input states packed eight to a byte, first bit in the least significant position (Modbus wire order)."""
+    packed = bytearray((len(bits) + 7) // 8)
+    for i, bit in enumerate(bits):
+        if bit:
+            packed[i >> 3] |= 1 << (i & 7)
+    return bytes(packed)
+
+def unpack_bits(packed, count):
+    """Inverse of pack_bits: the first `count` bits as booleans."""
+    return [bool(packed[i >> 3] >> (i & 7) & 1) for i in range(count)]
+
+def encode_value(value, data_type, quantity, swap_bytes):
+    """
+    Inverse of apply_byte_order: the register words holding `value` (already scaled to its raw
+    integer) as `data_type` in `quantity` registers. Raises OverflowError if it does not fit.
+    """
+    if data_type == "FLOAT":
+        byte_array = struct.pack(">f", value)
+    else:
+        byte_array = int(value).to_bytes(2 * quantity, byteorder='big', signed=data_type.startswith("I"))
+    raw_values = [int.from_bytes(byte_array[i:i + 2], byteorder='big') for i in range(0, len(byte_array), 2)]
+
+    # Word order only matters for values spanning several registers
+    if swap_bytes == "word" and quantity > 1:
+        raw_values = [raw_values[i ^ 1] for i in range(len(raw_values))]
+    elif swap_bytes == "both" and quantity > 1:
+        raw_values.reverse()
+        raw_values = [raw_values[i ^ 1] for i in range(len(raw_values))]
+    return raw_values
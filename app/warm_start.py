@@ -0,0 +1,155 @@
+# app/warm_start.py
+#
+# Warm restart: device records, learned serial gateways and compiled read plans saved periodically
+# and restored on startup, the values marked stale until each device is polled again.
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from app import connections
+from app import modbus_reader
+from app import startup
+from app.csv_parser import parse_register_map, parse_device_map
+from app.logger import logger
+
+VERSION = 2
+DEFAULT_PATH = "state/warm_start.pkl"
+DEFAULT_INTERVAL = 30
+
+# Settings "warm_start" block as loaded at startup
+options = {}
+# Digest of the configuration files loaded at startup, and the maps and plans built from them.
+# This is the plan cache that is saved; after a live config reload it is simply not reused next time.
+config_digest = None
+cached_config = None
+
+def config_file_digest(settings, register_map_path, device_map_path):
+    """Digest of everything the parsed maps and read plans depend on."""
+    digest = hashlib.sha256()
+    for path in (register_map_path, device_map_path):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+        digest.update(b"\0")
+    digest.update(str(settings.get("max_registers", 100)).encode())
+    return digest.hexdigest()
+
+def layout_signature(layout):
+    return (layout.addresses, layout.variable_names)
+
+def read_state(path):
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable warm start file {path}: {e}")
+        return None
+    if not isinstance(state, dict) or state.get("version") != VERSION:
+        logger.warning(f"Ignoring warm start file {path} from another version")
+        return None
+    return state
+
+def load_config(settings_path=modbus_reader.SETTINGS_FILE,
+                register_map_path=modbus_reader.REGISTER_MAP_FILE,
+                device_map_path=modbus_reader.DEVICE_MAP_FILE):
+    """
+    modbus_reader.load_config() with warm start: reuses the cached maps and read plans when the
+    configuration files are unchanged and restores the last saved records.
+
+    Returns:
+        dict: The loaded settings.
+    """
+    global options, config_digest, cached_config
+    with open(settings_path) as f:
+        settings = json.load(f)
+    options = settings.get("warm_start", {})
+    if not options.get("enabled", False):
+        modbus_reader.configure(settings, parse_register_map(register_map_path), parse_device_map(device_map_path))
+        return settings
+
+    state = read_state(options.get("path", DEFAULT_PATH))
+    config_digest = config_file_digest(settings, register_map_path, device_map_path)
+    if state is not None and state["config_digest"] == config_digest:
+        register_map, device_map, read_plans = state["register_map"], state["device_map"], state["read_plans"]
+        logger.info("Warm start: configuration unchanged, reusing the compiled read plans.")
+    else:
+        register_map, device_map, read_plans = parse_register_map(register_map_path), parse_device_map(device_map_path), None
+    modbus_reader.configure(settings, register_map, device_map, read_plans)
+    cached_config = (register_map, device_map, modbus_reader.read_plans)
+    if state is not None:
+        restore(state)
+    return settings
+
+def restore(state):
+    """Loads saved records into devices whose register layout is unchanged, marked stale."""
+    signatures = state["layouts"]
+    restored = 0
+    with modbus_reader.data_lock:
+        for device_key, (layout_number, record_state) in state["records"].items():
+            record = modbus_reader.device_data.get(device_key)
+            if record is None or layout_signature(record.layout) != signatures[layout_number]:
+                continue
+            if record.load_state(record_state, stale=True):
+                restored += 1
+    connections.serial_gateways.update(state["serial_gateways"])
+    age = time.time() - state["saved_at"]
+    logger.info(f"Warm start: restored last-known values of {restored} devices, saved {age:.0f}s ago.")
+    startup.mark("snapshot_restored")
+
+def save(path=None):
+    """Writes the current records, learned gateway modes and the startup plan cache."""
+    if config_digest is None:
+        return
+    path = path or options.get("path", DEFAULT_PATH)
+    with modbus_reader.data_lock:
+        records = list(modbus_reader.device_data.values())
+    layout_numbers = {}
+    signatures = []
+    saved_records = {}
+    for record in records:
+        if record.seq == 0:
+            # Never polled or restored
+            continue
+        number = layout_numbers.get(id(record.layout))
+        if number is None:
+            number = layout_numbers[id(record.layout)] = len(signatures)
+            signatures.append(layout_signature(record.layout))
+        saved_records[record.device_key] = (number, record.state())
+
+    register_map, device_map, read_plans = cached_config
+    state = {
+        "version": VERSION,
+        "saved_at": time.time(),
+        "config_digest": config_digest,
+        "register_map": register_map,
+        "device_map": device_map,
+        "read_plans": read_plans,
+        "layouts": signatures,
+        "records": saved_records,
+        "serial_gateways": sorted(connections.learned_serial_gateways())
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def run_saver(interval=DEFAULT_INTERVAL):
+    while True:
+        time.sleep(interval)
+        try:
+            save()
+        except Exception as e:
+            logger.error(f"Failed to save warm start state: {e}")
+
+def start_saver():
+    """Starts the periodic saver if warm start is enabled."""
+    if config_digest is None:
+        return None
+    thread = threading.Thread(target=run_saver, args=(options.get("interval", DEFAULT_INTERVAL),), name="warm-start", daemon=True)
+    thread.start()
+    return thread
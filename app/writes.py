@@ -0,0 +1,322 @@
+# app/writes.py
+#
+# Register writes. Requests from the HTTP API and MQTT are validated against the register map
+# and queued per device; the poller drains a device's queue on its pooled client ahead of its reads.
+
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from app import metrics
+from app.logger import logger
+from app.utils import encode_value
+
+WRITABLE_ACCESS = ("RW", "WO")
+WRITABLE_TYPES = ("U16", "I16", "U32", "I32", "FLOAT")
+# FC16 limit: 123 registers per request
+MAX_WRITE_REGISTERS = 123
+# Finished requests kept for status queries
+MAX_FINISHED = 1000
+
+class WriteError(Exception):
+    pass
+
+class WriteRequest:
+    """
+    One register write; `status` goes queued -> confirmed (read back), or written for write-only
+    registers, which devices usually refuse to read; or to failed/superseded.
+    """
+
+    def __init__(self, request_id, device_key, address, words, register=None, value=None, source="", write_only=None):
+        self.request_id = request_id
+        self.device_key = device_key
+        self.address = address
+        self.words = words
+        self.register = register
+        self.write_only = register["access"] == "WO" if write_only is None and register else bool(write_only)
+        self.value = value
+        self.source = source
+        self.created = time.time()
+        self.status = "queued"
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        metrics.WRITES.inc(result=status)
+        if status in ("confirmed", "written"):
+            metrics.WRITE_LATENCY.observe(time.time() - self.created)
+        self.done.set()
+
+    def result(self):
+        return {
+            "request_id": self.request_id,
+            "device": self.device_key,
+            "address": self.address,
+            "variable": self.register["variable_name"] if self.register else None,
+            "value": self.value,
+            "status": self.status,
+            "error": self.error
+        }
+
+def coalesce(requests):
+    """
+    Groups requests, given in submission order, into transactions: [(address, words, [requests])].
+    Write-only registers are usually commands (start, stop, reset) and go out alone, in submission
+    order. Between them, runs of adjacent read-write registers are merged in address order.
+    """
+    runs = []
+    segment = []
+    for request in requests + [None]:
+        if request is not None and not request.write_only:
+            segment.append(request)
+            continue
+        merged = []
+        for member in sorted(segment, key=lambda r: r.address):
+            if merged:
+                address, words, members = merged[-1]
+                if member.address == address + len(words) and len(words) + len(member.words) <= MAX_WRITE_REGISTERS:
+                    words.extend(member.words)
+                    members.append(member)
+                    continue
+            merged.append((member.address, list(member.words), [member]))
+        runs.extend(merged)
+        segment = []
+        if request is not None:
+            runs.append((request.address, list(request.words), [request]))
+    return runs
+
+class WriteQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = defaultdict(list)
+        self.requests = OrderedDict()
+        self.ids = itertools.count(1)
+        self.devices = {}
+        self.registers = {}
+        # Off unless settings "writes": {"enabled": true}
+        self.enabled = False
+        # Set when writes are queued; the poll loop waits on it between cycles
+        self.wake = threading.Event()
+
+    def configure(self, register_map, device_map, settings=None):
+        self.enabled = bool((settings or {}).get("writes", {}).get("enabled", False))
+        registers = defaultdict(lambda: {"by_address": {}, "by_name": defaultdict(list)})
+        for reg in register_map:
+            by_type = registers[reg["device_type_id"]]
+            by_type["by_address"][reg["address"]] = reg
+            by_type["by_name"][reg["variable_name"]].append(reg)
+        self.registers = dict(registers)
+        self.devices = {f"{d['device_id']}_{d['slave_id']}": d for d in device_map}
+        # Writes queued for devices that were removed would otherwise wait forever
+        for device_key in [key for key in list(self.pending) if key not in self.devices]:
+            self.fail(device_key, "Device is no longer configured")
+
+    # ----------------------
+    # Submitting
+    # ----------------------
+    def resolve(self, device_key, address=None, variable=None):
+        device = self.devices.get(device_key)
+        if device is None:
+            raise WriteError(f"Unknown device {device_key}")
+        by_type = self.registers.get(device["device_type_id"], {"by_address": {}, "by_name": {}})
+        if address is not None:
+            try:
+                address = int(address)
+            except (TypeError, ValueError):
+                raise WriteError(f"Invalid register address {address!r}")
+            reg = by_type["by_address"].get(address)
+            if reg is None:
+                raise WriteError(f"Device {device_key} has no register at address {address}")
+            return device, reg
+        candidates = by_type["by_name"].get(variable, [])
+        if not candidates:
+            raise WriteError(f"Device {device_key} has no variable {variable!r}")
+        if len(candidates) > 1:
+            raise WriteError(f"Variable {variable!r} is ambiguous on device {device_key}; "
+                             f"use one of the addresses {[reg['address'] for reg in candidates]}")
+        return device, candidates[0]
+
+    def build(self, device_key, value, address=None, variable=None, source=""):
+        """A validated, encoded WriteRequest (not yet queued). Raises WriteError."""
+        device, reg = self.resolve(device_key, address, variable)
+        name = f"{reg['variable_name']} ({reg['address']}) on {device_key}"
+        if reg["access"] not in WRITABLE_ACCESS:
+            raise WriteError(f"{name} is read-only")
+        if reg["function_code"] != 3:
+            raise WriteError(f"{name} is not a holding register")
+        if reg["type"] not in WRITABLE_TYPES:
+            raise WriteError(f"{name} has type {reg['type']}, which cannot be written")
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise WriteError(f"Value for {name} must be a finite number")
+        gain = float(reg.get("gain", 1))
+        try:
+            raw = value * gain if gain != 0 else value
+            if reg["type"] != "FLOAT":
+                raw = round(raw)
+            words = encode_value(raw, reg["type"], reg["quantity"], device.get("byte_swap", "none"))
+        except (OverflowError, ValueError):
+            raise WriteError(f"Value {value} is out of range for {name} ({reg['type']}, gain {reg.get('gain', 1)})")
+        return WriteRequest(f"w{next(self.ids)}", device_key, reg["address"], words, reg, value, source)
+
+    def submit(self, writes, source=""):
+        """
+        Validates and queues a batch of writes: [{"device": key | "device_type_id": id,
+        "address": n | "variable": name, "value": v}, ...]. A device_type_id fans out to every
+        device of that type. Nothing is queued if any write is invalid.
+
+        Returns:
+            list[WriteRequest]
+
+        Raises:
+            WriteError: For the first invalid write.
+        """
+        if not self.enabled:
+            raise WriteError("Register writes are disabled; set \"writes\": {\"enabled\": true} in settings.json")
+        if not isinstance(writes, list):
+            raise WriteError("Writes must be a list of objects")
+        requests = []
+        for write in writes:
+            if not isinstance(write, dict):
+                raise WriteError(f"Write {write!r} is not an object")
+            if "value" not in write:
+                raise WriteError(f"Write {write} has no value")
+            if "device" in write:
+                device_keys = [str(write["device"])]
+            elif "device_type_id" in write:
+                device_keys = [key for key, d in self.devices.items() if d["device_type_id"] == str(write["device_type_id"])]
+                if not device_keys:
+                    raise WriteError(f"No devices of type {write['device_type_id']}")
+            else:
+                raise WriteError(f"Write {write} names no device or device_type_id")
+            if write.get("address") is None and write.get("variable") is None:
+                raise WriteError(f"Write {write} names no address or variable")
+            for device_key in device_keys:
+                requests.append(self.build(device_key, write["value"], write.get("address"), write.get("variable"), source))
+
+        with self.lock:
+            for request in requests:
+                queue = self.pending[request.device_key]
+                # A newer value for the same register replaces a queued one
+                for old in [r for r in queue if r.address == request.address]:
+                    queue.remove(old)
+                    old.finish("superseded")
+                queue.append(request)
+                self.requests[request.request_id] = request
+            if len(self.requests) > MAX_FINISHED:
+                # Oldest finished requests first; queued ones stay until they finish
+                finished = [request_id for request_id, request in self.requests.items() if request.done.is_set()]
+                for request_id in finished[:len(self.requests) - MAX_FINISHED]:
+                    del self.requests[request_id]
+        if requests:
+            logger.info(f"Queued {len(requests)} register writes from {source or 'unknown source'}")
+            self.wake.set()
+        return requests
+
+    def get(self, request_id):
+        with self.lock:
+            return self.requests.get(request_id)
+
+    # ----------------------
+    # Executing (poller side)
+    # ----------------------
+    def has_pending(self, device_key):
+        return bool(self.pending.get(device_key))
+
+    def take(self, device_key):
+        with self.lock:
+            return self.pending.pop(device_key, [])
+
+    def fail(self, device_key, error):
+        """Fails a device's queued requests, e.g. when it cannot be reached."""
+        for request in self.take(device_key):
+            request.finish("failed", error)
+
+    def execute(self, client, device_key, unit_id):
+        """
+        Writes a device's queued requests over a connected client (see coalesce()) and reads the
+        read-write ones back; write-only registers are reported as written once the device accepts them.
+        """
+        requests = self.take(device_key)
+        for address, words, members in coalesce(requests):
+            function_code = 6 if len(words) == 1 else 16
+            try:
+                if function_code == 6:
+                    result = client.write_register(address, words[0], slave=unit_id)
+                else:
+                    result = client.write_registers(address, words, slave=unit_id)
+                metrics.WRITE_TRANSACTIONS.inc(function_code=function_code)
+                if result is None or result.isError():
+                    raise WriteError(f"FC {function_code} write at {address} rejected: {result}")
+                if members[0].write_only:
+                    members[0].finish("written")
+                    logger.info(f"Wrote write-only register {address} on {device_key} with FC {function_code}")
+                    continue
+                readback = client.read_holding_registers(address=address, count=len(words), slave=unit_id)
+                if readback is None or readback.isError():
+                    raise WriteError(f"Read-back of {address}+{len(words)} failed: {readback}")
+            except Exception as e:
+                logger.warning(f"Write of {len(words)} registers at {address} on {device_key} failed: {e}")
+                for request in members:
+                    request.finish("failed", str(e))
+                continue
+            for request in members:
+                offset = request.address - address
+                if list(readback.registers[offset:offset + len(request.words)]) == request.words:
+                    request.finish("confirmed")
+                else:
+                    request.finish("failed", "Read-back does not match the written value")
+            logger.info(f"Wrote {len(words)} registers at {address} on {device_key} with FC {function_code}")
+
+    # ----------------------
+    # Sharded polling: requests cross the process boundary as plain tuples
+    # ----------------------
+    def take_all(self):
+        """All queued requests as {device_key: [(request_id, address, words, write_only), ...]}, for worker processes."""
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(list)
+        return {
+            device_key: [(r.request_id, r.address, r.words, r.write_only) for r in requests]
+            for device_key, requests in pending.items() if requests
+        }
+
+    def add_forwarded(self, forwarded):
+        """Queues requests taken from the main process with take_all(); returns them for results()."""
+        requests = []
+        with self.lock:
+            for device_key, items in forwarded.items():
+                for request_id, address, words, write_only in items:
+                    request = WriteRequest(request_id, device_key, address, words, write_only=write_only)
+                    self.pending[device_key].append(request)
+                    requests.append(request)
+        return requests
+
+    def fail_unfinished(self, requests, error):
+        """Fails the given requests that are still queued, e.g. forwarded ones a worker did not get to."""
+        with self.lock:
+            for request in requests:
+                queue = self.pending.get(request.device_key)
+                if queue and request in queue:
+                    queue.remove(request)
+        for request in requests:
+            if not request.done.is_set():
+                request.finish("failed", error)
+
+    def complete_forwarded(self, results):
+        """Applies {request_id: (status, error)} reported by a worker."""
+        for request_id, (status, error) in results.items():
+            request = self.get(request_id)
+            if request is not None and not request.done.is_set():
+                request.finish(status, error)
+
+write_queue = WriteQueue()
+
+def wait(requests, timeout):
+    """Waits up to `timeout` seconds for the requests to finish; returns True if all did."""
+    deadline = time.monotonic() + timeout
+    for request in requests:
+        if not request.done.wait(max(0, deadline - time.monotonic())):
+            return False
+    return True
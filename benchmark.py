@@ -0,0 +1,191 @@
+# benchmark.py
+#
+# End-to-end throughput benchmark: polls simulated Modbus slaves (app/simulator.py) through the
+# real read plan / decode path and publishes the snapshot through a loopback MQTT client.
+#
+#   python benchmark.py --devices 1 10 100 1000 --cycles 5 --latency 0.002
+
+import argparse
+import gc
+import json
+import logging
+import os
+import resource
+import time
+import tracemalloc
+from app import modbus_reader, mqtt_manager
+from app.cache_manager import isolated_spool
+from app.connections import clients, close_clients
+from app.csv_parser import parse_register_map
+from app.logger import logger
+from app.sharded_poller import ShardedPoller
+from app.simulator import simulated_device_map, start_simulator_processes, LoopbackMqttClient
+
+def current_rss_mb(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Peak RSS; kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if pid == "self" else 0.0
+
+def cpu_seconds(pids):
+    """CPU time of this process plus the given (worker) processes."""
+    total = time.process_time()
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def count_values():
+    with modbus_reader.data_lock:
+        return sum(record.count() for record in modbus_reader.device_data.values())
+
+def measure_allocations(poll_cycle):
+    """
+    Runs one cycle under tracemalloc. Returns KB allocated by the cycle and still alive after it
+    (the rebuilt live data), the peak KB allocated during it, and the garbage collections it caused.
+    """
+    collections = sum(stats["collections"] for stats in gc.get_stats())
+    tracemalloc.start()
+    poll_cycle()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return retained / 1024, peak / 1024, sum(stats["collections"] for stats in gc.get_stats()) - collections
+
+def run_case(n_devices, register_map, args):
+    devices = simulated_device_map(n_devices, register_map, args.host, args.port, args.units_per_port)
+    faults = {"latency": args.latency, "jitter": args.jitter, "loss_rate": args.loss_rate, "exception_rate": args.exception_rate}
+    simulators = start_simulator_processes(devices, register_map, faults, processes=args.simulator_processes,
+                                           pipelined=not args.serial_gateways)
+    poller = None
+    try:
+        settings = {"max_registers": args.max_registers, "poll_workers": args.workers, "log_level": args.log_level.upper(),
+                    "tcp": {"pipeline_depth": args.pipeline_depth}, "mqtt": {"enabled": True}}
+        if args.record:
+            settings["capture"] = {"record": os.path.join(args.record, f"devices-{n_devices}.mbcap")}
+        modbus_reader.device_data.clear()
+        modbus_reader.configure(settings, register_map, devices)
+        poll_cycle = modbus_reader.poll_cycle
+        if args.workers > 1:
+            poller = ShardedPoller(args.workers)
+            poll_cycle = poller.poll_cycle
+
+        # Warm-up cycle opens the connections (and starts the workers)
+        poll_cycle()
+
+        worker_pids = [p.pid for p in poller.processes] if poller else []
+        cycle_times = []
+        values = 0
+        cpu_start = cpu_seconds(worker_pids)
+        wall_start = time.perf_counter()
+        for _ in range(args.cycles):
+            start = time.perf_counter()
+            poll_cycle()
+            cycle_times.append(time.perf_counter() - start)
+            values += count_values()
+        wall = time.perf_counter() - wall_start
+        cpu = cpu_seconds(worker_pids) - cpu_start
+        retained_kb, alloc_peak_kb, gc_runs = measure_allocations(poll_cycle)
+
+        words_per_cycle = sum(
+            block["count"]
+            for device in devices
+            for block in modbus_reader.read_plans.get(device["device_type_id"], [])
+        )
+
+        # Publish path against the loopback MQTT stand-in
+        loopback = LoopbackMqttClient(args.mqtt_ack_latency)
+        mqtt_manager.mqtt_client_instance = loopback
+        mqtt_manager.mqtt_connected.set()
+        publish_times = []
+        with isolated_spool():
+            for _ in range(args.cycles):
+                start = time.perf_counter()
+                mqtt_manager.publish_to_mqtt(modbus_reader.get_data(), settings)
+                publish_times.append(time.perf_counter() - start)
+        mqtt_manager.mqtt_connected.clear()
+        mqtt_manager.mqtt_client_instance = None
+
+        return {
+            "devices": n_devices,
+            "workers": args.workers,
+            "cycles": args.cycles,
+            "values_per_s": values / wall if wall else 0.0,
+            "registers_per_s": words_per_cycle * args.cycles / wall if wall else 0.0,
+            "cycle_p50_ms": percentile(cycle_times, 50) * 1000,
+            "cycle_p95_ms": percentile(cycle_times, 95) * 1000,
+            "cycle_p99_ms": percentile(cycle_times, 99) * 1000,
+            "cpu_pct": cpu / wall * 100 if wall else 0.0,
+            "rss_mb": current_rss_mb() + sum(current_rss_mb(pid) for pid in worker_pids),
+            "retained_kb": retained_kb,
+            "alloc_peak_kb": alloc_peak_kb,
+            "gc_runs": gc_runs,
+            "publish_p50_ms": percentile(publish_times, 50) * 1000,
+            "payload_kb": loopback.bytes / max(loopback.messages, 1) / 1024,
+        }
+    finally:
+        if poller:
+            poller.stop()
+        close_clients(list(clients))
+        for simulator in simulators:
+            simulator.terminate()
+            simulator.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark polling, decoding and publishing against simulated slaves.")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--units-per-port", type=int, default=247, help="Simulated devices per gateway; shards are per gateway")
+    parser.add_argument("--workers", type=int, default=1, help="Polling worker processes (1 = in-process threads)")
+    parser.add_argument("--simulator-processes", type=int, default=1)
+    parser.add_argument("--pipeline-depth", type=int, default=1, help="Requests in flight per gateway (1 = serial)")
+    parser.add_argument("--serial-gateways", action="store_true", help="Simulated gateways answer one transaction at a time")
+    parser.add_argument("--register-map", default="data/register_map.csv")
+    parser.add_argument("--max-registers", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--loss-rate", type=float, default=0.0)
+    parser.add_argument("--exception-rate", type=float, default=0.0)
+    parser.add_argument("--mqtt-ack-latency", type=float, default=0.0)
+    parser.add_argument("--log-level", default="WARNING", help="Poller log level; per-register INFO logging dominates otherwise")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--record", help="Record each case's Modbus traffic to <dir>/devices-N.mbcap for offline replay (python -m app.capture)")
+    args = parser.parse_args()
+
+    logger.setLevel(getattr(logging, args.log_level.upper()))
+    register_map = parse_register_map(args.register_map)
+    mqtt_manager.config = {"pi_id": "benchmark", "tenant_id": "bench", "customer_id": "bench", "site_id": "bench"}
+    mqtt_manager.pi_id = "benchmark"
+
+    columns = ["devices", "workers", "values_per_s", "registers_per_s", "cycle_p50_ms", "cycle_p95_ms", "cycle_p99_ms",
+               "cpu_pct", "rss_mb", "retained_kb", "alloc_peak_kb", "gc_runs", "publish_p50_ms", "payload_kb"]
+    print(" ".join(f"{c:>15}" for c in columns))
+    results = []
+    for n_devices in args.devices:
+        result = run_case(n_devices, register_map, args)
+        results.append(result)
+        print(" ".join(f"{result[c]:>15.1f}" if isinstance(result[c], float) else f"{result[c]:>15}" for c in columns))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,88 @@
+import atexit
+import signal
+import sys
 import threading
 import os
-import json
 import time
+from app import startup
 from app.modbus_reader import poll_devices, get_data
+from app.config_watcher import start_config_watcher
+from app.sharded_poller import ShardedPoller
 from app.flask_server import create_app
-from app.mqtt_manager import initialize_mqtt, publish_to_mqtt
+from app.mqtt_manager import initialize_mqtt, publish_to_mqtt, load_device_config, run_alarm_publisher
 # from app.logger import logger  # <- use centralized logger from logger.py
 from app.cloudwatch_logger import init_logger
-from app.logger import logger  
-
-# Load settings
-with open("settings.json") as f:
-    settings = json.load(f)
-
-print("Current working directory:", os.getcwd())
-
-init_logger()
-# Initialize MQTT connection
-initialize_mqtt(settings)
-
-# Setup Flask app
-app = create_app()
-
-# Start Modbus polling in a background thread
-poll_thread = threading.Thread(target=poll_devices, daemon=True)
-poll_thread.start()
-logger.info("Started Modbus polling thread.")
+from app import cloud_uploader
+from app import timeseries
+from app import alarms
+from app import tracing
+from app import warm_start
+from app.logger import logger
 
 # Start MQTT publish thread
-def mqtt_publish_thread():
+def mqtt_publish_thread(settings):
     while True:
         device_data = get_data()
         publish_to_mqtt(device_data, settings)
         time.sleep(settings["mqtt"].get("publish_interval", 10))
 
-mqtt_thread = threading.Thread(target=mqtt_publish_thread, daemon=True)
-mqtt_thread.start()
-logger.info("Started MQTT publishing thread.")
+# Queue snapshots for the SQL sink; the uploader thread drains the queue independently of the database's availability
+def sql_enqueue_thread(settings):
+    while True:
+        cloud_uploader.enqueue_snapshot(get_data())
+        time.sleep(settings["sql"].get("interval", 10))
 
-# Run Flask server
-if __name__ == "__main__":
+def main():
+    startup.reset_clock()
+    print("Current working directory:", os.getcwd())
+
+    # Load settings, register/device maps and device identity (local files only). With warm start,
+    # unchanged maps come with their compiled plans and the last-known values are served as stale.
+    settings = warm_start.load_config()
+    load_device_config()
+    if warm_start.start_saver():
+        # Save once more on shutdown; SIGTERM (systemd stop) exits through SystemExit so atexit runs
+        atexit.register(warm_start.save)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Stage tracing can also be switched on at runtime through POST /trace/start
+    if settings.get("tracing", {}).get("enabled", False):
+        tracing.start(settings["tracing"].get("max_events", tracing.DEFAULT_MAX_EVENTS))
+
+    # Start Modbus polling in a background thread, optionally sharded over worker processes
+    poll_cycle = None
+    if settings.get("poll_workers", 1) > 1:
+        poll_cycle = ShardedPoller(settings["poll_workers"]).poll_cycle
+    poll_thread = threading.Thread(target=poll_devices, args=(poll_cycle,), daemon=True)
+    poll_thread.start()
+    logger.info("Started Modbus polling thread.")
+
+    # Close finished rollup buckets and apply retention to the local time-series store
+    threading.Thread(target=timeseries.run_maintenance, daemon=True).start()
+
+    # Reload device/register maps and settings on change without restarting
+    start_config_watcher(settings.get("config_watch_interval", 2))
+
+    mqtt_thread = threading.Thread(target=mqtt_publish_thread, args=(settings,), daemon=True)
+    mqtt_thread.start()
+    logger.info("Started MQTT publishing thread.")
+
+    # Alarm events go out as soon as they are raised, on their own topic
+    threading.Thread(target=run_alarm_publisher, args=(alarms.events,), name="alarm-publisher", daemon=True).start()
+
+    if settings.get("sql", {}).get("enabled", False):
+        cloud_uploader.configure(settings)
+        threading.Thread(target=sql_enqueue_thread, args=(settings,), daemon=True).start()
+        cloud_uploader.start_uploader_thread()
+
+    # Network-bound initialization runs in the background with retry so it never delays polling or the dashboard
+    startup.start_background("cloudwatch", init_logger)
+    initialize_mqtt(settings)
+
+    # Setup and run Flask server
+    app = create_app()
     logger.info("Starting Flask dashboard server...")
-    app.run(host="0.0.0.0", port=5000, use_reloader=False)
+    app.run(host="0.0.0.0", port=settings.get("port", 5000), use_reloader=False)
+
+if __name__ == "__main__":
+    main()
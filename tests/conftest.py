@@ -0,0 +1,48 @@
+import socket
+import pytest
+from app import connections
+from app import modbus_reader
+from app.simulator import simulated_device_map, start_simulator_processes
+
+# One device type per function code family, with every decoded type and a write-only command
+REGISTER_MAP = [
+    {"device_type_id": "1", "variable_name": name, "access": access, "type": data_type, "unit": unit,
+     "gain": gain, "address": address, "quantity": quantity, "function_code": function_code}
+    for name, access, data_type, unit, gain, address, quantity, function_code in [
+        ("Voltage", "RO", "U16", "V", 10.0, 40000, 1, 3),
+        ("Current", "RO", "I16", "A", 100.0, 40001, 1, 3),
+        ("Energy", "RO", "U32", "kWh", 1.0, 40002, 2, 3),
+        ("Offset", "RO", "I32", "W", 1.0, 40004, 2, 3),
+        ("Setpoint", "RW", "U16", "kW", 10.0, 40100, 1, 3),
+        ("Limit", "RW", "U32", "kW", 1.0, 40101, 2, 3),
+        ("Reset", "WO", "U16", "N/A", 1.0, 40103, 1, 3),
+        ("Temperature", "RO", "FLOAT", "C", 1.0, 30000, 2, 4),
+        ("Breaker closed", "RO", "U16", "N/A", 1.0, 0, 1, 1),
+        ("Fan states", "RO", "U16", "N/A", 1.0, 1, 4, 1),
+        ("Door open", "RO", "U16", "N/A", 1.0, 10, 1, 2),
+    ]
+]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope="session")
+def simulator():
+    """Two simulated devices behind one gateway; yields their device map."""
+    devices = simulated_device_map(2, REGISTER_MAP, base_port=free_port())
+    processes = start_simulator_processes(devices, REGISTER_MAP)
+    yield devices
+    for process in processes:
+        process.terminate()
+        process.join()
+
+@pytest.fixture
+def poller(simulator):
+    """modbus_reader configured for the simulator with every optional subsystem off."""
+    settings = {"max_registers": 100, "writes": {"enabled": True}, "tcp": {"timeout": 2}}
+    modbus_reader.configure(settings, REGISTER_MAP, simulator)
+    yield modbus_reader
+    connections.close_clients(list(connections.clients))
+    modbus_reader.configure({}, [], [])
@@ -0,0 +1,112 @@
+import queue
+import pytest
+from app import alarms
+from app.alarms import AlarmEngine
+from app.live_records import DeviceRecord, build_layouts
+from app.read_plan import compile_read_plans
+from tests.conftest import REGISTER_MAP
+
+DEVICE_MAP = [{"device_id": 1, "slave_id": 1, "device_type_id": "1", "device_name": "Meter"}]
+
+def rule(rule_id, variable_name, condition, threshold, hysteresis=0.0):
+    return {"rule_id": rule_id, "device_type_id": "1", "variable_name": variable_name, "condition": condition,
+            "threshold": threshold, "hysteresis": hysteresis, "severity": "major", "active_hours": None}
+
+@pytest.fixture
+def record():
+    layout = build_layouts(compile_read_plans(REGISTER_MAP, 100))["1"]
+    return DeviceRecord("1_1", "Meter", layout)
+
+@pytest.fixture(autouse=True)
+def drain_events():
+    while True:
+        try:
+            alarms.events.get_nowait()
+        except queue.Empty:
+            break
+
+def poll(engine, record, timestamp, **values):
+    """One poll that read the given variables at `timestamp`, then the engine's evaluation."""
+    layout = record.layout
+    record.begin_poll()
+    for name, value in values.items():
+        slot = layout.variable_names.index(name.replace("_", " "))
+        block_number = max(n for n, start in enumerate(layout.block_slots[:-1]) if start <= slot)
+        record.set(slot, value)
+        record.set_block_time(block_number, timestamp)
+    record.end_poll()
+    engine.evaluate(record, now=timestamp)
+    return {event["alarm"] for event in engine.active()}
+
+def events():
+    emitted = []
+    while not alarms.events.empty():
+        event = alarms.events.get_nowait()
+        emitted.append((event["alarm"], event["state"]))
+    return emitted
+
+def test_threshold_with_hysteresis(record):
+    engine = AlarmEngine([rule("overvoltage", "Voltage", "above", 253, hysteresis=3)])
+    engine.configure(DEVICE_MAP)
+    assert poll(engine, record, 1000, Voltage=250) == set()
+    assert poll(engine, record, 1001, Voltage=255) == {"overvoltage"}
+    assert poll(engine, record, 1002, Voltage=251) == {"overvoltage"}
+    assert poll(engine, record, 1003, Voltage=249) == set()
+    assert events() == [("overvoltage", "raised"), ("overvoltage", "cleared")]
+
+def test_rate_alarm_clears_when_the_value_stops_changing(record):
+    engine = AlarmEngine([rule("ramp", "Energy", "rate_above", 5, hysteresis=1)])
+    engine.configure(DEVICE_MAP)
+    assert poll(engine, record, 1000, Energy=0) == set()
+    assert poll(engine, record, 1001, Energy=0) == set()
+    assert poll(engine, record, 1002, Energy=100) == {"ramp"}
+    # Same value on a fresh read: a rate of 0
+    assert poll(engine, record, 1003, Energy=100) == set()
+    assert events() == [("ramp", "raised"), ("ramp", "cleared")]
+
+def test_rate_needs_a_fresh_read(record):
+    engine = AlarmEngine([rule("ramp", "Energy", "rate_above", 5)])
+    engine.configure(DEVICE_MAP)
+    poll(engine, record, 1000, Energy=0)
+    poll(engine, record, 1001, Energy=100)
+    # Re-evaluating the same poll must not see a rate of 0
+    engine.evaluate(record, now=1005)
+    assert {event["alarm"] for event in engine.active()} == {"ramp"}
+
+def test_stale_device(record):
+    engine = AlarmEngine([rule("offline", "*", "stale", 60)])
+    engine.configure(DEVICE_MAP)
+    assert poll(engine, record, 1000, Voltage=230) == set()
+    engine.evaluate(record, now=1050)
+    assert engine.active() == []
+    engine.evaluate(record, now=1061)
+    assert [event["alarm"] for event in engine.active()] == ["offline"]
+    assert poll(engine, record, 1062, Voltage=230) == set()
+
+def test_removed_device_clears_its_alarms(record):
+    engine = AlarmEngine([rule("overvoltage", "Voltage", "above", 253)])
+    engine.configure(DEVICE_MAP)
+    poll(engine, record, 1000, Voltage=260)
+    engine.configure([])
+    assert engine.active() == []
+    assert events() == [("overvoltage", "raised"), ("overvoltage", "cleared")]
+
+@pytest.mark.parametrize("text, minutes", [("", None), ("09:00-16:30", (540, 990)), ("22:00-06:00", (1320, 360))])
+def test_active_hours(text, minutes):
+    assert alarms.parse_active_hours(text) == minutes
+
+@pytest.mark.parametrize("text", ["8-17", "25:00-26:00", "09:60-10:00", "09:00", "09:00-10:00-11:00", "9:x-10:00"])
+def test_malformed_active_hours_are_rejected(text):
+    with pytest.raises(ValueError):
+        alarms.parse_active_hours(text)
+
+def test_malformed_rule_skips_only_that_rule(tmp_path):
+    path = tmp_path / "alarm_rules.csv"
+    path.write_text(
+        "rule_id,device_type_id,variable_name,condition,threshold,hysteresis,severity,active_hours\n"
+        "hot,1,Temperature,above,80,5,major,\n"
+        "night,1,Voltage,below,200,0,minor,8-17\n"
+        "late,1,Voltage,below,200,0,minor,25:00-26:00\n"
+        "day,1,Voltage,above,250,0,minor,06:00-18:00\n"
+    )
+    assert [(r["rule_id"], r["active_hours"]) for r in alarms.parse_rules(path)] == [("hot", None), ("day", (360, 1080))]
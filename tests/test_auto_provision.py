@@ -0,0 +1,53 @@
+import importlib.util
+import json
+import os
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+spec = importlib.util.spec_from_file_location("auto_provision", os.path.join(ROOT, "auto-provision.py"))
+auto_provision = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(auto_provision)
+
+@pytest.fixture
+def stand_in(tmp_path):
+    stand_in = auto_provision.LocalStandIn(str(tmp_path / "stand-in.json"), latency=0.001)
+    yield stand_in
+    stand_in.close()
+
+def test_batch_is_provisioned_against_the_stand_in(tmp_path, stand_in):
+    backend = auto_provision.LocalBackend(stand_in)
+    finished, failed = auto_provision.provision_batch(["pi-1", "pi-2", "pi-3"], backend, str(tmp_path), concurrency=3)
+    assert failed == {} and len(finished) == 3
+    with open(tmp_path / "pi-2.json") as f:
+        config = json.load(f)
+    assert set(config["provisioning"]) == set(auto_provision.STEPS)
+    assert config["site_id"] == "local_site" and config["tenant_id"] == "local_tenant"
+    assert "certificate_ownership_token" not in config["provisioning"]["create_keys"]
+    assert os.path.exists(tmp_path / "pi-2-certificate.pem.crt") and os.path.exists(tmp_path / "pi-2-private.pem.key")
+    assert stand_in.shadows["pi-2"]["state"]["desired"]["customer_id"] == "local_customer"
+    # The credentials are fetched once for both post-provisioning steps
+    assert all("credentials" in provisioner.timings for provisioner in finished)
+
+def test_rejected_registration_resumes_with_a_new_certificate(tmp_path, stand_in):
+    backend = auto_provision.LocalBackend(stand_in)
+    stand_in.reject_rate = 1.0
+    _, failed = auto_provision.provision_batch(["pi-1"], backend, str(tmp_path), concurrency=1)
+    assert isinstance(failed["pi-1"], auto_provision.ProvisioningError)
+    state = auto_provision.DeviceState(str(tmp_path / "pi-1.json"), directory=str(tmp_path))
+    # The single-use ownership token is gone, so the certificate is requested again
+    assert state.steps == {}
+    stand_in.reject_rate = 0.0
+    finished, failed = auto_provision.provision_batch(["pi-1"], backend, str(tmp_path), concurrency=1)
+    assert failed == {} and "create_keys" in finished[0].timings
+
+def test_finished_steps_are_skipped(tmp_path, stand_in):
+    backend = auto_provision.LocalBackend(stand_in)
+    auto_provision.provision_batch(["pi-1"], backend, str(tmp_path), concurrency=1)
+    state = auto_provision.DeviceState(str(tmp_path / "pi-1.json"), directory=str(tmp_path))
+    state.discard("shadow")
+    provisioner = auto_provision.Provisioner(state, backend, quiet=True)
+    provisioner.run()
+    assert set(provisioner.timings) == {"credentials", "shadow"}
+    provisioner = auto_provision.Provisioner(auto_provision.DeviceState(str(tmp_path / "pi-1.json"), directory=str(tmp_path)), backend, quiet=True)
+    provisioner.run()
+    assert provisioner.timings == {}
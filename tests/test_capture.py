@@ -0,0 +1,65 @@
+import json
+import time
+import pytest
+from app import capture
+from app import clock
+from app import modbus_reader
+
+@pytest.fixture
+def recording(poller, tmp_path):
+    """A capture of three poll cycles of the simulator; returns (path, recording start, recording end)."""
+    path = str(tmp_path / "site.mbcap")
+    settings = dict(poller.settings)
+    poller.configure(dict(settings, capture={"record": path}), poller.register_map, poller.device_map)
+    start = time.time()
+    for _ in range(3):
+        poller.poll_cycle()
+        time.sleep(0.05)
+    end = time.time()
+    poller.configure(settings, poller.register_map, poller.device_map)
+    return path, start, end
+
+def test_capture_holds_configuration_and_transactions(recording):
+    path, start, end = recording
+    recorded = capture.read_capture(path)
+    assert recorded["configs"][0]["device_map"] == modbus_reader.device_map
+    # Five read blocks per device
+    assert len(recorded["transactions"]) == 3 * 5 * len(modbus_reader.device_map)
+    assert all(start <= transaction[0] <= end for transaction in recorded["transactions"])
+    assert {transaction[5] for transaction in recorded["transactions"]} == {capture.STATUS_OK}
+
+def test_replay_reproduces_the_polled_values(recording, tmp_path):
+    path, _, _ = recording
+    modbus_reader.poll_cycle()
+    live = {key: {(e["variable_name"], e["value"]) for e in entries} for key, entries in modbus_reader.get_data().items()}
+
+    capture.run_replay(path, cycles=2, speed=0, publish=False, output=str(tmp_path / "replayed.json"))
+    with open(tmp_path / "replayed.json") as f:
+        replayed = {key: {(e["variable_name"], e["value"]) for e in entries} for key, entries in json.load(f).items()}
+    assert replayed == live
+
+def test_replays_are_deterministic(recording, tmp_path):
+    path, _, _ = recording
+    outputs = []
+    # More cycles than were recorded, so the responses loop
+    for run in range(2):
+        output = tmp_path / f"replay-{run}.json"
+        capture.run_replay(path, cycles=5, speed=0, publish=True, output=str(output))
+        outputs.append(output.read_text())
+    assert outputs[0] == outputs[1]
+
+def test_replay_clock_follows_the_recorded_timestamps(recording):
+    path, start, end = recording
+    capture.run_replay(path, cycles=3, speed=0, publish=False)
+    assert clock.source == capture.replay.now
+    for record in modbus_reader.device_data.values():
+        assert start <= record.timestamp() <= end
+    # A fourth cycle replays the first lap again, one capture length later
+    modbus_reader.poll_cycle()
+    assert all(end < record.timestamp() < end + 2 * (end - start) for record in modbus_reader.device_data.values())
+
+def test_configure_restores_the_wall_clock(recording, poller):
+    path, _, _ = recording
+    capture.run_replay(path, cycles=1, speed=0, publish=False)
+    poller.configure({}, [], [])
+    assert clock.source == time.time
@@ -0,0 +1,58 @@
+import pytest
+from app import cloud_uploader
+
+@pytest.fixture
+def sink(tmp_path):
+    cloud_uploader.configure({"sql": {"dialect": "sqlite", "database": str(tmp_path / "sink.db"), "table": "modbus_data",
+                                      "batch_rows": 3, "queue_file": str(tmp_path / "queue.jsonl")}})
+    conn = cloud_uploader.connect()
+    yield conn
+    conn.close()
+
+def snapshot(timestamp, value=1.0):
+    return {
+        "1_1": [
+            {"timestamp": timestamp, "device_name": "Meter", "variable_name": "Voltage", "address": 40000, "value": value, "unit": "V"},
+            {"timestamp": timestamp, "device_name": "Meter", "variable_name": "Energy", "address": 40002, "value": 7, "unit": "kWh"},
+            {"timestamp": timestamp, "device_name": "Meter", "variable_name": "Serial", "address": 40010, "value": "decode error: x", "unit": ""},
+        ],
+        "2_2": [
+            {"timestamp": timestamp, "device_name": "Inverter", "variable_name": "Voltage", "address": 40000, "value": value, "unit": "V"},
+        ]
+    }
+
+def stored(conn):
+    return conn.execute("SELECT device_id, variable_name, timestamp, value FROM modbus_data ORDER BY device_id, variable_name").fetchall()
+
+def test_non_numeric_values_are_not_queued(sink):
+    cloud_uploader.enqueue_snapshot(snapshot("2026-01-01T00:00:00"))
+    assert cloud_uploader.drain_queue(sink) == 3
+
+def test_replayed_readings_are_inserted_once(sink):
+    cloud_uploader.enqueue_snapshot(snapshot("2026-01-01T00:00:00"))
+    cloud_uploader.drain_queue(sink)
+    # The same readings again, e.g. a batch replayed after a crash between insert and commit
+    cloud_uploader.enqueue_snapshot(snapshot("2026-01-01T00:00:00"))
+    cloud_uploader.drain_queue(sink)
+    assert len(stored(sink)) == 3
+
+def test_new_readings_are_kept(sink):
+    cloud_uploader.enqueue_snapshot(snapshot("2026-01-01T00:00:00"))
+    cloud_uploader.enqueue_snapshot(snapshot("2026-01-01T00:00:05", value=2.0))
+    cloud_uploader.drain_queue(sink)
+    assert len(stored(sink)) == 6
+
+def test_uncommitted_batch_is_replayed_without_duplicates(sink):
+    cloud_uploader.enqueue_snapshot(snapshot("2026-01-01T00:00:00"))
+    rows, _ = cloud_uploader.queue.read_batch(3, 1024 * 1024)
+    # Inserted but the queue offset was never committed
+    cloud_uploader.insert_batch(sink, [tuple(row) for row in rows])
+    assert cloud_uploader.drain_queue(sink) == 3
+    assert len(stored(sink)) == 3
+    assert cloud_uploader.queue.pending_bytes() == 0
+
+def test_dedup_key_depends_on_every_field():
+    key = cloud_uploader.dedup_key("1_1", 40000, "Voltage", "t0")
+    assert key == cloud_uploader.dedup_key("1_1", 40000, "Voltage", "t0")
+    assert len({key, cloud_uploader.dedup_key("1_2", 40000, "Voltage", "t0"), cloud_uploader.dedup_key("1_1", 40001, "Voltage", "t0"),
+                cloud_uploader.dedup_key("1_1", 40000, "Current", "t0"), cloud_uploader.dedup_key("1_1", 40000, "Voltage", "t1")}) == 5
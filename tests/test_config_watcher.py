@@ -0,0 +1,53 @@
+import csv
+import json
+import threading
+import time
+import pytest
+from app import config_watcher
+from app import modbus_reader
+from app.simulator import write_device_map
+from tests.conftest import REGISTER_MAP
+
+@pytest.fixture
+def config_files(tmp_path, poller):
+    """The poller's configuration written out as the three files the watcher reads."""
+    paths = [tmp_path / "settings.json", tmp_path / "register_map.csv", tmp_path / "device_map.csv"]
+    paths[0].write_text(json.dumps(poller.settings))
+    with open(paths[1], "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(REGISTER_MAP[0]))
+        writer.writeheader()
+        writer.writerows(REGISTER_MAP)
+    write_device_map(poller.device_map, paths[2])
+    yield [str(path) for path in paths]
+    modbus_reader.pending_config = None
+
+def test_valid_change_is_staged_and_applied(config_files, poller):
+    write_device_map(poller.device_map[:1], config_files[2])
+    assert config_watcher.reload_config(*config_files)
+    # Nothing changes until the poller applies it between cycles
+    assert set(poller.device_data) == {"1_1", "2_2"}
+    poller.poll_cycle()
+    assert set(poller.device_data) == {"1_1"}
+    assert set(poller.get_data()) == {"1_1"}
+
+@pytest.mark.parametrize("broken", ["settings", "device_type", "slave_id"])
+def test_invalid_configuration_is_rejected(config_files, poller, broken):
+    if broken == "settings":
+        with open(config_files[0], "w") as f:
+            f.write("{")
+    else:
+        devices = [dict(poller.device_map[0], **({"device_type_id": "9"} if broken == "device_type" else {"slave_id": 300}))]
+        write_device_map(devices, config_files[2])
+    assert not config_watcher.reload_config(*config_files)
+    assert modbus_reader.pending_config is None
+
+def test_watcher_stages_edited_files(config_files, poller):
+    thread = threading.Thread(target=config_watcher.watch_config, args=(0.05, config_files), daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    with open(config_files[0], "w") as f:
+        json.dump(dict(poller.settings, max_registers=50), f)
+    deadline = time.monotonic() + 2
+    while modbus_reader.pending_config is None and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert modbus_reader.pending_config[0]["max_registers"] == 50
@@ -0,0 +1,84 @@
+import csv
+import math
+import pytest
+from app import derived
+from app.derived import DerivedEngine
+from tests.conftest import REGISTER_MAP
+from tests.test_read_plan import simulated_word
+
+def definition(name, expression, scope="device", device_type_id="1", unit=""):
+    return {"variable_name": name, "scope": scope, "device_type_id": device_type_id if scope == "device" else "",
+            "expression": expression, "unit": unit, "replaces_inputs": False}
+
+# Listed dependents first, so the engine has to order them
+DEFINITIONS = [
+    definition("Average voltage", "{Total voltage} / {Meters}", scope="site"),
+    definition("Power kW", "{Power} / 1000"),
+    definition("Total voltage", "sum({1:Voltage})", scope="site"),
+    definition("Meters", "count({1:Voltage})", scope="site"),
+    definition("Power", "{Voltage} * {Current}"),
+    definition("Energy since last poll", "delta({Energy})"),
+    definition("Square", "{Voltage} ** 2"),
+    definition("Runaway", "{Voltage} ** {Energy}"),
+]
+
+def names(engine):
+    return [metric.name for metric in engine.order]
+
+def test_metrics_are_ordered_by_dependency(simulator):
+    order = names(DerivedEngine(DEFINITIONS, REGISTER_MAP, simulator))
+    assert set(order) == {d["variable_name"] for d in DEFINITIONS}
+    assert order.index("Power") < order.index("Power kW")
+    assert order.index("Total voltage") < order.index("Average voltage")
+    assert order.index("Meters") < order.index("Average voltage")
+
+def test_cycles_and_unknown_inputs_are_skipped(simulator):
+    engine = DerivedEngine([
+        definition("A", "{B} + 1"),
+        definition("B", "{A} + 1"),
+        definition("C", "{No such register}"),
+        definition("D", "{C} * 2"),
+        definition("E", "{Voltage} + 1"),
+    ], REGISTER_MAP, simulator)
+    assert names(engine) == ["E"]
+
+@pytest.mark.parametrize("expression", ["_ref0 + 1", "{Voltage} + _ref1", "_in0", "_pow(2, 3)", "__import__('os')", "{Voltage}.real", "[1][0]", "lambda: 1", "exec('1')"])
+def test_unsupported_syntax_is_rejected(simulator, expression):
+    assert names(DerivedEngine([definition("Bad", expression)], REGISTER_MAP, simulator)) == []
+
+def test_exponent_is_bounded():
+    metric = derived.CompiledMetric(definition("Pow", "{x} ** {y}"))
+    assert metric.function(2, 10) == 1024
+    assert math.isnan(metric.function(10, 10 ** 9))
+    assert math.isnan(metric.function(9, derived.MAX_EXPONENT + 1))
+
+@pytest.fixture
+def derived_poller(poller, tmp_path):
+    path = tmp_path / "derived_metrics.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["variable_name", "scope", "device_type_id", "expression", "unit", "replaces_inputs"])
+        writer.writeheader()
+        for row in DEFINITIONS:
+            writer.writerow(dict(row, replaces_inputs="no"))
+    poller.configure(dict(poller.settings, derived={"enabled": True, "file": str(path)}), poller.register_map, poller.device_map)
+    return poller
+
+def test_derived_values_follow_the_polled_ones(derived_poller):
+    derived_poller.poll_cycle()
+    data = derived_poller.get_data()
+    values = {entry["variable_name"]: entry["value"] for entry in data["1_1"]}
+    assert values["Power"] == pytest.approx(values["Voltage"] * values["Current"])
+    assert values["Power kW"] == pytest.approx(values["Power"] / 1000)
+    assert values["Square"] == pytest.approx((simulated_word(40000) / 10) ** 2)
+    # Voltage ** Energy is far beyond the exponent limit: NaN, which is left out
+    assert "Runaway" not in values
+    # No previous reading yet
+    assert "Energy since last poll" not in values
+
+    site = {entry["variable_name"]: entry["value"] for entry in data[derived.SITE_KEY]}
+    assert site["Meters"] == 2
+    assert site["Average voltage"] == pytest.approx(site["Total voltage"] / 2)
+
+    derived_poller.poll_cycle()
+    values = {entry["variable_name"]: entry["value"] for entry in derived_poller.get_data()["1_1"]}
+    assert values["Energy since last poll"] == 0
@@ -0,0 +1,51 @@
+import pytest
+from app.discovery import Scanner, merge_intervals, propose
+from app.simulator import simulated_device_map, start_simulator_processes
+from tests.conftest import REGISTER_MAP, free_port
+
+def register(type_id, name, address, quantity=1, function_code=3):
+    return {"device_type_id": type_id, "variable_name": name, "access": "RO", "type": "U16", "unit": "N/A",
+            "gain": 1.0, "address": address, "quantity": quantity, "function_code": function_code}
+
+METER = [register("2", "Power", 40000), register("2", "Frequency", 40001)]
+# Registers of a device type the register map does not know
+UNKNOWN = [register("3", f"Register {address}", address) for address in range(50000, 50010)]
+# What discovery is told to expect: each known type lists one register, in a read block of its own,
+# that its devices do not serve
+KNOWN_MAP = REGISTER_MAP + [register("1", "Reactive power", 40200)] + METER + [register("2", "Power factor", 41000)]
+
+@pytest.fixture(scope="module")
+def gateway():
+    """Units 1-3 of types 1, 2 and 3 behind one gateway; unit 4 is absent."""
+    devices = simulated_device_map(3, REGISTER_MAP + METER + UNKNOWN, base_port=free_port())
+    processes = start_simulator_processes(devices, REGISTER_MAP + METER + UNKNOWN)
+    yield ("TCP", devices[0]["address"], int(devices[0]["port_baudRate"]))
+    for process in processes:
+        process.terminate()
+        process.join()
+
+@pytest.fixture(scope="module")
+def units(gateway):
+    scanner = Scanner(KNOWN_MAP, max_registers=100, timeout=0.3, ranges=[(3, 50000, 50016)], resolution=8)
+    return scanner.scan([gateway], [1, 2, 3, 4], per_gateway=4)
+
+def test_finds_the_answering_units_and_their_types(units):
+    assert [(unit["unit_id"], unit["device_type_id"]) for unit in units] == [(1, "1"), (2, "2"), (3, None)]
+
+def test_known_types_keep_only_their_readable_registers(units):
+    full, meter, _ = units
+    assert sorted(reg["variable_name"] for reg in full["registers"]) == sorted(reg["variable_name"] for reg in REGISTER_MAP)
+    assert merge_intervals(full["spans"]) == {1: [(0, 5)], 2: [(10, 11)], 3: [(40000, 40006), (40100, 40104)], 4: [(30000, 30002)]}
+    assert [reg["variable_name"] for reg in meter["registers"]] == ["Power", "Frequency"]
+    assert merge_intervals(meter["spans"]) == {3: [(40000, 40002)]}
+
+def test_unknown_units_are_bisected_over_the_given_ranges(units):
+    # 50000-50009 are served; the half from 50008 is refused as a whole at the resolution of 8
+    assert units[2]["spans"] == [(3, 50000, 50008)]
+
+def test_proposed_blocks_avoid_refused_registers(units):
+    devices, registers, plans = propose([dict(unit) for unit in units], KNOWN_MAP, KNOWN_MAP, [], 100)
+    assert [(device["slave_id"], device["device_type_id"]) for device in devices] == [(1, "1"), (2, "2"), (3, "new-1")]
+    assert "Reactive power" not in {row["variable_name"] for row in registers}
+    assert [(block["start"], block["count"]) for block in plans["2"]] == [(40000, 2)]
+    assert [(block["start"], block["count"]) for block in plans["new-1"]] == [(50000, 8)]
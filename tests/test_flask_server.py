@@ -0,0 +1,49 @@
+import pytest
+from app import flask_server
+from app import modbus_reader
+
+TOKEN = "secret"
+
+@pytest.fixture(scope="module")
+def app():
+    # create_app() registers its routes on the module's Flask app, which can only happen once
+    return flask_server.create_app()
+
+@pytest.fixture
+def client(poller, app):
+    poller.configure(dict(poller.settings, api={"token": TOKEN}), poller.register_map, poller.device_map)
+    return app.test_client()
+
+def post_write(client, body, token=TOKEN):
+    return client.post("/write", json=body, headers={"Authorization": f"Bearer {token}"})
+
+def test_control_endpoints_are_closed_without_credentials(poller, app):
+    client = app.test_client()
+    assert client.post("/write", json={"writes": []}).status_code == 403
+
+def test_wrong_token_is_refused(client):
+    assert post_write(client, {"writes": []}, token="wrong").status_code == 401
+
+@pytest.mark.parametrize("body", [[1, 2], "text", 5, {"writes": [1]}, {"writes": {"device": "1_1"}}])
+def test_malformed_write_bodies_are_client_errors(client, body):
+    assert post_write(client, body).status_code == 400
+
+@pytest.mark.parametrize("value", ["NaN", "Infinity"])
+def test_non_finite_values_are_client_errors(client, value):
+    response = client.post("/write", data=f'{{"writes": [{{"device": "1_1", "variable": "Setpoint", "value": {value}}}]}}',
+                           content_type="application/json", headers={"Authorization": f"Bearer {TOKEN}"})
+    assert response.status_code == 400
+
+def test_write_is_queued(client):
+    response = post_write(client, {"writes": [{"device": "1_1", "variable": "Setpoint", "value": 5}]})
+    assert response.status_code == 202
+    modbus_reader.poll_cycle()
+    request_id = response.get_json()["writes"][0]["request_id"]
+    status = client.get(f"/write/{request_id}", headers={"Authorization": f"Bearer {TOKEN}"}).get_json()
+    assert status["status"] == "confirmed"
+
+def test_profile_needs_post(client):
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+    assert client.get("/profile?seconds=0.05", headers=headers).status_code == 405
+    response = client.post("/profile?seconds=0.05", headers=headers)
+    assert response.status_code == 200
@@ -0,0 +1,54 @@
+import pytest
+from app import metrics
+from app.governor import Governor, MAX_LEVEL, SPOOL_MAX_LEVEL
+
+@pytest.fixture
+def governor():
+    metrics.SPOOL_BYTES.set(0)
+    metrics.SQL_QUEUE_BYTES.set(0)
+    governor = Governor()
+    # Only the cycle time and the spool, which the tests control, can go over budget
+    governor.configure({"governor": {"enabled": True, "max_cpu": 1e9, "max_memory": 1e9, "max_spool_bytes": 1000,
+                                     "max_cycle_load": 1.0, "headroom": 0.5, "restore_cycles": 3}})
+    yield governor
+    metrics.SPOOL_BYTES.set(0)
+
+def run(governor, cycles, duration, interval=1.0):
+    levels = []
+    for _ in range(cycles):
+        governor.observe(duration, interval)
+        levels.append(governor.level)
+    return levels
+
+def test_steps_up_one_level_per_overloaded_cycle(governor):
+    assert run(governor, MAX_LEVEL + 2, duration=1.5) == list(range(1, MAX_LEVEL + 1)) + [MAX_LEVEL] * 2
+    assert governor.backlog_paused()
+    assert governor.stretch() == 8
+
+def test_steps_down_after_restore_cycles_of_headroom(governor):
+    run(governor, 3, duration=1.5)
+    assert run(governor, 7, duration=0.1) == [3, 3, 2, 2, 2, 1, 1]
+
+def test_holds_level_between_headroom_and_budget(governor):
+    run(governor, 2, duration=1.5)
+    assert run(governor, 10, duration=0.8) == [2] * 10
+
+def test_growing_spool_sheds_no_further_than_the_dashboard(governor):
+    metrics.SPOOL_BYTES.set(5000)
+    assert run(governor, 5, duration=0.1) == [1, 2, 2, 2, 2]
+    assert not governor.backlog_paused()
+
+def test_full_spool_does_not_latch_higher_levels(governor):
+    metrics.SPOOL_BYTES.set(5000)
+    run(governor, MAX_LEVEL, duration=1.5)
+    assert governor.level == MAX_LEVEL
+    # The backlog replay is paused up here, so the spool cannot drain; the level must still come down
+    levels = run(governor, 3 * MAX_LEVEL, duration=0.1)
+    assert levels[-1] == SPOOL_MAX_LEVEL
+    assert min(levels) == SPOOL_MAX_LEVEL
+
+def test_disabled_governor_drops_to_level_zero(governor):
+    run(governor, 2, duration=1.5)
+    governor.configure({"governor": {"enabled": False}})
+    assert governor.level == 0
+    assert run(governor, 3, duration=5.0) == [0, 0, 0]
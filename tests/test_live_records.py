@@ -0,0 +1,82 @@
+import math
+import pickle
+from app import clock
+from app.live_records import DeviceRecord, build_layouts
+from app.read_plan import compile_read_plans
+from app.utils import pack_bits
+from tests.conftest import REGISTER_MAP
+
+PLANS = compile_read_plans(REGISTER_MAP, 100)
+
+def new_record():
+    return DeviceRecord("1_1", "Meter", build_layouts(PLANS)["1"])
+
+def block_of(layout, name):
+    slot = layout.variable_names.index(name)
+    return slot, max(n for n, start in enumerate(layout.block_slots[:-1]) if start <= slot)
+
+def test_layouts_are_reused_while_the_plan_is_unchanged():
+    layouts = build_layouts(PLANS)
+    assert build_layouts(PLANS, layouts)["1"] is layouts["1"]
+    assert build_layouts(compile_read_plans(REGISTER_MAP, 100), layouts)["1"] is not layouts["1"]
+    layout = layouts["1"]
+    assert len(layout) == len(REGISTER_MAP)
+    assert layout.block_slots[-1] == len(layout)
+    assert [layout.plan[n]["function_code"] for n in layout.bit_blocks] == [1, 2]
+
+def test_poll_marks_only_read_values_valid(monkeypatch):
+    monkeypatch.setattr(clock, "source", lambda: 1000.0)
+    record = new_record()
+    assert record.timestamp() is None and record.entries() == []
+    slot, block = block_of(record.layout, "Voltage")
+    record.begin_poll()
+    record.set(slot, 230.0)
+    record.set_block_time(block)
+    record.end_poll()
+    assert record.seq == 1 and record.failures == 0 and record.timestamp() == 1000.0
+    [entry] = record.entries()
+    assert (entry["variable_name"], entry["value"], entry["address"]) == ("Voltage", 230.0, 40000)
+    values = record.slot_values()
+    assert values[slot] == 230.0 and sum(not math.isnan(value) for value in values) == 1
+    # A poll that reads nothing leaves no valid values and counts as a failure
+    record.begin_poll()
+    record.end_poll()
+    assert record.entries() == [] and record.failures == 1
+
+def test_skipped_blocks_keep_their_values():
+    record = new_record()
+    slot, block = block_of(record.layout, "Voltage")
+    record.begin_poll()
+    record.set(slot, 230.0)
+    record.set_block_time(block, 1000.0)
+    record.end_poll()
+    record.begin_poll(skipped=(block,))
+    record.end_poll()
+    assert [entry["value"] for entry in record.entries()] == [230.0]
+    assert record.failures == 0
+
+def test_bit_blocks_are_sent_as_bitmasks():
+    record = new_record()
+    slot, block = block_of(record.layout, "Fan states")
+    record.begin_poll()
+    record.set(slot, 5)
+    record.set_bits(block, pack_bits([False, True, False, True, False]))
+    record.set_block_time(block, 1000.0)
+    record.end_poll()
+    assert record.bitmasks() == [{"function_code": 1, "start": 0, "count": 5, "bits": "Cg=="}]
+    assert all(entry["bit"] for entry in record.entries())
+
+def test_state_round_trip_marks_restored_values_stale():
+    record = new_record()
+    slot, block = block_of(record.layout, "Voltage")
+    record.begin_poll()
+    record.set(slot, 230.0)
+    record.set_block_time(block, 1000.0)
+    record.end_poll()
+    restored = new_record()
+    assert restored.load_state(pickle.loads(pickle.dumps(record.state())), stale=True)
+    assert restored.seq == record.seq and restored.slot_values()[slot] == 230.0
+    assert restored.entries()[0]["stale"] is True
+    # States of a different layout are refused
+    other = DeviceRecord("1_1", "Meter", build_layouts(compile_read_plans(REGISTER_MAP[:3], 100))["1"])
+    assert not other.load_state(record.state())
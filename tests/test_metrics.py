@@ -0,0 +1,36 @@
+import pytest
+from app import metrics
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Metrics created in a test are kept out of the process-wide registry."""
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    return metrics.REGISTRY
+
+def test_unlabelled_counter_is_exported_from_the_start(registry):
+    counter = metrics.Counter("test_total", "A test counter")
+    assert metrics.render_metrics() == "# HELP test_total A test counter\n# TYPE test_total counter\ntest_total 0\n"
+    counter.inc()
+    counter.inc(2.5)
+    assert counter.render()[-1] == "test_total 3.5"
+
+def test_labels_are_escaped(registry):
+    gauge = metrics.Gauge("test_gauge", "A test gauge", ("device", "kind"))
+    gauge.set(4, device='say "hi"\\', kind="a\nb")
+    gauge.dec(device="x")
+    assert gauge.render()[2:] == ['test_gauge{device="say \\"hi\\"\\\\",kind="a\\nb"} 4', 'test_gauge{device="x",kind=""} -1']
+    gauge.remove(device="x")
+    assert gauge.get(device="x") == 0
+    assert len(gauge.render()) == 3
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = metrics.Histogram("test_seconds", "A test histogram", ("stage",), buckets=(1.0, 0.1))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, stage="read")
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{stage="read",le="0.1"} 2',
+        'test_seconds_bucket{stage="read",le="1.0"} 3',
+        'test_seconds_bucket{stage="read",le="+Inf"} 4',
+        'test_seconds_sum{stage="read"} 3.65',
+        'test_seconds_count{stage="read"} 4',
+    ]
@@ -0,0 +1,22 @@
+import json
+import pytest
+from app import mqtt_manager
+
+@pytest.fixture
+def published(monkeypatch):
+    messages = []
+    monkeypatch.setattr(mqtt_manager, "publish_and_wait", lambda topic, payload: messages.append(json.loads(payload)))
+    return messages
+
+@pytest.mark.parametrize("payload", [b"[1]", b'"text"', b'{"writes": [1]}', b'{"writes": "x"}', b"not json",
+                                     b'{"writes": [{"device": "1_1", "variable": "Setpoint", "value": Infinity}]}',
+                                     b'{"writes": [], "timeout": NaN}'])
+def test_malformed_commands_publish_an_error(poller, published, payload):
+    mqtt_manager.handle_write_command(payload)
+    assert len(published) == 1
+    assert "error" in published[0]
+
+def test_command_results_are_published(poller, published):
+    mqtt_manager.handle_write_command(b'{"command_id": "c1", "writes": [{"device": "1_1", "variable": "Setpoint", "value": 3}], "timeout": 0}')
+    assert published[0]["command_id"] == "c1"
+    assert published[0]["writes"][0]["status"] == "queued"
@@ -0,0 +1,109 @@
+import socket
+import struct
+import threading
+import time
+import pytest
+from app.pipelined_tcp import ModbusTcpError, PipelinedTcpClient
+from app.simulator import simulated_device_map, start_simulator_processes
+from tests.conftest import REGISTER_MAP, free_port
+from tests.test_read_plan import simulated_word
+
+@pytest.fixture(scope="module")
+def gateway():
+    """A pipelining gateway with units 1-3; other unit IDs never answer."""
+    devices = simulated_device_map(3, REGISTER_MAP, base_port=free_port())
+    processes = start_simulator_processes(devices, REGISTER_MAP, pipelined=True)
+    yield devices[0]["address"], int(devices[0]["port_baudRate"])
+    for process in processes:
+        process.terminate()
+        process.join()
+
+def read_concurrently(client, units):
+    results = {}
+    def read(unit):
+        try:
+            results[unit] = client.read_holding_registers(40000, 2, slave=unit).registers
+        except ModbusTcpError as e:
+            results[unit] = e
+    threads = [threading.Thread(target=read, args=(unit,)) for unit in units]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_missing_unit_fails_only_its_own_request(gateway):
+    client = PipelinedTcpClient(*gateway, depth=4, timeout=0.5)
+    try:
+        for _ in range(2):
+            sock = client.sock
+            results = read_concurrently(client, [9, 1, 2, 3])
+            assert isinstance(results.pop(9), ModbusTcpError)
+            assert results == {unit: [simulated_word(40000), simulated_word(40001)] for unit in (1, 2, 3)}
+            assert client.pipelined
+            assert sock is None or client.sock is sock
+    finally:
+        client.close()
+
+def test_pipelining_is_retried_after_a_quiet_period(gateway):
+    client = PipelinedTcpClient(*gateway, depth=4, timeout=0.5, retry_after=0.2)
+    try:
+        client.fall_back("test")
+        assert not client.pipelined
+        client.read_holding_registers(40000, 1, slave=1)
+        assert not client.pipelined
+        time.sleep(0.25)
+        client.read_holding_registers(40000, 1, slave=1)
+        assert client.pipelined
+        # Falling back again after a retry doubles the wait
+        client.fall_back("test")
+        assert client.retry_after == 0.4
+    finally:
+        client.close()
+
+def test_known_serial_gateway_starts_serial(gateway):
+    client = PipelinedTcpClient(*gateway, depth=4, pipelined=False)
+    try:
+        assert not client.pipelined
+        assert client.read_holding_registers(40000, 1, slave=2).registers == [simulated_word(40000)]
+    finally:
+        client.close()
+
+@pytest.fixture
+def scripted_gateway():
+    """A gateway answering each request with the next scripted PDU, whatever was asked."""
+    responses = []
+    server = socket.create_server(("127.0.0.1", 0))
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with conn:
+                while True:
+                    header = conn.recv(7)
+                    if len(header) < 7 or not responses:
+                        break
+                    transaction_id, _, length, unit_id = struct.unpack(">HHHB", header)
+                    conn.recv(length - 1)
+                    pdu = responses.pop(0)
+                    conn.sendall(struct.pack(">HHHB", transaction_id, 0, len(pdu) + 1, unit_id) + pdu)
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield server.getsockname(), responses
+    server.close()
+
+@pytest.mark.parametrize("pdu", [b"\x03\x03\x00\x01\x02", b"\x03\x04\x00\x01", b"\x03", b"\x01\x02\x01"])
+def test_malformed_pdu_is_a_framing_error(scripted_gateway, pdu):
+    address, responses = scripted_gateway
+    responses.extend([pdu, b"\x03\x02\x12\x34"])
+    client = PipelinedTcpClient(*address, depth=4, timeout=1)
+    try:
+        with pytest.raises(ModbusTcpError, match="Framing error"):
+            client.read_holding_registers(40000, 1, slave=1)
+        assert not client.pipelined
+        # The reader thread dropped the socket; the next request reconnects
+        assert client.read_holding_registers(40000, 1, slave=1).registers == [0x1234]
+    finally:
+        client.close()
@@ -0,0 +1,83 @@
+import struct
+import pytest
+from app.read_plan import build_read_plan, compile_read_plans, flat_registers
+from app.utils import apply_byte_order, encode_value, pack_bits, unpack_bits
+from tests.conftest import REGISTER_MAP
+
+def simulated_word(address):
+    # Register image served by app.simulator
+    return (address * 31 + 7) & 0xFFFF
+
+def simulated_bit(address):
+    return bool(simulated_word(address) & 0x10)
+
+def test_plan_groups_by_function_code_and_block_size():
+    plan = build_read_plan(REGISTER_MAP, max_registers=100)
+    assert [(block["function_code"], block["start"], block["count"]) for block in plan] == [
+        (1, 0, 5), (2, 10, 1), (3, 40000, 6), (3, 40100, 4), (4, 30000, 2)
+    ]
+    assert [reg["offset"] for reg in plan[0]["registers"]] == [0, 1]
+    assert len(flat_registers(plan)) == len(REGISTER_MAP)
+
+def test_plan_splits_at_max_registers():
+    plan = build_read_plan(REGISTER_MAP, max_registers=4)
+    assert [(block["start"], block["count"]) for block in plan if block["function_code"] == 3] == [
+        (40000, 4), (40004, 2), (40100, 4)
+    ]
+
+def test_compile_read_plans_only_requested_types():
+    assert list(compile_read_plans(REGISTER_MAP, 100, device_type_ids=["1", "9"])) == ["1", "9"]
+    assert compile_read_plans(REGISTER_MAP, 100, device_type_ids=["9"])["9"] == []
+
+@pytest.mark.parametrize("data_type, quantity, value", [
+    ("U16", 1, 51234),
+    ("I16", 1, -1234),
+    ("U32", 2, 3000000000),
+    ("I32", 2, -70000),
+    ("FLOAT", 2, 12.5),
+])
+@pytest.mark.parametrize("swap", ["none", "word", "both"])
+def test_byte_order_round_trip(data_type, quantity, value, swap):
+    words = encode_value(value, data_type, quantity, swap)
+    assert len(words) == quantity
+    assert apply_byte_order(words, data_type, swap) == value
+
+def test_word_swap_reverses_register_order():
+    assert encode_value(0x00010002, "U32", 2, "none") == [0x0001, 0x0002]
+    assert encode_value(0x00010002, "U32", 2, "word") == [0x0002, 0x0001]
+
+def test_encode_out_of_range():
+    with pytest.raises(OverflowError):
+        encode_value(70000, "U16", 1, "none")
+
+@pytest.mark.parametrize("count", [1, 7, 8, 9, 20])
+def test_bit_packing_round_trip(count):
+    bits = [bool(i * 7 % 3) for i in range(count)]
+    packed = pack_bits(bits)
+    assert len(packed) == (count + 7) // 8
+    assert unpack_bits(packed, count) == bits
+
+def test_first_bit_is_least_significant():
+    assert pack_bits([True, False, False, False, False, False, False, False, False, True]) == b"\x01\x02"
+
+def test_poll_decodes_simulated_device(poller):
+    poller.poll_cycle()
+    data = poller.get_data()
+    assert set(data) == {"1_1", "2_2"}
+    values = {entry["variable_name"]: entry["value"] for entry in data["1_1"]}
+
+    assert values["Voltage"] == simulated_word(40000) / 10
+    assert values["Current"] == struct.unpack(">h", struct.pack(">H", simulated_word(40001)))[0] / 100
+    assert values["Energy"] == simulated_word(40002) << 16 | simulated_word(40003)
+    assert values["Offset"] == struct.unpack(">i", struct.pack(">HH", simulated_word(40004), simulated_word(40005)))[0]
+    assert values["Temperature"] == struct.unpack(">f", struct.pack(">HH", simulated_word(30000), simulated_word(30001)))[0]
+    assert values["Breaker closed"] == simulated_bit(0)
+    assert values["Fan states"] == sum(simulated_bit(1 + i) << i for i in range(4))
+    assert values["Door open"] == simulated_bit(10)
+
+def test_poll_reports_bit_blocks_as_bitmasks(poller):
+    poller.poll_cycle()
+    record = poller.device_data["1_1"]
+    bitmasks = record.bitmasks()
+    assert [(mask["function_code"], mask["start"], mask["count"]) for mask in bitmasks] == [(1, 0, 5), (2, 10, 1)]
+    assert all(entry.get("bit") for entry in record.entries() if entry["address"] < 100)
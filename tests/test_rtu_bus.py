@@ -0,0 +1,37 @@
+import time
+import pytest
+from pymodbus.client import ModbusSerialClient
+from app.rtu_bus import FIXED_SILENT_INTERVAL, RtuBusMaster, character_time, silent_interval
+
+def test_character_time_counts_framing_bits():
+    assert character_time(9600) == pytest.approx(10 / 9600)
+    assert character_time(9600, parity="E", stopbits=1) == pytest.approx(11 / 9600)
+    assert character_time(19200, bytesize=7, parity="N", stopbits=2) == pytest.approx(10 / 19200)
+
+def test_silent_interval_is_fixed_above_19200_baud():
+    assert silent_interval(9600) == pytest.approx(3.5 * 10 / 9600)
+    assert silent_interval(19200) == pytest.approx(3.5 * 10 / 19200)
+    assert silent_interval(38400) == FIXED_SILENT_INTERVAL
+    assert silent_interval(115200) == FIXED_SILENT_INTERVAL
+
+def test_default_timeout_covers_the_largest_response():
+    bus = RtuBusMaster("/dev/null", 9600, turnaround=0.1, max_registers=125)
+    # Turnaround, 255 response characters and one silent interval
+    assert bus.bus_timeout == pytest.approx(0.1 + 255 * 10 / 9600 + 3.5 * 10 / 9600)
+    assert RtuBusMaster("/dev/null", 9600, timeout=0.5).bus_timeout == 0.5
+
+def test_transaction_time():
+    bus = RtuBusMaster("/dev/null", 9600)
+    gap = 3.5 * 10 / 9600
+    assert bus.transaction_time(10) == pytest.approx((8 + 5 + 20) * 10 / 9600 + 2 * gap)
+    # Bits are packed eight to a byte
+    assert bus.transaction_time(10, function_code=1) == pytest.approx((8 + 5 + 2) * 10 / 9600 + 2 * gap)
+
+def test_requests_are_spaced_by_the_silent_interval(monkeypatch):
+    started = []
+    monkeypatch.setattr(ModbusSerialClient, "execute", lambda self, *args, **kwargs: started.append(time.monotonic()))
+    bus = RtuBusMaster("/dev/null", 1200)
+    for _ in range(3):
+        bus.execute(None)
+    gaps = [later - earlier for earlier, later in zip(started, started[1:])]
+    assert min(gaps) >= bus.frame_gap
@@ -0,0 +1,37 @@
+from app import metrics
+from app.sharded_poller import ShardedPoller
+from app.writes import write_queue
+from tests.test_read_plan import simulated_word
+
+def device(device_id, port):
+    return {"device_id": device_id, "slave_id": 1, "device_type_id": "1", "address": "127.0.0.1",
+            "port_baudRate": str(port), "protocol": "TCP"}
+
+def shard_ids(shards):
+    return [[d["device_id"] for d in shard] for shard in shards]
+
+def test_shards_keep_gateways_on_their_worker():
+    poller = ShardedPoller(2)
+    devices = [device(1, 502), device(2, 502), device(3, 503), device(4, 504)]
+    assert shard_ids(poller.shard(devices)) == [[1, 2], [3, 4]]
+    # A new gateway goes to the least loaded worker; the others do not move
+    assert shard_ids(poller.shard(devices[1:] + [device(5, 505), device(6, 505)])) == [[2, 5, 6], [3, 4]]
+    assert shard_ids(poller.shard([device(7, 506), device(8, 506)] + devices[1:])) == [[7, 8, 2], [3, 4]]
+
+def test_workers_poll_and_execute_forwarded_writes(poller):
+    sharded = ShardedPoller(2)
+    try:
+        requests_before = metrics.POLL_REQUESTS.get()
+        request = write_queue.submit([{"device": "1_1", "variable": "Setpoint", "value": 5}])[0]
+        sharded.poll_cycle()
+        assert len(sharded.processes) == 2
+        assert request.status == "confirmed"
+        values = {entry["variable_name"]: entry["value"] for entry in poller.get_data()["1_1"]}
+        assert values["Voltage"] == simulated_word(40000) / 10
+        assert values["Setpoint"] == 5
+        # The workers' request counters are added to the main process's
+        assert metrics.POLL_REQUESTS.get() > requests_before
+    finally:
+        sharded.stop()
+        write_queue.submit([{"device": "1_1", "variable": "Setpoint", "value": simulated_word(40100) / 10}])
+        poller.poll_cycle()
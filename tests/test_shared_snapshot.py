@@ -0,0 +1,81 @@
+import math
+import threading
+import pytest
+from app.read_plan import compile_read_plans
+from app.shared_snapshot import SEQ, SnapshotReader, SnapshotWriter
+from tests.conftest import REGISTER_MAP
+
+DEVICE_MAP = [{"device_id": 1, "slave_id": 1, "device_type_id": "1", "device_name": "Meter"}]
+PLANS = compile_read_plans(REGISTER_MAP, 100)
+SLOTS = len(REGISTER_MAP)
+
+@pytest.fixture
+def writer(tmp_path):
+    writer = SnapshotWriter(str(tmp_path / "snapshot"))
+    writer.rebuild(DEVICE_MAP, PLANS)
+    yield writer
+    writer.close()
+
+def test_round_trip(writer):
+    reader = SnapshotReader(writer.path)
+    timestamp, values = reader.read_device("1_1")
+    assert timestamp == 0.0 and all(math.isnan(value) for value in values)
+    values = [float(i) for i in range(SLOTS)]
+    writer.write_device("1_1", values, timestamp=1000.0)
+    assert reader.read_device("1_1") == (1000.0, tuple(values))
+    # Each write advances the sequence by two and leaves it even
+    assert SEQ.unpack_from(writer.mm, writer.records["1_1"][0])[0] == 2
+
+def test_record_left_mid_update_times_out(writer):
+    reader = SnapshotReader(writer.path)
+    SEQ.pack_into(writer.mm, writer.records["1_1"][0], 1)
+    with pytest.raises(TimeoutError):
+        reader.read_device("1_1", timeout=0.01)
+
+def test_reader_never_sees_a_torn_record(writer):
+    reader = SnapshotReader(writer.path)
+    stop = threading.Event()
+    def write():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            writer.write_device("1_1", [float(i)] * SLOTS, timestamp=float(i))
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        for _ in range(2000):
+            timestamp, values = reader.read_device("1_1", timeout=1)
+            if timestamp:
+                assert set(values) == {timestamp}
+    finally:
+        stop.set()
+        thread.join()
+
+def test_reader_follows_a_rebuild(writer):
+    reader = SnapshotReader(writer.path)
+    reader.ensure_current()
+    writer.rebuild(DEVICE_MAP + [dict(DEVICE_MAP[0], slave_id=2, device_name="Second")], PLANS)
+    writer.write_device("1_2", [1.0] * SLOTS, timestamp=5.0)
+    assert reader.read_device("1_2") == (5.0, (1.0,) * SLOTS)
+
+def test_reader_follows_a_new_writer(writer):
+    reader = SnapshotReader(writer.path)
+    reader.ensure_current()
+    # A restarted poller builds a fresh file at the same path without retiring the old one
+    replacement = SnapshotWriter(writer.path)
+    replacement.rebuild(DEVICE_MAP, PLANS)
+    try:
+        replacement.write_device("1_1", [2.0] * SLOTS, timestamp=7.0)
+        assert reader.read_device("1_1") == (7.0, (2.0,) * SLOTS)
+    finally:
+        replacement.close()
+
+def test_dashboard_shape_skips_unread_values(writer):
+    reader = SnapshotReader(writer.path)
+    assert reader.as_device_data() == {}
+    values = [math.nan] * SLOTS
+    values[0] = 3.0
+    writer.write_device("1_1", values, timestamp=1000.0)
+    entries = reader.as_device_data()["1_1"]
+    assert len(entries) == 1
+    assert entries[0]["value"] == 3.0 and entries[0]["device_name"] == "Meter"
@@ -0,0 +1,70 @@
+import math
+import os
+import pytest
+from app import clock
+from app.read_plan import compile_read_plans
+from app.timeseries import TimeSeriesStore
+from tests.conftest import REGISTER_MAP
+
+DEVICE = {"device_id": "1", "slave_id": "1", "device_type_id": "1"}
+# A whole number of days, so every segment span starts on it
+BASE = 1_700_006_400.0
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(clock, "source", lambda: BASE)
+    store = TimeSeriesStore(str(tmp_path), retention={"raw": 3600})
+    store.configure([DEVICE], compile_read_plans(REGISTER_MAP, 100))
+    yield store
+    store.close()
+
+def poll(store, timestamp, voltage):
+    series = store.devices["1_1"]
+    values = [math.nan] * len(series.slots)
+    values[series.slot_index[(40000, "Voltage")]] = voltage
+    store.write_device("1_1", values, timestamp)
+
+def raw_segments(store):
+    return sorted(name for name in os.listdir(os.path.join(store.path, "1_1")) if name.startswith("raw-"))
+
+def test_segment_handle_is_kept_until_rollover(store):
+    series = store.devices["1_1"]
+    poll(store, BASE + 3500, 1.0)
+    path, f = series.files["raw"]
+    poll(store, BASE + 3550, 2.0)
+    assert series.files["raw"][1] is f
+    poll(store, BASE + 3650, 3.0)
+    assert series.files["raw"][0] != path
+    assert f.closed
+    assert raw_segments(store) == [f"raw-{int(BASE)}-{series.hash}.ts", f"raw-{int(BASE) + 3600}-{series.hash}.ts"]
+    points = store.query("1_1", 40000, "Voltage", BASE, BASE + 7200, resolution="raw")["points"]
+    assert points == [[BASE + 3500, 1.0], [BASE + 3550, 2.0], [BASE + 3650, 3.0]]
+
+def test_rollups_aggregate_closed_and_open_buckets(store):
+    for i, voltage in enumerate([1.0, 3.0, 5.0, 10.0]):
+        poll(store, BASE + 30 * i, voltage)
+    points = store.query("1_1", 40000, "Voltage", BASE, BASE + 120, resolution="1m")["points"]
+    assert points == [[BASE, 1.0, 3.0, 2.0], [BASE + 60, 5.0, 10.0, 7.5]]
+
+def test_unstamped_writes_use_the_clock(store, monkeypatch):
+    monkeypatch.setattr(clock, "source", lambda: BASE + 42)
+    poll(store, None, 4.0)
+    assert store.query("1_1", 40000, "Voltage", BASE, BASE + 60, resolution="raw")["points"] == [[BASE + 42, 4.0]]
+
+def test_retention_removes_only_expired_segments(store):
+    poll(store, BASE, 1.0)
+    poll(store, BASE + 3600, 2.0)
+    poll(store, BASE + 7200, 3.0)
+    assert len(raw_segments(store)) == 3
+    # Raw keeps one hour: the first segment ended more than an hour before
+    assert store.maintain(now=BASE + 7200 + 1) == 1
+    assert len(raw_segments(store)) == 2
+    points = store.query("1_1", 40000, "Voltage", BASE, BASE + 10800, resolution="raw")["points"]
+    assert points == [[BASE + 3600, 2.0], [BASE + 7200, 3.0]]
+
+def test_removed_device_closes_its_segment(store):
+    poll(store, BASE, 1.0)
+    _, f = store.devices["1_1"].files["raw"]
+    store.configure([], {})
+    assert f.closed
+    assert store.devices == {}
@@ -0,0 +1,70 @@
+import threading
+import time
+import pytest
+from app import tracing
+from app.logger import logger
+
+@pytest.fixture
+def trace():
+    tracing.start()
+    yield
+    tracing.stop()
+
+def spans(document):
+    return [event for event in document["traceEvents"] if event["ph"] == "X"]
+
+def test_spans_are_not_recorded_while_off():
+    assert tracing.span("read") is tracing.NULL_SPAN
+
+def test_spans_are_exported_as_chrome_trace_events(trace):
+    with tracing.span("read_block", start=40000):
+        with tracing.acquire(threading.Lock(), device="1_1"):
+            pass
+    with pytest.raises(ValueError):
+        with tracing.span("decode"):
+            raise ValueError("bad")
+    document = tracing.stop()
+    events = spans(document)
+    assert [event["name"] for event in events] == ["lock_wait", "read_block", "decode"]
+    assert events[1]["args"] == {"start": 40000} and events[0]["args"] == {"device": "1_1"}
+    assert events[2]["args"] == {"error": "ValueError"}
+    read_block, lock_wait = events[1], events[0]
+    assert read_block["ts"] <= lock_wait["ts"] and lock_wait["ts"] + lock_wait["dur"] <= read_block["ts"] + read_block["dur"]
+    thread_names = [event["args"]["name"] for event in document["traceEvents"] if event["ph"] == "M"]
+    assert thread_names == [threading.current_thread().name]
+
+def test_log_handlers_are_traced_only_while_on(trace):
+    handlers = list(logger.handlers)
+    logger.error("traced")
+    events = spans(tracing.stop())
+    assert any(event["name"] == "log" and event["args"]["level"] == "ERROR" for event in events)
+    assert all("handle" not in handler.__dict__ for handler in handlers)
+
+def test_traced_decorator(trace):
+    @tracing.traced("publish")
+    def publish():
+        return 1
+    assert publish() == 1
+    assert [event["name"] for event in spans(tracing.export())] == ["publish"]
+
+def test_profile_folds_the_stacks_of_other_threads():
+    stop = threading.Event()
+    def spin_for_profile():
+        while not stop.is_set():
+            time.sleep(0.001)
+    thread = threading.Thread(target=spin_for_profile, name="spinner")
+    thread.start()
+    try:
+        folded = tracing.profile(0.1, interval=0.005)
+    finally:
+        stop.set()
+        thread.join()
+    lines = folded.splitlines()
+    spinner = [line for line in lines if line.startswith("spinner;")]
+    assert spinner and "spin_for_profile (test_tracing.py:" in spinner[0]
+    assert all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines)
+
+def test_only_one_profile_runs_at_a_time():
+    with tracing.profile_lock:
+        with pytest.raises(tracing.ProfilerBusy):
+            tracing.profile(0.01)
@@ -0,0 +1,87 @@
+import json
+import pytest
+from app import connections
+from app import modbus_reader
+from app import warm_start
+
+REGISTER_MAP_CSV = """device_type_id,device_type,variable_name,access,type,unit,gain,address,quantity,function_code
+1,Meter,Voltage,RO,U16,V,10,40000,1,3
+1,Meter,Energy,RO,U32,kWh,1,40002,2,3
+"""
+DEVICE_MAP_CSV = """device_id,slave_id,device_name,device_type_id,address,port_baudRate,protocol,byte_swap
+1,1,Meter,1,127.0.0.1,5020,TCP,FALSE
+"""
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    """Configuration files with warm start on; yields a function loading them as main() does."""
+    paths = {name: tmp_path / name for name in ("settings.json", "register_map.csv", "device_map.csv")}
+    paths["settings.json"].write_text(json.dumps({"max_registers": 100, "warm_start": {"enabled": True, "path": str(tmp_path / "warm_start.pkl")}}))
+    paths["register_map.csv"].write_text(REGISTER_MAP_CSV)
+    paths["device_map.csv"].write_text(DEVICE_MAP_CSV)
+    for name in ("options", "config_digest", "cached_config"):
+        monkeypatch.setattr(warm_start, name, getattr(warm_start, name))
+    parsed = []
+    parse_register_map = warm_start.parse_register_map
+    monkeypatch.setattr(warm_start, "parse_register_map", lambda path: parsed.append(path) or parse_register_map(path))
+    def load():
+        parsed.clear()
+        settings = warm_start.load_config(*(str(path) for path in paths.values()))
+        return settings, bool(parsed)
+    load.paths = paths
+    yield load
+    connections.serial_gateways.clear()
+    modbus_reader.configure({}, [], [])
+
+def poll_meter(voltage):
+    record = modbus_reader.device_data["1_1"]
+    record.begin_poll()
+    record.set(0, voltage)
+    record.set_block_time(0, 1000.0)
+    record.end_poll()
+    return record
+
+def test_digest_covers_the_maps_and_block_size(site):
+    paths = site.paths
+    digest = warm_start.config_file_digest({}, paths["register_map.csv"], paths["device_map.csv"])
+    assert warm_start.config_file_digest({"max_registers": 100}, paths["register_map.csv"], paths["device_map.csv"]) == digest
+    assert warm_start.config_file_digest({"max_registers": 50}, paths["register_map.csv"], paths["device_map.csv"]) != digest
+    paths["device_map.csv"].write_text(DEVICE_MAP_CSV.replace("Meter,1,", "Main meter,1,"))
+    assert warm_start.config_file_digest({}, paths["register_map.csv"], paths["device_map.csv"]) != digest
+
+def test_unchanged_configuration_restores_plans_and_values(site):
+    _, parsed = site()
+    assert parsed
+    poll_meter(230.0)
+    connections.serial_gateways.add(("TCP", "127.0.0.1", 5020))
+    warm_start.save()
+    connections.serial_gateways.clear()
+
+    _, parsed = site()
+    assert not parsed
+    record = modbus_reader.device_data["1_1"]
+    assert record.stale and record.values[0] == 230.0 and record.block_times[0] == 1000.0
+    assert ("TCP", "127.0.0.1", 5020) in connections.serial_gateways
+    # The next successful poll clears the stale mark
+    assert not poll_meter(231.0).stale
+
+def test_changed_register_map_invalidates_the_cache(site):
+    site()
+    poll_meter(230.0)
+    warm_start.save()
+    site.paths["register_map.csv"].write_text(REGISTER_MAP_CSV.replace("40002,2,3", "40004,2,3"))
+    _, parsed = site()
+    assert parsed
+    # The layout changed with the addresses, so the saved values are not restored either
+    record = modbus_reader.device_data["1_1"]
+    assert not record.stale and record.seq == 0
+
+def test_changed_device_map_keeps_records_of_unchanged_layouts(site):
+    site()
+    poll_meter(230.0)
+    warm_start.save()
+    site.paths["device_map.csv"].write_text(DEVICE_MAP_CSV + "2,2,Second meter,1,127.0.0.1,5020,TCP,FALSE\n")
+    _, parsed = site()
+    assert parsed
+    assert modbus_reader.device_data["1_1"].values[0] == 230.0
+    assert modbus_reader.device_data["2_2"].seq == 0
@@ -0,0 +1,108 @@
+import pytest
+from app import connections
+from app import metrics
+from app import writes
+from app.writes import WriteError, WriteRequest, coalesce, write_queue
+
+def request(address, words, write_only=False):
+    return WriteRequest(f"w{address}", "1_1", address, words, write_only=write_only)
+
+def layout(runs):
+    return [(address, words, [member.address for member in members]) for address, words, members in runs]
+
+def test_coalesce_merges_adjacent_registers_in_address_order():
+    runs = coalesce([request(40102, [3]), request(40100, [1]), request(40101, [2]), request(40200, [9])])
+    assert layout(runs) == [(40100, [1, 2, 3], [40100, 40101, 40102]), (40200, [9], [40200])]
+
+def test_coalesce_keeps_write_only_commands_in_submission_order():
+    runs = coalesce([request(40101, [2]), request(40103, [1], write_only=True), request(40100, [1]),
+                     request(40103, [0], write_only=True)])
+    assert layout(runs) == [(40101, [2], [40101]), (40103, [1], [40103]), (40100, [1], [40100]), (40103, [0], [40103])]
+
+def test_coalesce_never_merges_write_only_registers():
+    runs = coalesce([request(40102, [1], write_only=True), request(40103, [1], write_only=True)])
+    assert len(runs) == 2
+
+def test_submit_validates(poller):
+    with pytest.raises(WriteError, match="read-only"):
+        write_queue.submit([{"device": "1_1", "variable": "Voltage", "value": 230}])
+    with pytest.raises(WriteError, match="out of range"):
+        write_queue.submit([{"device": "1_1", "variable": "Setpoint", "value": 10000}])
+    with pytest.raises(WriteError, match="Unknown device"):
+        write_queue.submit([{"device": "9_9", "variable": "Setpoint", "value": 1}])
+    assert not write_queue.has_pending("1_1")
+
+def test_submit_refused_when_writes_disabled(poller):
+    write_queue.enabled = False
+    with pytest.raises(WriteError, match="disabled"):
+        write_queue.submit([{"device": "1_1", "variable": "Setpoint", "value": 1}])
+
+def test_writes_are_coalesced_and_read_back(poller):
+    transactions = metrics.WRITE_TRANSACTIONS.get(function_code=16)
+    queued = write_queue.submit([
+        {"device": "1_1", "variable": "Limit", "value": 3000000},
+        {"device": "1_1", "variable": "Setpoint", "value": 42.5},
+        {"device": "1_1", "variable": "Reset", "value": 1},
+    ])
+    poller.poll_cycle()
+    assert [r.status for r in queued] == ["confirmed", "confirmed", "written"]
+    # Setpoint and Limit are adjacent: one FC16 request
+    assert metrics.WRITE_TRANSACTIONS.get(function_code=16) == transactions + 1
+
+    poller.poll_cycle()
+    values = {entry["variable_name"]: entry["value"] for entry in poller.get_data()["1_1"]}
+    assert values["Setpoint"] == 42.5
+    assert values["Limit"] == 3000000
+
+def test_newer_value_supersedes_queued_one(poller):
+    first = write_queue.submit([{"device": "2_2", "variable": "Setpoint", "value": 1}])[0]
+    second = write_queue.submit([{"device": "2_2", "variable": "Setpoint", "value": 2}])[0]
+    poller.poll_cycle()
+    assert (first.status, second.status) == ("superseded", "confirmed")
+
+def test_word_swapped_device_round_trip(poller, simulator):
+    devices = [dict(device, byte_swap="word") for device in simulator]
+    poller.configure(dict(poller.settings), poller.register_map, devices)
+    queued = write_queue.submit([{"device": "1_1", "variable": "Limit", "value": 70000}])
+    poller.poll_cycle()
+    assert queued[0].status == "confirmed"
+    poller.poll_cycle()
+    values = {entry["variable_name"]: entry["value"] for entry in poller.get_data()["1_1"]}
+    assert values["Limit"] == 70000
+    # Low word first on the wire
+    client = connections.get_client(devices[0])
+    assert client.read_holding_registers(address=40101, count=2, slave=1).registers == [0x1170, 0x0001]
+
+@pytest.mark.parametrize("value", [float("nan"), float("inf"), -float("inf")])
+@pytest.mark.parametrize("variable", ["Setpoint", "Limit"])
+def test_non_finite_values_are_rejected(poller, value, variable):
+    with pytest.raises(WriteError, match="finite"):
+        write_queue.submit([{"device": "1_1", "variable": variable, "value": value}])
+
+@pytest.mark.parametrize("writes", [[1], ["Setpoint"], [None], {"device": "1_1"}, "writes"])
+def test_malformed_batches_are_rejected(poller, writes):
+    with pytest.raises(WriteError):
+        write_queue.submit(writes)
+
+def test_writes_for_removed_devices_fail(poller, simulator):
+    queued = write_queue.submit([{"device": "2_2", "variable": "Setpoint", "value": 1}])
+    poller.stage_config(dict(poller.settings), poller.register_map, simulator[:1])
+    poller.apply_pending_config()
+    assert queued[0].status == "failed"
+    assert "no longer configured" in queued[0].error
+
+def test_forwarded_writes_are_always_reported(poller):
+    forwarded = write_queue.add_forwarded({"1_1": [("f1", 40100, [7], False)], "9_9": [("f2", 40100, [7], False)]})
+    poller.poll_cycle()
+    write_queue.fail_unfinished(forwarded, "Device was not polled by its worker")
+    assert [(request.request_id, request.status) for request in forwarded] == [("f1", "confirmed"), ("f2", "failed")]
+    assert not write_queue.has_pending("9_9")
+
+def test_finished_requests_are_evicted_behind_a_queued_one(poller, monkeypatch):
+    monkeypatch.setattr(writes, "MAX_FINISHED", 5)
+    stuck = write_queue.submit([{"device": "2_2", "variable": "Setpoint", "value": 1}])[0]
+    for value in range(20):
+        for request in write_queue.submit([{"device": "1_1", "variable": "Setpoint", "value": value}]):
+            request.finish("confirmed")
+    assert len(write_queue.requests) == 5
+    assert write_queue.get(stuck.request_id) is stuck